@@ -7,28 +7,37 @@ import json
 import logging
 from logging.handlers import RotatingFileHandler
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import threading
 import re
+import asyncio
 from datetime import datetime, timedelta
 from flask import Flask, request, abort, jsonify, render_template
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import MessageEvent, TextMessage, TextSendMessage, FollowEvent
 import redis
+from redis.utils import HIREDIS_AVAILABLE
 from random import choice
 from collections import Counter
 import signal
+import socket
 import atexit
+import functools
 import math
-from waitress import serve
+import secrets
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor as SchedulerThreadPoolExecutor
 from apscheduler.schedulers.base import SchedulerNotRunningError
 
 # นำเข้าโมดูลภายในโปรเจค
 from .middleware.rate_limiter import init_limiter
 from .config import load_config, SYSTEM_MESSAGES, GENERATION_CONFIG, SUMMARY_GENERATION_CONFIG, TOKEN_THRESHOLD
-from .utils import safe_db_operation, safe_api_call, clean_ai_response, check_hospital_inquiry, get_hospital_information_message, handle_grok_api_error
+from .utils import safe_db_operation, safe_api_call, clean_ai_response, check_hospital_inquiry, get_hospital_information_message, handle_grok_api_error, TTLCache, json_loads
 from .llm import grok_client
 from .chat_history_db import ChatHistoryDB
 from .token_counter import TokenCounter
@@ -50,6 +59,7 @@ from .risk_assessment import (
     generate_progress_report,
     RISK_KEYWORDS,
     GENERAL_RISK_LEVEL,
+    PROGRESS_HISTORY_LIMIT,
     normalize_risk_level,
 )
 from .database_init import initialize_database
@@ -66,17 +76,31 @@ from enum import Enum
 
 # ค่าคงที่ส่วนของการแอพลิเคชัน
 FOLLOW_UP_INTERVALS = [1, 3, 7, 14, 30]  # จำนวนวันในการติดตาม
+_FOLLOW_UP_IDX = {days: i for i, days in enumerate(FOLLOW_UP_INTERVALS)}  # จำนวนวัน -> ดัชนี
 SESSION_TIMEOUT = 604800  # 7 วัน (7 * 24 * 60 * 60 วินาที)
 MESSAGE_LOCK_TIMEOUT = 30  # ระยะเวลาล็อค (วินาที)
+MAX_USER_MESSAGE_LENGTH = 2000  # ความยาวข้อความสูงสุดที่ส่งเข้าระบบประมวลผล (ตัวอักษร)
+WEBHOOK_EVENT_DEDUP_TTL = 120  # ระยะเวลาจำ webhook event id เพื่อข้ามการส่งซ้ำจาก LINE (วินาที)
+SHUTDOWN_DRAIN_TIMEOUT = 5  # เวลารอข้อความที่กำลังประมวลผลตอนปิดแอป ก่อนปลดล็อคที่เหลือทิ้ง (วินาที)
 DB_RESTORE_MESSAGE_PAIRS = 40  # จำนวนคู่ข้อความล่าสุดที่ใช้ในการกู้คืนจากฐานข้อมูล
+MESSAGE_WORKERS = int(os.getenv('MESSAGE_WORKERS', '32'))  # จำนวนเธรดที่ประมวลผลข้อความนอกเธรดของ webhook
+FOLLOW_UP_WORKERS = 8  # จำนวนเธรดที่ส่งข้อความติดตามพร้อมกันในแต่ละรอบ
+LOADING_WORKERS = 8  # จำนวนเธรดที่เรียก LINE loading animation แบบไม่รอผล
+FOLLOW_UP_BATCH_SIZE = 100  # จำนวนรายการติดตามสูงสุดที่ดึงออกจากคิวต่อการเรียก Redis หนึ่งครั้ง
+FOLLOW_UP_LEASE_SECONDS = 600  # ระยะเวลาที่รายการติดตามที่ดึงออกมาถือไว้ใน follow_up_inflight ก่อนถูกคืนเข้าคิว (วินาที)
+FOLLOW_UP_BATCH_PAUSE = 0.1  # เวลาพักระหว่างชุดการติดตาม เพื่อคืน GIL ให้เธรดที่ตอบ webhook (วินาที)
+SUMMARY_TIMEOUT = 20  # เวลารอผลสรุปประวัติแบบขนานทั้งหมด ต้องน้อยกว่า MESSAGE_LOCK_TIMEOUT (วินาที)
+HEALTH_CHECK_TTL = 5  # อายุแคชผลการตรวจสุขภาพ (วินาที)
+API_HEALTH_CHECK_TTL = 30  # อายุแคชผลการตรวจ API ภายนอก (LINE, xAI) ซึ่งมีค่าใช้จ่ายต่อครั้ง (วินาที)
 PROCESSING_MESSAGES = [
     "⌛ กำลังคิดอยู่ค่ะ...",
     "🤔 กำลังประมวลผลข้อความของคุณ...",
     "📝 กำลังเรียบเรียงคำตอบ...",
     "🔄 รอสักครู่นะคะ..."
 ]
-HIGH_RISK_KEYWORDS = {kw.lower() for kw in RISK_KEYWORDS.get('high_risk', [])}
-MEDIUM_RISK_KEYWORDS = {kw.lower() for kw in RISK_KEYWORDS.get('medium_risk', [])}
+# ระดับความเสี่ยงของคำสำคัญ (ตัวพิมพ์เล็ก) ใช้ในแดชบอร์ด หากคำอยู่ทั้งสองกลุ่มให้ถือเป็นความเสี่ยงสูง
+KEYWORD_RISK_LEVELS = {kw.lower(): 'medium' for kw in RISK_KEYWORDS.get('medium_risk', [])}
+KEYWORD_RISK_LEVELS.update((kw.lower(), 'high') for kw in RISK_KEYWORDS.get('high_risk', []))
 
 # Legacy error types for backward compatibility - will be migrated to new system
 class ErrorType(Enum):
@@ -109,27 +133,83 @@ logging.basicConfig(
 # โหลดการตั้งค่าและตัวแปรสภาพแวดล้อม
 config = load_config()
 
+class SessionHttpClient(RequestsHttpClient):
+    """RequestsHttpClient ของ LINE SDK ที่ส่งทุกคำขอผ่าน requests.Session เดียวกัน
+
+    SDK เรียก requests.get/post ระดับโมดูลซึ่งไม่ใช้ connection ซ้ำ คลาสนี้ใช้ session
+    ที่มี connection pool แบบ keep-alive แทน (กำหนด SessionHttpClient.session ก่อนสร้าง LineBotApi)
+    """
+    session = None
+
+    def _request(self, method, url, timeout=None, **kwargs):
+        response = self.session.request(
+            method, url, timeout=self.timeout if timeout is None else timeout, **kwargs
+        )
+        return RequestsHttpResponse(response)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request('GET', url, timeout, headers=headers, params=params, stream=stream)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request('POST', url, timeout, headers=headers, data=data)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request('DELETE', url, timeout, headers=headers, data=data)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request('PUT', url, timeout, headers=headers, data=data)
+
 # เริ่มต้นเซอร์วิสภายนอก
 try:
-    # เริ่มต้น Redis
-    redis_client = redis.Redis(
+    # เริ่มต้น Redis ด้วย connection pool ที่ใช้ร่วมกันทุกเธรด
+    redis_keepalive_options = {}
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        redis_keepalive_options[socket.TCP_KEEPIDLE] = 30
+    redis_pool = redis.BlockingConnectionPool(
         host=config.REDIS_HOST,
         port=config.REDIS_PORT,
         db=config.REDIS_DB,
+        max_connections=int(os.getenv('REDIS_POOL', 64)),
+        # เมื่อ pool เต็ม รอการเชื่อมต่อว่างไม่เกิน 2 วินาที (ค่าเริ่มต้นคือ 20 วินาที)
+        timeout=2,
         decode_responses=True,
         socket_timeout=5,
-        socket_connect_timeout=5
+        socket_connect_timeout=5,
+        socket_keepalive=True,
+        socket_keepalive_options=redis_keepalive_options,
+        health_check_interval=30,
     )
+    redis_client = redis.Redis(connection_pool=redis_pool)
     redis_client.ping()  # ตรวจสอบการเชื่อมต่อ
-
-    # เริ่มต้น Line API
-    line_bot_api = LineBotApi(config.LINE_CHANNEL_ACCESS_TOKEN)
+    if HIREDIS_AVAILABLE:
+        logging.info("Redis client ใช้ hiredis parser")
+    else:
+        logging.warning("ไม่พบ hiredis, Redis client ใช้ parser แบบ Python ล้วน")
+
+    # HTTP session ที่ใช้ซ้ำสำหรับทุกการเรียก LINE API (keep-alive ไม่ต้องทำ TLS handshake ใหม่ทุกครั้ง)
+    # retry เฉพาะกรณีเชื่อมต่อไม่สำเร็จหนึ่งครั้ง (urllib3 ไม่ retry POST ที่ส่งไปแล้ว)
+    _line_session = requests.Session()
+    _line_session.mount('https://', HTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=100,
+        max_retries=Retry(total=1, backoff_factor=0.2),
+    ))
+
+    # เริ่มต้น Line API ผ่าน session เดียวกัน
+    SessionHttpClient.session = _line_session
+    line_bot_api = LineBotApi(config.LINE_CHANNEL_ACCESS_TOKEN, http_client=SessionHttpClient)
     handler = WebhookHandler(config.LINE_CHANNEL_SECRET)
 
+    _LINE_LOAD_HEADERS = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {config.LINE_CHANNEL_ACCESS_TOKEN}'
+    }
+
     # ใช้ Grok client ผ่านโมดูลรวมศูนย์ app/llm/grok_client.py
 
     # เริ่มต้นตัวนับโทเค็นที่ปรับปรุงแล้ว
-    token_counter = TokenCounter(cache_size=5000)
+    # แคชต้องใหญ่พอให้ข้อความเดิมในเซสชันที่ใช้งานอยู่ไม่ถูก tokenize ซ้ำทุกครั้งที่บันทึก
+    token_counter = TokenCounter(cache_size=int(os.getenv('TOKEN_CACHE_SIZE', 20000)))
 
     # เริ่มต้น DatabaseManager สำหรับการจัดการฐานข้อมูล
     db_config = {
@@ -145,9 +225,12 @@ try:
     db_retry_count = 0
     db_manager = None
     
+    # ขนาด pool รวมทุกโปรเซส (DB_POOL_SIZE) หารด้วยจำนวน worker ของ gunicorn
+    # เพื่อไม่ให้จำนวนการเชื่อมต่อรวมเกิน max_connections ของ MySQL
+    db_pool_size = max(4, int(os.getenv('DB_POOL_SIZE', 32)) // max(1, int(os.getenv('WEB_CONCURRENCY', 1))))
     while db_retry_count < max_db_retries:
         try:
-            db_manager = DatabaseManager(db_config, pool_size=32)
+            db_manager = DatabaseManager(db_config, pool_size=db_pool_size)
             break  # Success, exit retry loop
         except Exception as e:
             db_retry_count += 1
@@ -164,20 +247,22 @@ try:
     if db_manager is None:
         raise RuntimeError("Failed to initialize database manager after all retries")
 
-    # เสร็จสิ้นการตรวจสอบและเริ่มต้นฐานข้อมูล
-    initialize_database(db_config)
-    logging.info("เสร็จสิ้นการเริ่มต้นและตรวจสอบฐานข้อมูล")
-    
-    # Apply database optimizations
-    try:
-        from .database_optimization import optimize_database
-        optimization_result = optimize_database(db_config)
-        if optimization_result:
-            logging.info("การปรับปรุงประสิทธิภาพฐานข้อมูลสำเร็จ")
-        else:
-            logging.warning("การปรับปรุงประสิทธิภาพฐานข้อมูลเสร็จสิ้นแต่มีปัญหาบางส่วน")
-    except Exception as e:
-        logging.error(f"ไม่สามารถรันการปรับปรุงฐานข้อมูลได้: {str(e)}")
+    # สร้าง/ตรวจสอบตารางและปรับปรุงฐานข้อมูล เมื่อรันหลาย worker ให้ทำครั้งเดียวก่อน fork
+    # (gunicorn.conf.py รันขั้นตอนนี้ใน on_starting แล้วตั้ง DB_INIT_ON_START=0 ให้ worker)
+    if os.getenv('DB_INIT_ON_START', '1') != '0':
+        initialize_database(db_config)
+        logging.info("เสร็จสิ้นการเริ่มต้นและตรวจสอบฐานข้อมูล")
+
+        # Apply database optimizations
+        try:
+            from .database_optimization import optimize_database
+            optimization_result = optimize_database(db_config)
+            if optimization_result:
+                logging.info("การปรับปรุงประสิทธิภาพฐานข้อมูลสำเร็จ")
+            else:
+                logging.warning("การปรับปรุงประสิทธิภาพฐานข้อมูลเสร็จสิ้นแต่มีปัญหาบางส่วน")
+        except Exception as e:
+            logging.error(f"ไม่สามารถรันการปรับปรุงฐานข้อมูลได้: {str(e)}")
 
     # เริ่มต้น ChatHistoryDB ด้วย DatabaseManager
     db = ChatHistoryDB(db_manager)
@@ -203,30 +288,50 @@ def dashboard_page():
 
 
 
+@functools.lru_cache(maxsize=4096)
+def _parse_iso_timestamp(value: str) -> Optional[datetime]:
+    # Progress lists repeat across dashboard polls, so each ISO string is parsed once.
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        if value.endswith('Z'):
+            try:
+                return datetime.fromisoformat(value.replace('Z', '+00:00'))
+            except ValueError:
+                return None
+    return None
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_progress_timestamp(value: datetime) -> str:
+    return value.isoformat()
+
+
 def _parse_progress_timestamp(value: Any) -> Optional[datetime]:
     if value is None:
         return None
     if isinstance(value, datetime):
         return value
     if isinstance(value, str):
+        return _parse_iso_timestamp(value)
+    if isinstance(value, bytes):
+        return _parse_iso_timestamp(value.decode('utf-8', 'replace'))
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
         try:
-            return datetime.fromisoformat(value)
-        except ValueError:
-            if value.endswith('Z'):
-                try:
-                    return datetime.fromisoformat(value.replace('Z', '+00:00'))
-                except ValueError:
-                    return None
+            return datetime.fromtimestamp(value)
+        except (OverflowError, OSError, ValueError):
+            return None
     return None
 
 
 def _classify_keyword_risk(keyword: str) -> str:
-    key_lower = keyword.lower()
-    if key_lower in HIGH_RISK_KEYWORDS:
-        return 'high'
-    if key_lower in MEDIUM_RISK_KEYWORDS:
-        return 'medium'
-    return 'contextual'
+    return KEYWORD_RISK_LEVELS.get(keyword.lower(), 'contextual')
+
+
+# progress:* lists fetched per Redis pipeline (one round trip per batch, not per user).
+DASHBOARD_SCAN_BATCH = 500
+# Seconds a rendered /api/dashboard/insights payload is reused for identical queries.
+DASHBOARD_INSIGHTS_CACHE_TTL = 45
 
 
 def _collect_dashboard_progress_metrics(
@@ -234,6 +339,7 @@ def _collect_dashboard_progress_metrics(
     per_user_limit: int = 5,
     keyword_limit: int = 10,
 ) -> Dict[str, Any]:
+    raw_keyword_counter: Counter[str] = Counter()
     keyword_counter: Counter[str] = Counter()
     display_lookup: Dict[str, str] = {}
     risk_counter: Counter[str] = Counter()
@@ -246,45 +352,72 @@ def _collect_dashboard_progress_metrics(
         }
 
     cutoff = datetime.now() - timedelta(days=max(1, lookback_days))
-    try:
-        for key in redis_client.scan_iter('progress:*'):
+    limit_per_user = max(1, per_user_limit)
+
+    def _process_batch(keys: List[str]) -> None:
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            # Writers trim lists to PROGRESS_HISTORY_LIMIT; the bound also caps any untrimmed legacy list.
+            pipe.lrange(key, 0, PROGRESS_HISTORY_LIMIT - 1)
+        for key, entries in zip(keys, pipe.execute()):
             user_id = key.split(':', 1)[1] if ':' in key else key
-            entries = redis_client.lrange(key, 0, -1)
-            limit_per_user = max(1, per_user_limit)
             recent_events: List[Dict[str, Any]] = []
+            # Lists are newest-first: once an entry falls before the cutoff, so do all later ones.
+            in_window = True
             for raw in entries:
                 try:
-                    entry = json.loads(raw)
-                except (TypeError, json.JSONDecodeError):
+                    entry = json_loads(raw)
+                except (TypeError, ValueError):
                     continue
 
-                timestamp = _parse_progress_timestamp(entry.get('timestamp'))
                 raw_level = entry.get('risk_level')
                 risk_level = normalize_risk_level(raw_level)
-                keywords = entry.get('keywords') or []
                 risk_counter[risk_level] += 1
 
-                if risk_level in ('high', 'medium') and len(recent_events) < limit_per_user:
+                wants_event = risk_level in ('high', 'medium') and len(recent_events) < limit_per_user
+                if not (in_window or wants_event):
+                    continue
+
+                timestamp = _parse_progress_timestamp(entry.get('timestamp'))
+                keywords = entry.get('keywords') or []
+
+                if wants_event:
                     recent_events.append({
-                        'timestamp': timestamp.isoformat() if timestamp else None,
+                        'timestamp': _format_progress_timestamp(timestamp) if timestamp else None,
                         'risk_level': risk_level,
                         'keywords': keywords,
                     })
 
-                if timestamp and timestamp >= cutoff:
-                    for keyword in keywords:
-                        normalized = keyword.strip()
-                        if not normalized:
-                            continue
-                        lowered = normalized.lower()
-                        keyword_counter[lowered] += 1
-                        display_lookup.setdefault(lowered, normalized)
+                if in_window and timestamp:
+                    if timestamp >= cutoff:
+                        raw_keyword_counter.update(keywords)
+                    else:
+                        in_window = False
 
             if recent_events:
                 user_progress[user_id] = recent_events
+
+    try:
+        batch: List[str] = []
+        for key in redis_client.scan_iter(match='progress:*', count=1000):
+            batch.append(key)
+            if len(batch) >= DASHBOARD_SCAN_BATCH:
+                _process_batch(batch)
+                batch = []
+        if batch:
+            _process_batch(batch)
     except Exception as exc:
         logging.warning('Failed to collect progress metrics: %s', exc)
 
+    # Normalise each distinct keyword once rather than once per occurrence.
+    for keyword, count in raw_keyword_counter.items():
+        normalized = keyword.strip()
+        if not normalized:
+            continue
+        lowered = normalized.lower()
+        keyword_counter[lowered] += count
+        display_lookup.setdefault(lowered, normalized)
+
     top_keywords: List[Dict[str, Any]] = []
     for lowered, count in keyword_counter.most_common(max(1, keyword_limit)):
         label = display_lookup.get(lowered, lowered)
@@ -325,6 +458,17 @@ def get_dashboard_insights():
         lookback_days = max(1, min(lookback_days, 180))
         keyword_limit = max(1, min(keyword_limit, 50))
 
+        # Dashboards poll this endpoint; serve the cached payload unless ?fresh=1 asks for a rebuild.
+        cache_key = f"dashboard:insights:{user_limit}:{lookback_days}:{keyword_limit}"
+        if redis_client is not None and request.args.get('fresh') != '1':
+            try:
+                cached = redis_client.get(cache_key)
+            except Exception as exc:
+                logging.warning('Could not read cached dashboard insights: %s', exc)
+                cached = None
+            if cached:
+                return app.response_class(cached, mimetype='application/json')
+
         progress_metrics = _collect_dashboard_progress_metrics(
             lookback_days=lookback_days,
             per_user_limit=5,
@@ -352,6 +496,9 @@ def get_dashboard_insights():
         user_summaries = db.get_recent_user_summaries(limit=user_limit) or []
         user_progress_map = progress_metrics.get('user_progress', {})
         formatted_users: List[Dict[str, Any]] = []
+        # Aggregates are accumulated in the same pass that formats each user.
+        total_messages_all = important_messages_all = total_tokens_all = 0
+        high_focus_users = growth_watch_users = returning_users = deep_conversation_users = 0
 
         for summary in user_summaries:
             formatted = dict(summary)
@@ -363,37 +510,35 @@ def get_dashboard_insights():
             important_messages = int(formatted.get('important_messages') or 0)
             total_tokens = int(formatted.get('total_tokens') or 0)
 
-            formatted['total_messages'] = total_messages
-            formatted['important_messages'] = important_messages
-            formatted['total_tokens'] = total_tokens
-            formatted['important_ratio'] = (
+            important_ratio = (
                 round(important_messages / total_messages, 3)
                 if total_messages else 0.0
             )
+
+            formatted['total_messages'] = total_messages
+            formatted['important_messages'] = important_messages
+            formatted['total_tokens'] = total_tokens
+            formatted['important_ratio'] = important_ratio
             formatted['recent_risk_events'] = user_progress_map.get(
                 formatted.get('user_id'), []
             )
 
             formatted_users.append(formatted)
 
+            total_messages_all += total_messages
+            important_messages_all += important_messages
+            total_tokens_all += total_tokens
+            if important_ratio >= 0.4:
+                high_focus_users += 1
+            elif important_ratio >= 0.15:
+                growth_watch_users += 1
+            if total_messages >= 10:
+                returning_users += 1
+            if total_tokens >= 2000:
+                deep_conversation_users += 1
+
         total_users = len(formatted_users)
-        total_messages_all = sum(user['total_messages'] for user in formatted_users)
-        important_messages_all = sum(user['important_messages'] for user in formatted_users)
-        total_tokens_all = sum(user['total_tokens'] for user in formatted_users)
-        high_focus_users = sum(
-            1 for user in formatted_users
-            if user.get('important_ratio', 0) >= 0.4
-        )
-        growth_watch_users = sum(
-            1 for user in formatted_users
-            if 0.15 <= user.get('important_ratio', 0) < 0.4
-        )
         monitor_users = max(total_users - high_focus_users - growth_watch_users, 0)
-        returning_users = sum(1 for user in formatted_users if user['total_messages'] >= 10)
-        deep_conversation_users = sum(
-            1 for user in formatted_users
-            if user['total_tokens'] >= 2000
-        )
         avg_messages_per_user = (
             round(total_messages_all / total_users, 1)
             if total_users
@@ -451,7 +596,13 @@ def get_dashboard_insights():
             'infographic': infographic,
             'users': formatted_users,
         }
-        return jsonify(response_payload)
+        body = app.json.dumps(response_payload)
+        if redis_client is not None:
+            try:
+                redis_client.setex(cache_key, DASHBOARD_INSIGHTS_CACHE_TTL, body)
+            except Exception as exc:
+                logging.warning('Could not cache dashboard insights: %s', exc)
+        return app.response_class(body, mimetype='application/json')
 
     except Exception as exc:
         logging.error('Error generating dashboard insights: %s', exc, exc_info=True)
@@ -489,14 +640,14 @@ def get_dashboard_user_history(user_id: str):
             raw_events = redis_client.lrange(f"progress:{user_id}", 0, limit - 1)
             for raw in raw_events:
                 try:
-                    event = json.loads(raw)
-                except (TypeError, json.JSONDecodeError):
+                    event = json_loads(raw)
+                except (TypeError, ValueError):
                     continue
 
                 timestamp = _parse_progress_timestamp(event.get('timestamp'))
                 normalized_level = normalize_risk_level(event.get('risk_level'))
                 risk_events.append({
-                    'timestamp': timestamp.isoformat() if timestamp else event.get('timestamp'),
+                    'timestamp': _format_progress_timestamp(timestamp) if timestamp else event.get('timestamp'),
                     'risk_level': normalized_level,
                     'keywords': event.get('keywords') or [],
                 })
@@ -518,51 +669,92 @@ def get_dashboard_user_history(user_id: str):
         }), 500
 
 
+# แคชผลการตรวจสุขภาพ: load balancer ที่ probe ทุกวินาทีจะไม่ไปเรียก MySQL/Redis/API ภายนอกทุกครั้ง
+_health_cache = TTLCache(maxsize=16, ttl=HEALTH_CHECK_TTL)
+_api_health_cache = TTLCache(maxsize=16, ttl=API_HEALTH_CHECK_TTL)
+_HEALTH_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="health-check")
+
+def _cache_health_result_in(cache):
+    """สร้างเดโครเรเตอร์ที่เก็บผลของฟังก์ชันตรวจสุขภาพ (ไม่มีอาร์กิวเมนต์) ไว้ใน cache ที่กำหนด"""
+    def decorator(func):
+        # ให้มีเพียงเธรดเดียวที่ตรวจจริงเมื่อแคชหมดอายุ เธรดอื่นรอและใช้ผลเดียวกัน
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper():
+            result = cache.get(func.__name__)
+            if result is None:
+                with lock:
+                    result = cache.get(func.__name__)
+                    if result is None:
+                        result = func()
+                        cache.set(func.__name__, result)
+            return result
+        return wrapper
+    return decorator
+
+# ตรวจบริการภายใน (MySQL/Redis) ซ้ำได้ทุก HEALTH_CHECK_TTL วินาที
+cache_health_result = _cache_health_result_in(_health_cache)
+# ตรวจ API ภายนอกซ้ำได้ทุก API_HEALTH_CHECK_TTL วินาที
+cache_api_health_result = _cache_health_result_in(_api_health_cache)
+
+@cache_health_result
+def get_database_health_status():
+    """สถานะฐานข้อมูลสำหรับ /health"""
+    try:
+        if db_manager and db_manager.check_connection():
+            return 'healthy'
+        return 'unhealthy'
+    except Exception as e:
+        return f'error: {str(e)[:50]}'
+
+@cache_health_result
+def get_redis_health_status():
+    """สถานะ Redis สำหรับ /health"""
+    try:
+        redis_client.ping()
+        return 'healthy'
+    except Exception as e:
+        return f'error: {str(e)[:50]}'
+
 # Health check endpoint
 @app.route('/health', methods=['GET'])
 def health_check():
     """
     Health check endpoint for monitoring
+
+    ?deep=1 also calls the LINE and xAI APIs (results cached for API_HEALTH_CHECK_TTL seconds)
     """
     try:
+        checks = {
+            'database': get_database_health_status,
+            'redis': get_redis_health_status,
+        }
+        deep = request.args.get('deep') == '1'
+        if deep:
+            checks['line_api'] = check_line_api_health
+            checks['xai_api'] = check_grok_api_health
+
+        # ตรวจทุกบริการพร้อมกัน เวลารวมจึงเท่ากับตัวที่ช้าที่สุด ไม่ใช่ผลรวมของทุกตัว
+        futures = {name: _HEALTH_POOL.submit(check) for name, check in checks.items()}
+
         health_status = {
             'status': 'healthy',
             'timestamp': datetime.now().isoformat(),
-            'services': {
-                'database': 'unknown',
-                'redis': 'unknown',
-                'xai_api': 'unknown'
-            }
+            'services': {}
         }
-        
-        # Check database
-        try:
-            if db_manager and db_manager.check_connection():
-                health_status['services']['database'] = 'healthy'
-            else:
-                health_status['services']['database'] = 'unhealthy'
+
+        for name, future in futures.items():
+            result = future.result()
+            if isinstance(result, bool):
+                result = 'healthy' if result else 'unhealthy'
+            health_status['services'][name] = result
+            if result != 'healthy':
                 health_status['status'] = 'degraded'
-        except Exception as e:
-            health_status['services']['database'] = f'error: {str(e)[:50]}'
-            health_status['status'] = 'degraded'
-        
-        # Check Redis
-        try:
-            redis_client.ping()
-            health_status['services']['redis'] = 'healthy'
-        except Exception as e:
-            health_status['services']['redis'] = f'error: {str(e)[:50]}'
-            health_status['status'] = 'degraded'
-        
-        # Check xAI API (simple check)
-        try:
+
+        if not deep:
             # This is a lightweight check - we don't actually call the API
-            if config.XAI_API_KEY:
-                health_status['services']['xai_api'] = 'configured'
-            else:
-                health_status['services']['xai_api'] = 'not_configured'
-        except Exception as e:
-            health_status['services']['xai_api'] = f'error: {str(e)[:50]}'
+            health_status['services']['xai_api'] = 'configured' if config.XAI_API_KEY else 'not_configured'
         
         # Determine overall status code
         if health_status['status'] == 'healthy':
@@ -585,10 +777,11 @@ def chunk_conversation_history(history, chunk_size=10):
         history (list): ประวัติการสนทนา [(id, user_msg, bot_resp), ...]
         chunk_size (int): ขนาดของแต่ละส่วน
 
-    Returns:
-        list: รายการของส่วนประวัติการสนทนา
+    Yields:
+        list: ส่วนของประวัติการสนทนาทีละส่วน (ไม่สร้าง list ของทุกส่วนไว้พร้อมกัน)
     """
-    return [history[i:i + chunk_size] for i in range(0, len(history), chunk_size)]
+    for i in range(0, len(history), chunk_size):
+        yield history[i:i + chunk_size]
 
 @safe_api_call
 def summarize_conversation_chunk(chunk):
@@ -605,24 +798,129 @@ def summarize_conversation_chunk(chunk):
         return ""
 
     try:
-        summary_prompt = "นี่คือส่วนของประวัติการสนทนา โปรดสรุปประเด็นสำคัญในส่วนนี้โดยย่อ:\n"
-        for _, msg, resp in chunk:
-            summary_prompt += f"\nผู้ใช้: {msg}\nบอท: {resp}\n"
-
-        text = grok_client.send_chat(
-            messages=[
-                SYSTEM_MESSAGES,
-                {"role": "user", "content": summary_prompt}
-            ],
-            model=config.XAI_MODEL,
-            **SUMMARY_GENERATION_CONFIG,
-        )
-
-        return text
+        return _send_summary_prompt(_build_chunk_summary_prompt(chunk))
     except Exception as e:
         logging.error(f"เกิดข้อผิดพลาดใน summarize_conversation_chunk: {str(e)}")
         return ""
 
+def _send_summary_prompt(summary_prompt):
+    """ส่ง prompt สรุปไปยัง Grok และคืนข้อความสรุป"""
+    return grok_client.send_chat(
+        messages=_summary_messages(summary_prompt),
+        model=config.XAI_MODEL,
+        **SUMMARY_GENERATION_CONFIG,
+    )
+
+# ส่วนคงที่ของข้อความสำหรับงานสรุป เตรียมไว้ครั้งเดียวตอน import
+_SUMMARY_MSG_PREFIX = (SYSTEM_MESSAGES,)
+
+CHUNK_SUMMARY_HEADER = "นี่คือส่วนของประวัติการสนทนา โปรดสรุปประเด็นสำคัญในส่วนนี้โดยย่อ:\n"
+HISTORY_SUMMARY_HEADER = "นี่คือประวัติการสนทนา โปรดสรุปประเด็นสำคัญในประวัติการสนทนานี้:\n"
+TOPIC_SUMMARY_TEMPLATE = """
+นี่คือประวัติการสนทนาระหว่างผู้ใช้และบอทเกี่ยวกับการเลิกสารเสพติด:
+
+{conversation}
+
+โปรดวิเคราะห์และแบ่งแยกหัวข้อสำคัญต่างๆ ในการสนทนานี้ พร้อมทั้งสรุปแต่ละหัวข้อ ตามรูปแบบนี้:
+1. [ชื่อหัวข้อ 1]: [สรุปสั้นๆ]
+2. [ชื่อหัวข้อ 2]: [สรุปสั้นๆ]
+...
+
+แต่ละหัวข้อควรครอบคลุมประเด็นสำคัญที่พูดถึงโดยมีใจความชัดเจน กระชับ และเก็บรายละเอียดสำคัญไว้
+"""
+
+def _summary_messages(prompt):
+    """ประกอบข้อความสำหรับงานสรุปจากส่วนคงที่กับ prompt ของผู้ใช้"""
+    return [*_SUMMARY_MSG_PREFIX, {"role": "user", "content": prompt}]
+
+def _build_summary_prompt(header, history):
+    """สร้าง prompt สรุปด้วย join ครั้งเดียว แทนการต่อสตริงทีละคู่ข้อความ"""
+    parts = [header]
+    parts.extend(f"\nผู้ใช้: {msg}\nบอท: {resp}\n" for _, msg, resp in history)
+    return "".join(parts)
+
+def _build_chunk_summary_prompt(chunk):
+    """สร้าง prompt สำหรับสรุปส่วนของประวัติการสนทนา"""
+    return _build_summary_prompt(CHUNK_SUMMARY_HEADER, chunk)
+
+async def _summarize_prompts_async(prompts):
+    """ส่งคำขอสรุปทุก prompt พร้อมกัน ผลลัพธ์เรียงตามลำดับของ prompts"""
+    return await asyncio.gather(
+        *[
+            grok_client.astream_chat(
+                messages=_summary_messages(prompt),
+                model=config.XAI_MODEL,
+                **SUMMARY_GENERATION_CONFIG,
+            )
+            for prompt in prompts
+        ],
+        return_exceptions=True,
+    )
+
+def summarize_conversation_chunks(chunks):
+    """
+    สรุปหลายส่วนของประวัติการสนทนาแบบขนาน
+
+    Args:
+        chunks (iterable): ส่วนของประวัติการสนทนา (รับ generator ได้)
+
+    Returns:
+        list: ข้อความสรุปที่ไม่ว่าง เรียงตามลำดับของ chunks
+    """
+    return collect_chunk_summaries(start_chunk_summaries(chunks))
+
+def start_chunk_summaries(chunks):
+    """
+    เริ่มส่งคำขอสรุปทุกส่วนบน event loop กลางโดยไม่รอผล
+    ผู้เรียกทำงานฝั่ง CPU ต่อได้ระหว่างรอ I/O แล้วค่อยเรียก collect_chunk_summaries
+
+    Returns:
+        tuple: (prompts, future) สำหรับส่งต่อให้ collect_chunk_summaries
+    """
+    # เก็บไว้เฉพาะ prompt แต่ละส่วนถูกปล่อยทันทีหลังสร้าง prompt
+    prompts = [_build_chunk_summary_prompt(chunk) for chunk in chunks if chunk]
+    if not prompts:
+        return prompts, None
+    try:
+        # รันบน event loop กลางของ grok_client เพื่อใช้ connection pool ของ async client ซ้ำ
+        return prompts, grok_client.submit(_summarize_prompts_async(prompts))
+    except RuntimeError as e:
+        logging.warning(f"ไม่สามารถเริ่มสรุปแบบขนานได้: {str(e)}")
+        return prompts, None
+
+def collect_chunk_summaries(pending):
+    """รอผลจาก start_chunk_summaries และคืนข้อความสรุปที่ไม่ว่างตามลำดับ"""
+    prompts, future = pending
+    if not prompts:
+        return []
+
+    try:
+        if future is None:
+            raise RuntimeError("ไม่ได้เริ่มการสรุปแบบขนาน")
+        results = future.result(timeout=SUMMARY_TIMEOUT)
+    except FutureTimeoutError:
+        # xAI ตอบช้าเกินไป ยกเลิกงานบน event loop และข้ามการสรุป ไม่ให้ค้างเกินอายุล็อคผู้ใช้
+        future.cancel()
+        logging.warning(f"การสรุปประวัติแบบขนานเกิน {SUMMARY_TIMEOUT} วินาที ข้ามการสรุปรอบนี้")
+        return []
+    except RuntimeError as e:
+        # event loop กลางถูกปิดไปแล้ว (เช่นระหว่างปิดแอป) ถอยกลับไปสรุปทีละส่วน
+        logging.warning(f"ไม่สามารถสรุปแบบขนานได้ ใช้การสรุปทีละส่วนแทน: {str(e)}")
+        results = []
+        for prompt in prompts:
+            try:
+                results.append(_send_summary_prompt(prompt))
+            except Exception as prompt_error:
+                results.append(prompt_error)
+
+    summaries = []
+    for result in results:
+        if isinstance(result, Exception):
+            logging.error(f"เกิดข้อผิดพลาดในการสรุปส่วนของประวัติ: {str(result)}")
+        elif result:
+            summaries.append(result)
+    return summaries
+
 def process_and_optimize_history(user_id, max_tokens=85000):
     """
     ประมวลผลและปรับปรุงประวัติการสนทนาให้เหมาะสมที่สุด
@@ -646,6 +944,12 @@ def process_and_optimize_history(user_id, max_tokens=85000):
         db_history = db.get_user_history(user_id, max_tokens=max_tokens)
         session_history = get_chat_session(user_id)
 
+        # เริ่มสรุปข้อความจาก db_history ทันที (I/O) แล้วคัดข้อความสำคัญ (CPU) ระหว่างรอ
+        # แบ่งเป็นส่วนๆ เพื่อประสิทธิภาพในการสรุป
+        pending_summaries = start_chunk_summaries(
+            chunk_conversation_history(db_history, chunk_size=10)
+        )
+
         # 3. ระบุข้อความสำคัญ
         important_messages = []
 
@@ -663,15 +967,8 @@ def process_and_optimize_history(user_id, max_tokens=85000):
         recent_count = min(20, len(session_history) // 2)  # จำนวนการโต้ตอบล่าสุด (ไม่เกิน 20)
         recent_messages = session_history[-recent_count*2:]  # *2 เพราะแต่ละการโต้ตอบมี 2 ข้อความ
 
-        # 5. สรุปข้อความที่เหลือจาก db_history
-        # แบ่งเป็นส่วนๆ เพื่อประสิทธิภาพในการสรุป
-        chunks = chunk_conversation_history(db_history, chunk_size=10)
-        summaries = []
-
-        for chunk in chunks:
-            summary = summarize_conversation_chunk(chunk)
-            if summary:
-                summaries.append(summary)
+        # 5. รอผลสรุปข้อความที่เหลือจาก db_history
+        summaries = collect_chunk_summaries(pending_summaries)
 
         # 6. รวมประวัติทั้งหมด
         optimized_history = []
@@ -764,12 +1061,7 @@ def summarize_conversation_history(history):
         if len(history) > 20:
             # แบ่งเป็นชิ้นและสรุปแต่ละชิ้น
             chunks = chunk_conversation_history(history, chunk_size=10)
-            summaries = []
-
-            for chunk in chunks:
-                chunk_summary = summarize_conversation_chunk(chunk)
-                if chunk_summary:
-                    summaries.append(chunk_summary)
+            summaries = summarize_conversation_chunks(chunks)
 
             # รวมสรุปทั้งหมด
             if summaries:
@@ -777,20 +1069,9 @@ def summarize_conversation_history(history):
                 return combined_summary
 
         # หากมีขนาดเล็ก ใช้วิธีสรุปแบบปกติ
-        summary_prompt = "นี่คือประวัติการสนทนา โปรดสรุปประเด็นสำคัญในประวัติการสนทนานี้:\n"
-        for _, msg, resp in history:
-            summary_prompt += f"\nผู้ใช้: {msg}\nบอท: {resp}\n"
-
-        text = grok_client.send_chat(
-            messages=[
-                SYSTEM_MESSAGES,
-                {"role": "user", "content": summary_prompt}
-            ],
-            model=config.XAI_MODEL,
-            **SUMMARY_GENERATION_CONFIG,
-        )
+        summary_prompt = _build_summary_prompt(HISTORY_SUMMARY_HEADER, history)
 
-        return text
+        return _send_summary_prompt(summary_prompt)
     except Exception as e:
         logging.error(f"เกิดข้อผิดพลาดใน summarize_conversation_history: {str(e)}")
         return ""
@@ -811,34 +1092,17 @@ def summarize_by_topic(history):
         return ""
 
     try:
-        # สร้างข้อความเพื่อให้ AI แบ่งหัวข้อและสรุป
-        topic_prompt = """
-นี่คือประวัติการสนทนาระหว่างผู้ใช้และบอทเกี่ยวกับการเลิกสารเสพติด:
-
-{conversation}
-
-โปรดวิเคราะห์และแบ่งแยกหัวข้อสำคัญต่างๆ ในการสนทนานี้ พร้อมทั้งสรุปแต่ละหัวข้อ ตามรูปแบบนี้:
-1. [ชื่อหัวข้อ 1]: [สรุปสั้นๆ]
-2. [ชื่อหัวข้อ 2]: [สรุปสั้นๆ]
-...
-
-แต่ละหัวข้อควรครอบคลุมประเด็นสำคัญที่พูดถึงโดยมีใจความชัดเจน กระชับ และเก็บรายละเอียดสำคัญไว้
-"""
-
         # สร้างเนื้อหาการสนทนาสำหรับใส่ใน prompt
-        conversation_text = ""
-        for _, msg, resp in history:
-            conversation_text += f"ผู้ใช้: {msg}\nบอท: {resp}\n\n"
+        conversation_text = "".join(
+            f"ผู้ใช้: {msg}\nบอท: {resp}\n\n" for _, msg, resp in history
+        )
 
         # นำเนื้อหาการสนทนาใส่ใน prompt
-        topic_prompt = topic_prompt.format(conversation=conversation_text)
+        topic_prompt = TOPIC_SUMMARY_TEMPLATE.format(conversation=conversation_text)
 
         # ส่งไปให้ AI ประมวลผล
         text = grok_client.send_chat(
-            messages=[
-                SYSTEM_MESSAGES,
-                {"role": "user", "content": topic_prompt}
-            ],
+            messages=_summary_messages(topic_prompt),
             model=config.XAI_MODEL,
             temperature=0.2,
             max_tokens=800,
@@ -850,22 +1114,123 @@ def summarize_by_topic(history):
         return ""
 
 
+# อายุแคชสถานะการลงทะเบียนใน Redis (ผลบวก 1 วัน, ผลลบสั้นเพื่อให้เห็นการลงทะเบียนใหม่เร็ว)
+REGISTRATION_CACHE_TTL = 86400
+REGISTRATION_NEGATIVE_CACHE_TTL = 60
+
+# แคชผู้ใช้ที่ลงทะเบียนแล้วภายในโปรเซส ผู้ใช้ส่วนใหญ่จึงไม่ต้องถาม Redis ทุกข้อความ
+# เก็บเฉพาะผลบวก (การลงทะเบียนไม่ถูกยกเลิก) ผลลบยังอ่านจาก Redis เพื่อให้เห็นการลงทะเบียนจากโปรเซสอื่นทันที
+_registered_user_cache = TTLCache(maxsize=50000, ttl=300)
+
+# ผู้ใช้ที่ยังไม่ลงทะเบียนซึ่งโปรเซสนี้เพิ่งพบว่าได้รับข้อความลงทะเบียนไปแล้ว
+# ข้อความถัดไปจึงตอบได้ทันทีโดยไม่ต้องถาม Redis (Redis ยังเป็นข้อมูลหลักเมื่อแคชหมดอายุ)
+REGISTRATION_SENT_LOCAL_TTL = 600
+_registration_sent_cache = TTLCache(maxsize=10000, ttl=REGISTRATION_SENT_LOCAL_TTL)
+
 def is_user_registered(user_id):
-    """ตรวจสอบว่าผู้ใช้ลงทะเบียนแล้วหรือไม่"""
+    """ตรวจสอบว่าผู้ใช้ลงทะเบียนแล้วหรือไม่ (อ่านจากแคชในโปรเซส แล้วแคช Redis ก่อนถามฐานข้อมูล)"""
+    if _registered_user_cache.get(user_id):
+        return True
+
+    cache_key = f"registered:{user_id}"
+    try:
+        cached = redis_client.get(cache_key)
+        if cached == '1':
+            _registered_user_cache.set(user_id, True)
+            return True
+        if cached == '0':
+            return False
+    except Exception as e:
+        logging.warning(f"ไม่สามารถอ่านแคชสถานะการลงทะเบียน: {str(e)}")
+
+    return _load_registration_status(user_id)
+
+def _load_registration_status(user_id):
+    """ถามสถานะการลงทะเบียนจากฐานข้อมูล แล้วเก็บผลลงแคช Redis"""
+    cache_key = f"registered:{user_id}"
     try:
         query = 'SELECT EXISTS(SELECT 1 FROM registration_codes WHERE user_id = %s AND status = %s)'
         result = db_manager.execute_query(query, (user_id, 'verified'))
-        return bool(result[0][0]) if result else False
+        registered = bool(result[0][0]) if result else False
     except Exception as e:
         logging.error(f"Error checking user registration: {str(e)}")
         return False
 
+    if registered:
+        _registered_user_cache.set(user_id, True)
+
+    try:
+        redis_client.setex(
+            cache_key,
+            REGISTRATION_CACHE_TTL if registered else REGISTRATION_NEGATIVE_CACHE_TTL,
+            '1' if registered else '0',
+        )
+    except Exception as e:
+        logging.warning(f"ไม่สามารถบันทึกแคชสถานะการลงทะเบียน: {str(e)}")
+    return registered
+
+# รหัสยืนยันเป็นตัวเลข 6 หลัก และความยาวสูงสุดของส่วนท้ายคำสั่งที่ยอมรับก่อนตัดช่องว่าง
+VERIFY_CODE_LENGTH = 6
+MAX_VERIFY_CODE_LENGTH = 16
+# ระยะห่างขั้นต่ำระหว่างการลองยืนยันรหัสแต่ละครั้งของผู้ใช้เดียวกัน ป้องกันการเดารหัส (วินาที)
+VERIFY_ATTEMPT_INTERVAL = 2
+
+def parse_verify_code(message):
+    """แยกรหัสยืนยันจากข้อความ "/verify <รหัส>" คืนค่า None หากรูปแบบไม่ถูกต้อง"""
+    # "/verify" ที่ไม่มีช่องว่างตามหลังไม่มีรหัสแน่นอน จึงไม่ต้องแยกคำ
+    if not message[7:8].isspace():
+        return None
+    # split(None, 1) แยกแค่คำแรก ไม่สร้างลิสต์ตามจำนวนคำของข้อความที่ยาวผิดปกติ
+    parts = message.split(None, 1)
+    if len(parts) != 2 or len(parts[1]) > MAX_VERIFY_CODE_LENGTH:
+        return None
+    code = parts[1].strip()
+    if len(code) != VERIFY_CODE_LENGTH or not code.isdigit():
+        return None
+    return code
+
+def check_registration_and_verify_lock(user_id):
+    """อ่านแคชสถานะการลงทะเบียนและจองสิทธิ์ลองยืนยันรหัสใน pipeline เดียว
+
+    Returns:
+        (registered, allowed): allowed เป็น False หากผู้ใช้เพิ่งลองยืนยันภายใน VERIFY_ATTEMPT_INTERVAL วินาที
+    """
+    if _registered_user_cache.get(user_id):
+        return True, False
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(f"registered:{user_id}")
+        pipe.set(f"verify_lock:{user_id}", '1', nx=True, ex=VERIFY_ATTEMPT_INTERVAL)
+        cached, allowed = pipe.execute()
+    except Exception as e:
+        logging.warning(f"ไม่สามารถตรวจสอบการลงทะเบียนและจองการยืนยันใน pipeline: {str(e)}")
+        return is_user_registered(user_id), True
+
+    if cached == '1':
+        _registered_user_cache.set(user_id, True)
+        registered = True
+    elif cached == '0':
+        registered = False
+    else:
+        # แคชหมดอายุ: ถามฐานข้อมูล
+        registered = _load_registration_status(user_id)
+    return registered, bool(allowed)
+
 def register_user_with_code(user_id, code):
     """ยืนยันการลงทะเบียนด้วยรหัสยืนยันและโหลดบริบทผู้ใช้"""
     try:
-        # ตรวจสอบว่ารหัสมีอยู่และยังไม่หมดอายุ
-        query = 'SELECT code, form_data FROM registration_codes WHERE code = %s AND status = %s'
-        result = db_manager.execute_query(query, (code, 'pending'), dictionary=True)
+        # อัพเดทรหัสที่ยังรอยืนยันให้เชื่อมกับผู้ใช้ในคำสั่งเดียว ป้องกันการใช้รหัสซ้ำพร้อมกัน
+        update_query = (
+            'UPDATE registration_codes SET user_id = %s, status = %s, verified_at = %s '
+            'WHERE code = %s AND status = %s'
+        )
+        result = None
+        with db_manager.get_cursor(dictionary=True) as cursor:
+            cursor.execute(update_query, (user_id, 'verified', datetime.now(), code, 'pending'))
+            if cursor.rowcount:
+                cursor.execute('SELECT form_data FROM registration_codes WHERE code = %s', (code,))
+                result = cursor.fetchall()
         
         if not result:
             return False, "รหัสยืนยันไม่ถูกต้องหรือหมดอายุแล้ว"
@@ -873,10 +1238,11 @@ def register_user_with_code(user_id, code):
         # ดึงข้อมูล form และสรุป
         form_data_json = result[0].get('form_data', '{}')
         form_data = json.loads(form_data_json) if form_data_json else {}
-        
-        # อัพเดทรหัสให้เชื่อมกับผู้ใช้และสถานะเป็น verified
-        update_query = 'UPDATE registration_codes SET user_id = %s, status = %s, verified_at = %s WHERE code = %s'
-        db_manager.execute_and_commit(update_query, (user_id, 'verified', datetime.now(), code))
+        _registered_user_cache.set(user_id, True)
+        try:
+            redis_client.setex(f"registered:{user_id}", REGISTRATION_CACHE_TTL, '1')
+        except Exception as cache_error:
+            logging.warning(f"ไม่สามารถบันทึกแคชสถานะการลงทะเบียน: {str(cache_error)}")
         
         # บันทึกบริบทเริ่มต้นของผู้ใช้
         if form_data and 'ai_summary' in form_data:
@@ -899,7 +1265,7 @@ def save_user_initial_context(user_id, ai_summary):
         redis_client.set(context_key, ai_summary)
         
         # บันทึกเวลาที่สร้างบริบท
-        redis_client.set(f"context_created:{user_id}", datetime.now().timestamp())
+        redis_client.set(f"context_created:{user_id}", time.time())
         
         logging.info(f"บันทึกบริบทเริ่มต้นสำหรับผู้ใช้: {user_id}")
         
@@ -914,8 +1280,6 @@ def get_user_context(user_id):
         context = redis_client.get(context_key)
         
         if context:
-            if isinstance(context, bytes):
-                context = context.decode('utf-8')
             return context
             
         # ถ้าไม่มีบริบทใน Redis ลองดึงจากฐานข้อมูล
@@ -972,39 +1336,202 @@ def create_personalized_welcome_message(form_data):
     
     return personalized_message
 
+# ข้อความแนะนำการลงทะเบียน (ใช้ทั้งตอนเพิ่มเพื่อนและเมื่อผู้ใช้ที่ยังไม่ลงทะเบียนส่งข้อความ)
+_REGISTRATION_MESSAGE_TEXT = (
+    "สวัสดีค่ะ! ยินดีต้อนรับสู่แชทบอท 'ใจดี'\n\n"
+    "เพื่อเริ่มใช้งาน คุณจำเป็นต้องลงทะเบียนก่อน โดยทำตามขั้นตอนดังนี้:\n\n"
+    "1. กรอกแบบฟอร์มที่ลิงก์นี้: https://forms.gle/gVE6WN7W5thHR1kZ9\n"
+    "2. หลังกรอกเสร็จ คุณจะได้รับรหัสยืนยัน 6 หลัก\n"
+    "3. นำรหัสมาพิมพ์ที่นี่ด้วยคำสั่ง \"/verify รหัส\" เช่น \"/verify 123456\"\n\n"
+    "หากมีข้อสงสัย พิมพ์ /help เพื่อดูคำแนะนำ\n\n"
+    "📧 ติดต่อสอบถาม:\n"
+    "• ปัญหาทางเทคนิค: pahnkcn@gmail.com\n"
+    "• คำถามเกี่ยวกับการวิจัย: Std6548097@pcm.ac.th"
+)
+
+# ข้อความตอบกลับคงที่ สร้างครั้งเดียวตอนโหลดโมดูลแล้วใช้ซ้ำทุกคำขอ
+_MSG_REGISTRATION = TextSendMessage(text=_REGISTRATION_MESSAGE_TEXT)
+_MSG_WELCOME = TextSendMessage(text=(
+    "ขอบคุณที่เพิ่มน้องใจดีเป็นเพื่อน! 👋\n\n"
+    "น้องใจดีพร้อมเป็นเพื่อนคุยและช่วยเหลือคุณในเรื่องการเลิกสารเสพติด\n\n"
+    "👉 ก่อนเริ่มต้นใช้งาน กรุณาลงทะเบียนตามขั้นตอนง่ายๆ"
+))
+_MSG_VERIFY_FORMAT = TextSendMessage(
+    text="รูปแบบไม่ถูกต้อง กรุณาพิมพ์ \"/verify\" ตามด้วยรหัส 6 หลัก เช่น \"/verify 123456\""
+)
+_MSG_ALREADY_REGISTERED = TextSendMessage(
+    text="✅ คุณได้ลงทะเบียนและยืนยันตัวตนเรียบร้อยแล้ว\n"
+         "ไม่จำเป็นต้องยืนยันอีกครั้ง คุณสามารถใช้บริการของน้องใจดีได้ตามปกติ"
+)
+_MSG_VERIFY_WAIT = TextSendMessage(text="กรุณารอสักครู่ก่อนลองยืนยันรหัสอีกครั้งค่ะ")
+_MSG_NOT_REGISTERED_HINT = TextSendMessage(
+    text="คุณยังไม่ได้ลงทะเบียน กรุณาลงทะเบียนก่อนใช้งาน พิมพ์ /register เพื่อดูวิธีลงทะเบียน"
+)
+_MSG_WAIT_PREVIOUS = TextSendMessage(text="กรุณารอระบบประมวลผลข้อความก่อนหน้าให้เสร็จสิ้นก่อนค่ะ")
+_MSG_TOO_LONG = TextSendMessage(
+    text=f"ข้อความยาวเกินไปค่ะ กรุณาส่งข้อความไม่เกิน {MAX_USER_MESSAGE_LENGTH} ตัวอักษร หรือแบ่งส่งเป็นหลายข้อความนะคะ"
+)
+_MSG_RESEND_AFTER_RESTART = TextSendMessage(
+    text="ขออภัยค่ะ ระบบกำลังรีสตาร์ทและยังไม่ได้ประมวลผลข้อความล่าสุดของคุณ กรุณาส่งข้อความอีกครั้งในอีกสักครู่นะคะ"
+)
+
 def send_registration_message(user_id):
     """ส่งข้อความแนะนำการลงทะเบียน"""
-    register_message = (
-        "สวัสดีค่ะ! ยินดีต้อนรับสู่แชทบอท 'ใจดี'\n\n"
-        "เพื่อเริ่มใช้งาน คุณจำเป็นต้องลงทะเบียนก่อน โดยทำตามขั้นตอนดังนี้:\n\n"
-        "1. กรอกแบบฟอร์มที่ลิงก์นี้: https://forms.gle/gVE6WN7W5thHR1kZ9\n"
-        "2. หลังกรอกเสร็จ คุณจะได้รับรหัสยืนยัน 6 หลัก\n"
-        "3. นำรหัสมาพิมพ์ที่นี่ด้วยคำสั่ง \"/verify รหัส\" เช่น \"/verify 123456\"\n\n"
-        "หากมีข้อสงสัย พิมพ์ /help เพื่อดูคำแนะนำ\n\n"
-        "📧 ติดต่อสอบถาม:\n"
-        "• ปัญหาทางเทคนิค: pahnkcn@gmail.com\n"
-        "• คำถามเกี่ยวกับการวิจัย: Std6548097@pcm.ac.th"
-    )
-
-    line_bot_api.push_message(
-        user_id,
-        TextSendMessage(text=register_message)
-    )
+    line_bot_api.push_message(user_id, _MSG_REGISTRATION)
 
 # ฟังก์ชันที่เกี่ยวข้องกับการล็อคข้อความ
-def is_user_locked(user_id):
-    """ตรวจสอบว่าผู้ใช้ถูกล็อคอยู่หรือไม่"""
-    return redis_client.exists(f"message_lock:{user_id}")
+# ล็อคด้วย SET NX PX ซึ่งตรวจสอบและตั้งค่าในคำสั่งเดียว จึงไม่มีขั้นตอน "ตรวจสอบว่าถูกล็อค" แยกต่างหาก
+
+# ปลดล็อคเฉพาะเมื่อ token ตรงกับผู้ถือล็อค (เรียกผ่าน EVALSHA, โหลดสคริปต์อัตโนมัติเมื่อจำเป็น)
+UNLOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_unlock_script = redis_client.register_script(UNLOCK_LUA)
 
 def lock_user(user_id):
-    """ล็อคผู้ใช้"""
-    redis_client.setex(f"message_lock:{user_id}", MESSAGE_LOCK_TIMEOUT, "1")
+    """ล็อคผู้ใช้ด้วย SET NX PX ในคำสั่งเดียว
+
+    Returns:
+        token ของล็อคเมื่อสำเร็จ หรือ None หากผู้ใช้ถูกล็อคอยู่แล้ว
+    """
+    token = secrets.token_hex(8)
+    if redis_client.set(f"message_lock:{user_id}", token, nx=True, px=MESSAGE_LOCK_TIMEOUT * 1000):
+        return token
+    return None
+
+def check_registration_and_lock(user_id, event_id=None):
+    """อ่านแคชสถานะการลงทะเบียน ล็อคผู้ใช้ และกันเหตุการณ์ซ้ำใน pipeline เดียว (Redis หนึ่งรอบสำหรับผู้ใช้ส่วนใหญ่)
+
+    ล็อคถูกขอไว้ล่วงหน้า หากผู้ใช้ยังไม่ได้ลงทะเบียนหรือเหตุการณ์นี้เคยรับแล้ว (LINE ส่ง webhook ซ้ำ)
+    จะปลดล็อคคืนทันที
+
+    Returns:
+        (registered, lock_token, duplicate): lock_token เป็น None หากผู้ใช้ถูกล็อคอยู่แล้ว ยังไม่ได้ลงทะเบียน
+        หรือเป็นเหตุการณ์ซ้ำ
+    """
+    cached_registered = _registered_user_cache.get(user_id)
+    if cached_registered and not event_id:
+        return True, lock_user(user_id), False
+
+    token = secrets.token_hex(8)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        if event_id:
+            pipe.set(f"webhook_event:{event_id}", '1', nx=True, ex=WEBHOOK_EVENT_DEDUP_TTL)
+        if not cached_registered:
+            pipe.get(f"registered:{user_id}")
+        pipe.set(f"message_lock:{user_id}", token, nx=True, px=MESSAGE_LOCK_TIMEOUT * 1000)
+        results = pipe.execute()
+    except Exception as e:
+        logging.warning(f"ไม่สามารถตรวจสอบการลงทะเบียนและล็อคใน pipeline: {str(e)}")
+        if not is_user_registered(user_id):
+            return False, None, False
+        return True, lock_user(user_id), False
+
+    first_delivery = results.pop(0) if event_id else True
+    locked = results.pop()
+    lock_token = token if locked else None
+    if not first_delivery:
+        if lock_token:
+            unlock_user(user_id, lock_token)
+        return bool(cached_registered), None, True
+
+    if cached_registered:
+        return True, lock_token, False
+
+    cached = results[0]
+    if cached == '1':
+        registered = True
+        _registered_user_cache.set(user_id, True)
+    elif cached == '0':
+        registered = False
+    else:
+        # แคชหมดอายุ: ถามฐานข้อมูล
+        registered = _load_registration_status(user_id)
+
+    if not registered and lock_token:
+        unlock_user(user_id, lock_token)
+        lock_token = None
+    return registered, lock_token, False
 
-def unlock_user(user_id):
-    """ปลดล็อคผู้ใช้"""
-    redis_client.delete(f"message_lock:{user_id}")
+def unlock_user(user_id, token):
+    """ปลดล็อคผู้ใช้ หากล็อคยังเป็นของ token นี้ (ไม่ลบล็อคที่หมดอายุแล้วถูกผู้อื่นถือ)"""
+    try:
+        _unlock_script(keys=[f"message_lock:{user_id}"], args=[token])
+    except Exception as e:
+        logging.error(f"เกิดข้อผิดพลาดในการปลดล็อคผู้ใช้ {user_id}: {str(e)}")
 
 # ฟังก์ชันเกี่ยวกับการติดตามผู้ใช้
+# ค่าจองชั่วคราวใน first_interaction:<user_id> ระหว่างที่เวิร์กเกอร์หนึ่งถามฐานข้อมูล
+# ไม่ใช่เวลา เวิร์กเกอร์อื่นจึงไม่นำไปใช้เป็นวันที่เริ่มต้น และหมดอายุเองหากผู้จองหยุดทำงาน
+FIRST_INTERACTION_PENDING = 'pending'
+FIRST_INTERACTION_CLAIM_MS = 5000
+FIRST_INTERACTION_WAIT_ATTEMPTS = 10  # จำนวนครั้งที่รออ่านค่าจริงจากผู้จอง (ครั้งละ 0.1 วินาที)
+
+def _parse_first_interaction(value):
+    """แปลงค่าเวลาเริ่มต้นจาก Redis เป็น datetime (คืน None ถ้าไม่มี ยังจองอยู่ หรือไม่ถูกต้อง)"""
+    if not value or value == FIRST_INTERACTION_PENDING:
+        return None
+    try:
+        return datetime.fromtimestamp(float(value))
+    except (ValueError, TypeError) as e:
+        logging.warning(f"ข้อมูลเวลาเริ่มต้นใน Redis ไม่ถูกต้อง: {str(e)}")
+        return None
+
+def _get_first_interaction_date(user_id):
+    """
+    หาวันที่ปฏิสัมพันธ์แรกของผู้ใช้ โดยให้มีเพียงเวิร์กเกอร์เดียวที่ถามฐานข้อมูล
+
+    เวิร์กเกอร์ที่จองด้วย SET NX PX ได้สำเร็จเป็นผู้ดึง MIN(timestamp) จากฐานข้อมูลแล้วเขียนค่าจริง
+    เวิร์กเกอร์อื่นรอค่าจริงสักครู่ หากยังไม่ได้จะคืน None (ผู้เรียกควรข้ามการกำหนดการ)
+    """
+    key = f"first_interaction:{user_id}"
+    value = redis_client.get(key)
+    interaction_date = _parse_first_interaction(value)
+    if interaction_date is not None:
+        return interaction_date
+
+    claimed = value is None and redis_client.set(
+        key, FIRST_INTERACTION_PENDING, nx=True, px=FIRST_INTERACTION_CLAIM_MS
+    )
+    if not claimed:
+        value = redis_client.get(key)
+        if value == FIRST_INTERACTION_PENDING:
+            # มีเวิร์กเกอร์อื่นกำลังถามฐานข้อมูล รอค่าจริงแทนการใช้ค่าจอง
+            for _ in range(FIRST_INTERACTION_WAIT_ATTEMPTS):
+                time.sleep(0.1)
+                value = redis_client.get(key)
+                if value != FIRST_INTERACTION_PENDING:
+                    break
+            else:
+                return None
+        existing = _parse_first_interaction(value)
+        if existing is not None:
+            return existing
+        # ค่าเดิมอ่านไม่ได้ (หรือค่าจองหมดอายุ) ถือว่าไม่มี จองใหม่แล้วถามฐานข้อมูลเอง
+        redis_client.set(key, FIRST_INTERACTION_PENDING, px=FIRST_INTERACTION_CLAIM_MS)
+
+    now = datetime.now()
+    try:
+        # ใช้ DatabaseManager เพื่อดึงข้อมูล
+        query = 'SELECT MIN(timestamp) FROM conversations WHERE user_id = %s'
+        result = db_manager.execute_query(query, (user_id,))
+        first_timestamp = result[0][0] if result and result[0] else None
+    except Exception as db_error:
+        logging.error(f"เกิดข้อผิดพลาดในการดึงข้อมูลจากฐานข้อมูล: {str(db_error)}")
+        # ไม่บันทึกค่าที่ไม่แน่นอน ปล่อยคืนสิทธิ์ให้ครั้งถัดไปถามใหม่
+        redis_client.delete(key)
+        return now
+
+    # ไม่มีข้อมูลในฐานข้อมูล เวลาปัจจุบันคือเวลาเริ่มต้น
+    # เก็บเวลาเริ่มต้นจริงลง Redis แทนค่าจอง เพื่อใช้อ้างอิงในอนาคต (ไม่มีเวลาหมดอายุ)
+    first_timestamp = first_timestamp or now
+    redis_client.set(key, first_timestamp.timestamp())
+    return first_timestamp
+
 def schedule_follow_up(user_id, interaction_date=None):
     """
     จัดการการติดตามผู้ใช้ โดยอ้างอิงจากข้อความแรกสุด
@@ -1015,91 +1542,54 @@ def schedule_follow_up(user_id, interaction_date=None):
         interaction_date (datetime, optional): วันที่ปฏิสัมพันธ์ (ถ้าไม่ระบุจะหาจากฐานข้อมูล)
     """
     try:
+        # ใช้เวลาปัจจุบันค่าเดียวตลอดทั้งฟังก์ชัน
+        now = datetime.now()
+
         # หาวันที่ของข้อความแรกสุด (ถ้าไม่ได้ระบุมา)
         if interaction_date is None:
-            # ตรวจสอบว่ามีการเก็บเวลาเริ่มต้นไว้ใน Redis หรือไม่
-            first_interaction_time = redis_client.get(f"first_interaction:{user_id}")
-
-            if first_interaction_time:
-                try:
-                    # แปลงจาก string หรือ bytes เป็น float และจาก float เป็น datetime
-                    if isinstance(first_interaction_time, bytes):
-                        first_interaction_time = first_interaction_time.decode('utf-8')
-                    interaction_date = datetime.fromtimestamp(float(first_interaction_time))
-                except (ValueError, TypeError) as e:
-                    logging.warning(f"ข้อมูลเวลาเริ่มต้นใน Redis ไม่ถูกต้อง: {str(e)}")
-                    interaction_date = None
-
-            # ถ้ายังไม่มีเวลาเริ่มต้นที่ถูกต้อง ให้ดึงจากฐานข้อมูล
+            interaction_date = _get_first_interaction_date(user_id)
             if interaction_date is None:
-                try:
-                    # ใช้ DatabaseManager เพื่อดึงข้อมูล
-                    query = 'SELECT MIN(timestamp) FROM conversations WHERE user_id = %s'
-                    result = db_manager.execute_query(query, (user_id,))
-                    first_timestamp = result[0][0] if result and result[0] else None
-
-                    if first_timestamp:
-                        interaction_date = first_timestamp
-                        # เก็บเวลาเริ่มต้นลง Redis เพื่อใช้อ้างอิงในอนาคต (ไม่มีเวลาหมดอายุ)
-                        redis_client.set(
-                            f"first_interaction:{user_id}",
-                            interaction_date.timestamp()
-                        )
-                    else:
-                        # ถ้าไม่มีข้อมูลในฐานข้อมูล ใช้เวลาปัจจุบัน
-                        interaction_date = datetime.now()
-                        # เก็บเวลาเริ่มต้นลง Redis
-                        redis_client.set(
-                            f"first_interaction:{user_id}",
-                            interaction_date.timestamp()
-                        )
-                except Exception as db_error:
-                    logging.error(f"เกิดข้อผิดพลาดในการดึงข้อมูลจากฐานข้อมูล: {str(db_error)}")
-                    interaction_date = datetime.now()
+                # เวิร์กเกอร์อื่นกำลังหาวันที่เริ่มต้นและจะกำหนดการติดตามเอง
+                logging.debug(f"ข้ามการกำหนดการติดตามของผู้ใช้ {user_id} ระหว่างรอวันที่เริ่มต้น")
+                return
 
         # ตรวจสอบว่า interaction_date เป็นประเภท datetime
         if not isinstance(interaction_date, datetime):
             logging.warning(f"ค่า interaction_date ไม่ใช่ประเภท datetime ใช้เวลาปัจจุบันแทน")
-            interaction_date = datetime.now()
+            interaction_date = now
 
-        # บันทึกข้อมูลวันที่เริ่มต้นลงใน Redis (ถ้ายังไม่มี)
-        redis_client.setnx(f"first_interaction:{user_id}", interaction_date.timestamp())
+        # บันทึกวันที่เริ่มต้น (ถ้ายังไม่มี) และอ่านกำหนดการเดิมกับการติดตามล่าสุดในรอบเดียว
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.setnx(f"first_interaction:{user_id}", interaction_date.timestamp())
+        pipe.zscore('follow_up_queue', user_id)
+        pipe.get(f"last_follow_up:{user_id}")
+        _, existing_ts, last_follow_up = pipe.execute()
 
         # ถ้ามีการกำหนดการติดตามไว้แล้วและยังไม่ถึงกำหนด ให้ใช้อันเดิม
-        existing_ts = redis_client.zscore('follow_up_queue', user_id)
         if existing_ts:
             try:
                 existing_dt = datetime.fromtimestamp(float(existing_ts))
-                if existing_dt > datetime.now():
-                    logging.info(
-                        f"มีการกำหนดการติดตามไว้แล้วสำหรับผู้ใช้ {user_id} ในวันที่ {existing_dt.strftime('%Y-%m-%d')}"
+                if existing_dt > now:
+                    logging.debug(
+                        "มีการกำหนดการติดตามไว้แล้วสำหรับผู้ใช้ %s ในวันที่ %s", user_id, existing_dt.date()
                     )
                     return
             except (ValueError, TypeError) as e:
                 logging.warning(f"ข้อมูลกำหนดการติดตามไม่ถูกต้อง: {str(e)}")
 
-        # ดึงข้อมูลการติดตามล่าสุด (ถ้ามี)
-        last_follow_up = redis_client.get(f"last_follow_up:{user_id}")
+        # หาดัชนีการติดตามถัดไปจากการติดตามล่าสุด (ถ้ามี)
         next_follow_idx = 0
 
         if last_follow_up:
-            # แปลงจาก bytes เป็น string ถ้าจำเป็น
-            if isinstance(last_follow_up, bytes):
-                last_follow_up = last_follow_up.decode('utf-8')
-
-            # หาดัชนีถัดไปใน FOLLOW_UP_INTERVALS
+            # หาดัชนีถัดไปใน FOLLOW_UP_INTERVALS (ค่าที่ไม่รู้จักเริ่มจาก 0, เกินขอบเขตใช้วันสุดท้าย)
             try:
-                last_idx = FOLLOW_UP_INTERVALS.index(int(last_follow_up))
-                next_follow_idx = last_idx + 1
-                # ถ้าเกินขอบเขต ให้ใช้วันสุดท้าย
-                if next_follow_idx >= len(FOLLOW_UP_INTERVALS):
-                    next_follow_idx = len(FOLLOW_UP_INTERVALS) - 1
-            except (ValueError, IndexError):
-                # ถ้าไม่พบค่าใน FOLLOW_UP_INTERVALS หรือเกิดข้อผิดพลาด ให้เริ่มจาก 0
-                next_follow_idx = 0
+                last_idx = _FOLLOW_UP_IDX.get(int(last_follow_up), -1)
+            except (ValueError, TypeError):
+                last_idx = -1
+            next_follow_idx = min(last_idx + 1, len(FOLLOW_UP_INTERVALS) - 1)
 
         # กำหนดการติดตามตามช่วงเวลาที่กำหนด
-        current_date = datetime.now()
+        current_date = now
         scheduled = False
 
         # ลูปเริ่มจากดัชนีที่คำนวณได้ (ไม่ใช่ตั้งแต่ดัชนี 0 เสมอ)
@@ -1109,19 +1599,24 @@ def schedule_follow_up(user_id, interaction_date=None):
 
             # กำหนดการติดตามสำหรับวันที่ในอนาคตเท่านั้น
             if follow_up_date > current_date:
-                redis_client.zadd(
+                pipe = redis_client.pipeline(transaction=False)
+                # GT: เพิ่มสมาชิกใหม่ได้ แต่จะเลื่อนกำหนดการเดิมไปข้างหน้าเท่านั้น
+                # เวิร์กเกอร์ที่ทำงานพร้อมกันจึงไม่ดึงกำหนดการกลับไปวันที่เร็วกว่า
+                pipe.zadd(
                     'follow_up_queue',
-                    {user_id: follow_up_date.timestamp()}
+                    {user_id: follow_up_date.timestamp()},
+                    gt=True,
                 )
                 # บันทึกว่าการติดตามล่าสุดคือวันที่เท่าไร
-                redis_client.set(f"last_follow_up:{user_id}", str(days))
+                pipe.set(f"last_follow_up:{user_id}", str(days))
+                pipe.execute()
 
-                logging.info(f"กำหนดการติดตามผู้ใช้ {user_id} ในวันที่ {follow_up_date.strftime('%Y-%m-%d')} (+{days} วัน จากวันแรก)")
+                logging.debug("กำหนดการติดตามผู้ใช้ %s ในวันที่ %s (+%d วัน จากวันแรก)", user_id, follow_up_date.date(), days)
                 scheduled = True
                 break
 
         if not scheduled:
-            logging.info(f"ไม่ได้กำหนดการติดตามสำหรับผู้ใช้ {user_id} เนื่องจากไม่มีวันที่ในอนาคตที่เข้าเกณฑ์")
+            logging.debug("ไม่ได้กำหนดการติดตามสำหรับผู้ใช้ %s เนื่องจากไม่มีวันที่ในอนาคตที่เข้าเกณฑ์", user_id)
 
     except Exception as e:
         logging.error(f"เกิดข้อผิดพลาดในการกำหนดการติดตามผล: {str(e)}")
@@ -1164,49 +1659,143 @@ def get_follow_up_status(user_id):
         return "ไม่สามารถดึงข้อมูลการติดตามได้ในขณะนี้"
 
 
+# ดึงรายการติดตามที่ถึงกำหนดออกจากคิวและย้ายไปไว้ใน follow_up_inflight พร้อมเวลาหมดสัญญาเช่า
+# ในคำสั่งเดียว (atomic) จำกัดจำนวนต่อรอบด้วย LIMIT หากโปรเซสหยุดกลางชุด รายการจะไม่หายไป
+POP_DUE_FOLLOW_UPS_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due > 0 then
+    local leased = {}
+    for i, user_id in ipairs(due) do
+        leased[2 * i - 1] = ARGV[3]
+        leased[2 * i] = user_id
+    end
+    redis.call('ZADD', KEYS[2], unpack(leased))
+    redis.call('ZREM', KEYS[1], unpack(due))
+end
+return due
+"""
+_pop_due_follow_ups_script = redis_client.register_script(POP_DUE_FOLLOW_UPS_LUA)
+
+# คืนรายการที่สัญญาเช่าหมดอายุ (ผู้ส่งหยุดทำงานก่อนบันทึกผล) กลับเข้าคิวให้ส่งในรอบนี้
+# NX: ไม่ทับกำหนดการใหม่ที่อาจถูกเพิ่มเข้ามาระหว่างนี้
+REQUEUE_EXPIRED_FOLLOW_UPS_LUA = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, user_id in ipairs(expired) do
+    redis.call('ZADD', KEYS[1], 'NX', ARGV[1], user_id)
+end
+if #expired > 0 then
+    redis.call('ZREM', KEYS[2], unpack(expired))
+end
+return #expired
+"""
+_requeue_expired_follow_ups_script = redis_client.register_script(REQUEUE_EXPIRED_FOLLOW_UPS_LUA)
+
 def check_and_send_follow_ups():
     """ตรวจสอบและส่งการติดตามที่ถึงกำหนด พร้อมกำหนดการติดตามครั้งถัดไป"""
     logging.info("กำลังรันการตรวจสอบการติดตามผลตามกำหนดเวลา")
     try:
-        current_time = datetime.now().timestamp()
-        # ดึงรายการติดตามที่ถึงกำหนด
-        due_follow_ups = redis_client.zrangebyscore(
+        # ใช้เวลาตัดรอบค่าเดียวตลอดการรัน รายการที่คืนเข้าคิวหรือกำหนดใหม่ระหว่างนี้จึงไม่ถูกดึงซ้ำในรอบเดียวกัน
+        current_time = time.time()
+
+        requeued = _requeue_expired_follow_ups_script(
+            keys=['follow_up_queue', 'follow_up_inflight'],
+            args=[current_time]
+        )
+        if requeued:
+            logging.warning(f"คืนรายการติดตามที่ค้างจากรอบก่อนเข้าคิว {requeued} รายการ")
+
+        with ThreadPoolExecutor(
+            max_workers=FOLLOW_UP_WORKERS,
+            thread_name_prefix="follow-up",
+        ) as executor:
+            while True:
+                # ดึงและลบรายการที่ถึงกำหนดทีละไม่เกิน FOLLOW_UP_BATCH_SIZE รายการ (atomic)
+                # ทุกคำสั่งมีขนาดคงที่ แม้จะมีผู้ใช้ถึงกำหนดพร้อมกันจำนวนมากก็ไม่บล็อก Redis นาน
+                due_users = _pop_due_follow_ups_script(
+                    keys=['follow_up_queue', 'follow_up_inflight'],
+                    args=[current_time, FOLLOW_UP_BATCH_SIZE, time.time() + FOLLOW_UP_LEASE_SECONDS]
+                )
+                if due_users:
+                    _send_follow_up_batch(executor, due_users)
+                if len(due_users) < FOLLOW_UP_BATCH_SIZE:
+                    break
+                # พักสั้น ๆ ก่อนชุดถัดไป ให้เธรดที่ตอบ webhook ได้ใช้ GIL และ Redis ระหว่างรอบที่มีงานค้างมาก
+                # (หยุดทันทีหากแอปกำลังปิด)
+                if _CLEANED.wait(FOLLOW_UP_BATCH_PAUSE):
+                    break
+
+    except Exception as e:
+        logging.error(f"เกิดข้อผิดพลาดใน check_and_send_follow_ups: {str(e)}")
+
+def _send_follow_up_batch(executor, due_users):
+    """ส่งข้อความติดตามให้ผู้ใช้หนึ่งชุด คืนรายการที่ล้มเหลวเข้าคิว และกำหนดการครั้งถัดไปให้รายการที่สำเร็จ"""
+    # 1. สร้างและส่งข้อความติดตามพร้อมกัน แล้วเก็บรายชื่อผู้ใช้ที่ส่งสำเร็จ
+    sent_users = [
+        user_id for user_id in executor.map(_send_follow_up, due_users) if user_id
+    ]
+
+    # 2. คืนรายการที่ส่งไม่สำเร็จกลับเข้าคิวเพื่อลองใหม่ในรอบถัดไป
+    # (NX: ไม่ทับกำหนดการใหม่ที่อาจถูกเพิ่มเข้ามาระหว่างนี้)
+    failed_users = set(due_users).difference(sent_users)
+    if failed_users:
+        retry_at = time.time()
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zadd(
             'follow_up_queue',
-            0,
-            current_time
+            {user_id: retry_at for user_id in failed_users},
+            nx=True
         )
+        pipe.zrem('follow_up_inflight', *failed_users)
+        pipe.execute()
 
-        for user_id in due_follow_ups:
-            # แปลง bytes เป็ string ถ้าจำเป็น
-            if isinstance(user_id, bytes):
-                user_id = user_id.decode('utf-8')
+    if not sent_users:
+        return
 
-            # สร้างข้อความติดตามที่เป็นไปตามบริบทของการสนทนา
-            follow_up_message = generate_contextual_followup_message(user_id, db, config)
-            try:
-                line_bot_api.push_message(
-                    user_id,
-                    TextSendMessage(text=follow_up_message)
-                )
-                # ลบรายการติดตามที่ส่งแล้ว
-                redis_client.zrem('follow_up_queue', user_id)
-                # บันทึกการติดตามลงในฐานข้อมูล
-                db.update_follow_up_status(user_id, 'sent', datetime.now())
-                logging.info(f"ส่งการติดตามไปยังผู้ใช้: {user_id}")
+    # 3. อ่านวันที่เริ่มต้นของทุกคนในชุดด้วย MGET ครั้งเดียว แทนการ GET ทีละคนใน schedule_follow_up
+    first_interactions = redis_client.mget([f"first_interaction:{user_id}" for user_id in sent_users])
 
-                # กำหนดการติดตามครั้งถัดไปโดยอัตโนมัติ
-                # ส่งค่า None เพื่อให้ใช้วันที่เริ่มต้นจาก Redis
-                schedule_follow_up(user_id, None)
+    # 4. บันทึกสถานะและกำหนดการติดตามครั้งถัดไปพร้อมกัน
+    sent_at = datetime.now()
+    list(executor.map(
+        lambda args: _record_follow_up_sent(args[0], sent_at, _parse_first_interaction(args[1])),
+        zip(sent_users, first_interactions),
+    ))
 
-            except Exception as e:
-                logging.error(f"เกิดข้อผิดพลาดในการส่งการติดตามไปยัง {user_id}: {str(e)}")
+    # 5. ส่งแล้ว ปลดสัญญาเช่าเพื่อไม่ให้ถูกคืนเข้าคิวและส่งซ้ำ
+    redis_client.zrem('follow_up_inflight', *sent_users)
 
+def _send_follow_up(user_id):
+    """สร้างและส่งข้อความติดตามให้ผู้ใช้หนึ่งคน คืน user_id เมื่อส่งสำเร็จ มิฉะนั้นคืน None"""
+    try:
+        # สร้างข้อความติดตามที่เป็นไปตามบริบทของการสนทนา
+        follow_up_message = generate_contextual_followup_message(user_id, db, config)
+        line_bot_api.push_message(
+            user_id,
+            TextSendMessage(text=follow_up_message)
+        )
+        logging.info(f"ส่งการติดตามไปยังผู้ใช้: {user_id}")
+        return user_id
     except Exception as e:
-        logging.error(f"เกิดข้อผิดพลาดใน check_and_send_follow_ups: {str(e)}")
+        logging.error(f"เกิดข้อผิดพลาดในการส่งการติดตามไปยัง {user_id}: {str(e)}")
+        return None
 
-# ฟังก์ชันที่เกี่ยวข้องกับการแสดงสถานะการประมวลผล
-def send_processing_status(user_id, reply_token):
-    """ส่งข้อความแจ้งสถานะกำลังประมวลผล"""
+def _record_follow_up_sent(user_id, sent_at, interaction_date=None):
+    """บันทึกสถานะการส่งและกำหนดการติดตามครั้งถัดไปของผู้ใช้หนึ่งคน
+
+    interaction_date คือวันที่เริ่มต้นที่อ่านมาแล้วแบบกลุ่ม (None ให้ schedule_follow_up หาเอง)
+    """
+    try:
+        # บันทึกการติดตามลงในฐานข้อมูล
+        db.update_follow_up_status(user_id, 'sent', sent_at)
+
+        # กำหนดการติดตามครั้งถัดไปโดยอัตโนมัติ
+        schedule_follow_up(user_id, interaction_date)
+    except Exception as e:
+        logging.error(f"เกิดข้อผิดพลาดในการกำหนดการติดตามครั้งถัดไปของ {user_id}: {str(e)}")
+
+# ฟังก์ชันที่เกี่ยวข้องกับการแสดงสถานะการประมวลผล
+def send_processing_status(user_id, reply_token):
+    """ส่งข้อความแจ้งสถานะกำลังประมวลผล"""
     try:
         # ส่งข้อความว่ากำลังประมวลผลทันที
         processing_message = choice(PROCESSING_MESSAGES)
@@ -1273,27 +1862,20 @@ def start_loading_animation(user_id, duration=60):
         # ใช้ 60 วินาทีเสมอ (ระยะเวลาสูงสุดที่อนุญาตโดย LINE API)
         duration = 60
 
-        # ดึงโทเค็นการเข้าถึงจากตัวแปรสภาพแวดล้อม
-        access_token = config.LINE_CHANNEL_ACCESS_TOKEN
-
         # สร้างคำขอ
         url = 'https://api.line.me/v2/bot/chat/loading/start'
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {access_token}'
-        }
         payload = {
             'chatId': user_id,
             'loadingSeconds': duration
         }
 
         # ส่งคำขอ
-        response = requests.post(url, headers=headers, json=payload)
+        response = _line_session.post(url, headers=_LINE_LOAD_HEADERS, json=payload, timeout=2)
 
         # ตรวจสอบการตอบกลับ - ทั้ง 200 และ 202 ถือว่าสำเร็จ
         # 202 หมายถึง "Accepted" ใน HTTP ซึ่งเหมาะสำหรับการดำเนินการแบบอะซิงโครนัส
         if response.status_code in [200, 202]:
-            logging.info(f"เริ่มภาพเคลื่อนไหวการโหลดสำหรับผู้ใช้ {user_id} เป็นเวลา {duration} วินาที (สถานะ: {response.status_code})")
+            logging.debug("เริ่มภาพเคลื่อนไหวการโหลดสำหรับผู้ใช้ %s เป็นเวลา %d วินาที (สถานะ: %s)", user_id, duration, response.status_code)
             return True, duration
         else:
             logging.error(f"ไม่สามารถเริ่มภาพเคลื่อนไหวการโหลด: {response.status_code} {response.text}")
@@ -1454,7 +2036,11 @@ def process_conversation_data(user_id, user_message, bot_response, messages):
     session_token_count = get_session_token_count(user_id)
     token_threshold_warning = TOKEN_THRESHOLD * 0.70  # แจ้งเตือนที่ 70% ของขีดจำกัด
 
-    if session_token_count > token_threshold_warning and not redis_client.exists(f"token_warning:{user_id}"):
+    # ตรวจและตั้งธงการแจ้งเตือน (หมดอายุ 30 นาที) ในคำสั่ง SET NX เดียว
+    if (
+        session_token_count > token_threshold_warning
+        and redis_client.set(f"token_warning:{user_id}", "1", nx=True, ex=1800)
+    ):
         # ส่งการแจ้งเตือนเรื่องโทเค็น
         warning_message = (
             "📊 ข้อควรทราบ: ประวัติการสนทนาของเรากำลังเติบโต ระบบอาจจะต้องสรุปบางส่วน"
@@ -1463,31 +2049,17 @@ def process_conversation_data(user_id, user_message, bot_response, messages):
             "• คุณสามารถใช้คำสั่ง /optimize เพื่อปรับปรุงประวัติการสนทนาได้ทุกเมื่อ"
         )
 
-        # ตั้งค่าเวลาหมดอายุของการแจ้งเตือน (30 นาที)
-        redis_client.setex(f"token_warning:{user_id}", 1800, "1")
-
-        # ส่งข้อความแจ้งเตือนหลังจากการตอบกลับปกติเล็กน้อย
-        def send_delayed_warning():
-            time.sleep(3)  # รอ 3 วินาทีหลังจากส่งการตอบกลับปกติ
-            send_final_response(user_id, warning_message)
-
-        # เริ่ม thread ใหม่เพื่อส่งการแจ้งเตือนแบบหน่วงเวลา
-        warning_thread = threading.Thread(target=send_delayed_warning)
-        warning_thread.daemon = True
-        warning_thread.start()
+        # ส่งข้อความแจ้งเตือนหลังจากการตอบกลับปกติ 3 วินาที ผ่านตัวกำหนดการ
+        # แทนการสร้างเธรดใหม่ที่ต้องนอนรอ
+        schedule_delayed_call(3, send_final_response, user_id, warning_message)
 
 # ฟังก์ชันสำหรับการจัดการข้อความที่ถูกล็อค
 
 def handle_locked_user(user_id):
     """จัดการกรณีผู้ใช้ถูกล็อค"""
-    wait_notice_sent = redis_client.exists(f"wait_notice:{user_id}")
-
-    if not wait_notice_sent:
-        line_bot_api.push_message(
-            user_id,
-            TextSendMessage(text="กรุณารอระบบประมวลผลข้อความก่อนหน้าให้เสร็จสิ้นก่อนค่ะ")
-        )
-        redis_client.setex(f"wait_notice:{user_id}", 10, "1")
+    # SET NX EX: ตรวจสอบและตั้งสถานะ "แจ้งเตือนแล้ว" ในคำสั่งเดียว แจ้งไม่เกินหนึ่งครั้งต่อ 10 วินาที
+    if redis_client.set(f"wait_notice:{user_id}", "1", nx=True, ex=10):
+        line_bot_api.push_message(user_id, _MSG_WAIT_PREVIOUS)
 
 # ฟังก์ชันสำหรับประมวลผลข้อความของผู้ใช้
 def process_user_message(user_id, user_message, reply_token):
@@ -1510,22 +2082,35 @@ def process_user_message(user_id, user_message, reply_token):
         send_final_response(user_id, hospital_response, reply_token=reply_token)
         return
 
-    animation_success, _ = start_loading_animation(user_id)
-    if not animation_success and reply_token:
-        if send_processing_status(user_id, reply_token):
-            reply_token = None
+    # เริ่มภาพเคลื่อนไหวการโหลดบนเธรดแยก เพื่อให้การเตรียมบริบททำงานไปพร้อมกับ HTTP call ไปยัง LINE
+    loading_future = _LOADING_POOL.submit(start_loading_animation, user_id)
 
     process_ai_response_with_context(
         user_id,
         user_message,
         start_time,
-        animation_success,
+        loading_future,
         reply_token,
     )
 
-def process_ai_response_with_context(user_id: str, user_message: str, start_time: float, animation_success: bool, reply_token: Optional[str]):
+def _loading_result(loading_future, timeout=1):
+    """รอผลของ start_loading_animation ที่ส่งไปทำงานเบื้องหลัง
+
+    Returns:
+        bool: True หากเริ่มภาพเคลื่อนไหวสำเร็จภายในเวลาที่กำหนด
+    """
+    try:
+        animation_success, _ = loading_future.result(timeout=timeout)
+        return animation_success
+    except Exception as e:
+        logging.warning(f"ไม่ได้รับผลภาพเคลื่อนไหวการโหลดทันเวลา: {str(e)}")
+        return False
+
+def process_ai_response_with_context(user_id: str, user_message: str, start_time: float, loading_future, reply_token: Optional[str]):
     """
     สร้างการตอบกลับ AI โดยใช้บริบทจาก form พร้อมการจัดการข้อผิดพลาดที่ดีขึ้น
+
+    loading_future คือ Future ของ start_loading_animation ซึ่งจะรอผลหลังเตรียมบริบทเสร็จแล้ว
     """
     # ตัวแปรสำหรับเก็บสถานะและข้อมูลสำคัญ
     user_context = None
@@ -1535,35 +2120,47 @@ def process_ai_response_with_context(user_id: str, user_message: str, start_time
     fallback_response = None
     
     try:
-        # 1. ดึงบริบทผู้ใช้ (ไม่ critical - สามารถทำงานต่อได้แม้ไม่มีบริบท)
-        try:
-            user_context = get_user_context(user_id)
-            if user_context:
-                logging.info(f"โหลดบริบทผู้ใช้สำเร็จ: {user_id}")
-        except Exception as e:
-            logging.warning(f"ไม่สามารถโหลดบริบทผู้ใช้ {user_id}: {str(e)}")
-            # ไม่ throw error - ให้ทำงานต่อแบบไม่มีบริบท
-            user_context = None
-        
-        # 2. จัดการประวัติการสนทนาและโทเค็น
+        # 1. ดึงบริบทผู้ใช้บนเธรดแยก (Redis และอาจ fallback ไป MySQL)
+        # ให้ทำงานซ้อนกับการโหลดเซสชันและประวัติในขั้นที่ 2 แทนการรอทีละขั้น
+        context_future = _CONTEXT_POOL.submit(get_user_context, user_id)
+
+        # 2. จัดการประวัติการสนทนาและโทเค็น (เพิ่มบริบทหลังได้ผลจากขั้นที่ 1)
         try:
-            messages = prepare_conversation_messages(user_id, user_context)
+            messages = prepare_conversation_messages(user_id, None)
         except TokenThresholdExceeded:
             # ถ้าโทเค็นเกิน ใช้การจัดการแบบพิเศษ
             logging.info(f"โทเค็นเกินขีดจำกัดสำหรับผู้ใช้ {user_id}, ใช้การจัดการแบบไฮบริด")
             try:
                 messages = hybrid_context_management(user_id, TOKEN_THRESHOLD)
-                # เพิ่มบริบทกลับเข้าไปถ้ามี
-                if user_context:
-                    add_context_to_messages(messages, user_context)
+                messages.insert(0, SYSTEM_MESSAGES)
             except Exception as hybrid_error:
                 logging.error(f"การจัดการแบบไฮบริดล้มเหลว: {str(hybrid_error)}")
                 # Fallback: ใช้เซสชันว่าง
-                messages = create_minimal_session(user_context)
+                messages = None
         except Exception as e:
             logging.error(f"เกิดข้อผิดพลาดในการเตรียมข้อความ: {str(e)}")
+            messages = None
+
+        # บริบทผู้ใช้ไม่ critical - สามารถทำงานต่อได้แม้ไม่มีบริบท
+        try:
+            user_context = context_future.result()
+            if user_context:
+                logging.debug("โหลดบริบทผู้ใช้สำเร็จ: %s", user_id)
+        except Exception as e:
+            logging.warning(f"ไม่สามารถโหลดบริบทผู้ใช้ {user_id}: {str(e)}")
+            user_context = None
+
+        if messages is None:
             messages = create_minimal_session(user_context)
+        elif user_context:
+            add_context_to_messages(messages, user_context)
         
+        # ภาพเคลื่อนไหวไม่สำเร็จ: ใช้ reply token แจ้งสถานะก่อนเรียก AI ซึ่งใช้เวลานาน
+        animation_success = _loading_result(loading_future)
+        if not animation_success and reply_token:
+            if send_processing_status(user_id, reply_token):
+                reply_token = None
+
         # 3. เพิ่มข้อความของผู้ใช้
         messages.append({"role": "user", "content": user_message})
         
@@ -1636,30 +2233,23 @@ def process_ai_response_with_context(user_id: str, user_message: str, start_time
             # ไม่ให้ error นี้ทำให้ผู้ใช้ไม่ได้รับคำตอบ
             error_occurred = True
         
-        # 8. จัดการจังหวะเวลา
-        handle_response_timing(start_time, animation_success)
-        
-        # 9. ส่งการตอบกลับ
-        try:
-            success = send_final_response(user_id, bot_response, reply_token=reply_token)
-            if not success:
-                raise create_legacy_chatbot_error(
-                    ErrorType.MESSAGE_SEND_ERROR,
-                    "Failed to send response to user"
-                )
-                
-            # ถ้าใช้ fallback หรือมี error แจ้งให้ผู้ใช้ทราบ
-            if fallback_response or error_occurred:
-                send_system_notification(user_id, fallback_response is not None, error_occurred)
-                
-        except Exception as e:
-            logging.critical(f"ไม่สามารถส่งข้อความให้ผู้ใช้ {user_id}: {str(e)}")
-            # นี่คือ critical error - ผู้ใช้จะไม่ได้รับการตอบกลับเลย
-            notify_admin_critical_error(user_id, user_message, str(e))
+        # 8-9. จัดการจังหวะเวลาและส่งการตอบกลับ (หน่วงผ่าน scheduler แทนการ sleep บนเธรดที่รับงาน)
+        # หมายเหตุ: ล็อคผู้ใช้ถูกปลดเมื่องานนี้จบ ก่อนคำตอบที่หน่วงไว้ (ไม่เกิน 5 วินาที) ถูกส่ง
+        # คำสั่งที่ผู้ใช้ส่งตามมาในช่วงนี้ (เช่น /tokens) จึงอาจได้รับคำตอบก่อนคำตอบของ AI
+        response_delay = handle_response_timing(start_time, animation_success)
+        _schedule_final_delivery(
+            response_delay,
+            user_id,
+            user_message,
+            bot_response,
+            reply_token,
+            fallback_response is not None,
+            error_occurred,
+        )
             
         # 10. บันทึกเวลาประมวลผล
         total_time = time.time() - start_time
-        logging.info(f"เวลาประมวลผลทั้งหมดสำหรับผู้ใช้ {user_id}: {total_time:.2f} วินาที")
+        logging.debug("เวลาประมวลผลทั้งหมดสำหรับผู้ใช้ %s: %.2f วินาที", user_id, total_time)
         
         # 11. บันทึก metrics
         record_processing_metrics(user_id, total_time, fallback_response is not None, error_occurred)
@@ -1697,26 +2287,28 @@ def prepare_conversation_messages(user_id: str, user_context: Optional[str]) ->
     """เตรียมข้อความสำหรับการสนทนา พร้อมจัดการข้อผิดพลาด"""
     try:
         session_token_count = get_session_token_count(user_id)
-        logging.info(f"จำนวนโทเค็นปัจจุบัน: {session_token_count} (ผู้ใช้: {user_id})")
+        logging.debug("จำนวนโทเค็นปัจจุบัน: %s (ผู้ใช้: %s)", session_token_count, user_id)
 
         if session_token_count > TOKEN_THRESHOLD:
             raise TokenThresholdExceeded(f"Token count {session_token_count} exceeds threshold")
 
-        messages = get_chat_session(user_id) or []
+        # ข้อความแรกคือ SYSTEM_MESSAGES เสมอ ส่งต่อให้ API ได้โดยไม่ต้องต่อ list ใหม่
+        messages = get_chat_session(user_id, include_system=True)
+        has_session_history = len(messages) > 1
         used_history_ids: Set[int] = set()
         history_for_summary: List[Tuple] = []
 
-        history_token_limit = 20000 if not messages else 10000
+        history_token_limit = 20000 if not has_session_history else 10000
         try:
             history_for_summary = db.get_user_history(user_id, max_tokens=history_token_limit) or []
         except Exception as e:
             logging.warning(f"ไม่สามารถโหลดประวัติจากฐานข้อมูล: {str(e)}")
             history_for_summary = []
 
-        if not messages and history_for_summary:
+        if not has_session_history and history_for_summary:
             restored_messages, used_history_ids = history_to_messages(history_for_summary, max_pairs=DB_RESTORE_MESSAGE_PAIRS)
             if restored_messages:
-                messages = restored_messages
+                messages.extend(restored_messages)
                 try:
                     save_chat_session(user_id, messages)
                     logging.info(f"กู้คืนประวัติการสนทนาจากฐานข้อมูลสำหรับผู้ใช้ {user_id}: {len(messages)} ข้อความ")
@@ -1763,16 +2355,23 @@ def create_minimal_session(user_context: Optional[str]) -> List[Dict[str, str]]:
     return messages
 
 
+def with_system_prompt(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """คืนข้อความที่ขึ้นต้นด้วย system prompt โดยคัดลอก list เฉพาะเมื่อจำเป็น"""
+    if messages and messages[0].get('role') == 'system':
+        return messages
+    return [SYSTEM_MESSAGES] + messages
+
+
 def generate_ai_response_with_timeout(messages: List[Dict[str, str]], timeout: int = 30) -> str:
     """เรียก xAI Grok API พร้อม timeout และคืนข้อความตอบกลับ"""
     import concurrent.futures
 
-    filtered_messages = filter_messages_for_api(messages)
+    filtered_messages = with_system_prompt(filter_messages_for_api(messages))
     effective_timeout = _calculate_adaptive_timeout(filtered_messages, base_timeout=timeout)
 
     def _call() -> str:
         return grok_client.send_chat(
-            messages=[SYSTEM_MESSAGES] + filtered_messages,
+            messages=filtered_messages,
             model=config.XAI_MODEL,
             **GENERATION_CONFIG,
         )
@@ -1793,9 +2392,8 @@ def _calculate_adaptive_timeout(filtered_messages: List[Dict[str, str]], base_ti
     char_count = 0
 
     try:
-        payload = [SYSTEM_MESSAGES] + filtered_messages
         if token_counter is not None:
-            token_count = token_counter.count_message_tokens(payload)
+            token_count = token_counter.count_message_tokens(filtered_messages)
     except Exception as token_error:
         logging.debug(f"Adaptive timeout token count failed: {token_error}")
 
@@ -2045,6 +2643,7 @@ def notify_admin_critical_error(user_id: str, user_message: str, error: str):
 def save_error_for_analysis(error_id: str, user_id: str, user_message: str, error: Exception):
     """บันทึกข้อผิดพลาดสำหรับการวิเคราะห์"""
     try:
+        now = datetime.now()
         error_data = {
             'error_id': error_id,
             'user_id': user_id,
@@ -2052,12 +2651,13 @@ def save_error_for_analysis(error_id: str, user_id: str, user_message: str, erro
             'error_type': type(error).__name__,
             'error_message': str(error),
             'traceback': traceback.format_exc(),
-            'timestamp': datetime.now().isoformat()
+            'timestamp': now.isoformat()
         }
         
         # บันทึกลง Redis
-        redis_client.hset(f"errors:{datetime.now().strftime('%Y%m%d')}", error_id, json.dumps(error_data))
-        redis_client.expire(f"errors:{datetime.now().strftime('%Y%m%d')}", 604800)  # 7 วัน
+        errors_key = f"errors:{now.strftime('%Y%m%d')}"
+        redis_client.hset(errors_key, error_id, json.dumps(error_data))
+        redis_client.expire(errors_key, 604800)  # 7 วัน
         
     except:
         # ถ้าบันทึกไม่ได้ ก็ไม่ต้องทำอะไร
@@ -2112,18 +2712,201 @@ def prepare_conversation_context(messages, optimized_history, used_history_ids:
         messages.append({"role": "system_summary", "content": "สรุปการสนทนาก่อนหน้า: " + summary})
 
 
+# ข้อความคงที่ของคำสั่งที่ไม่มีข้อมูลเฉพาะผู้ใช้ สร้างครั้งเดียวตอนโหลดโมดูล
+_SESSION_TIMEOUT_TEXT = (
+    "สวัสดีค่ะ ยินดีต้อนรับกลับมา 👋\n\n"
+    "เซสชันก่อนหน้าของเราหมดอายุแล้ว เราสามารถเริ่มการสนทนาใหม่ได้ทันที\n\n"
+    "💡 ต้องการดูประวัติการสนทนาก่อนหน้า พิมพ์: /status\n"
+    "💡 ต้องการดูรายงานความก้าวหน้า พิมพ์: /progress\n"
+    "💡 ต้องการคำแนะนำเพิ่มเติม พิมพ์: /help\n\n"
+    "คุณต้องการพูดคุยเกี่ยวกับเรื่องอะไรดีคะวันนี้?"
+)
+
+_HELP_TEXT = (
+    "สวัสดีค่ะ 👋 ฉันคือน้องใจดี ผู้ช่วยดูแลและให้คำปรึกษาสำหรับผู้ที่ต้องการเลิกใช้สารเสพติด"
+    "💬 ฉันสามารถช่วยคุณได้ดังนี้:\n"
+    "- พูดคุยและให้กำลังใจในการเลิกใช้สารเสพติด\n"
+    "- ให้คำปรึกษาเกี่ยวกับวิธีรับมือความอยากและอาการถอน\n"
+    "- ให้ข้อมูลเกี่ยวกับผลกระทบของสารเสพติดและการรักษา\n"
+    "- ติดตามความก้าวหน้าและให้คำแนะนำที่เหมาะสมกับคุณ\n\n"
+    "🛠️ คำสั่งที่มีให้ใช้:\n"
+    "📥 /register - วิธีลงทะเบียนใช้งาน\n"
+    "✅ /verify <รหัส> - ยืนยันตัวตนด้วยรหัส 6 หลัก\n"
+    "🧠 /optimize - ปรับปรุงประวัติการสนทนาให้มีประสิทธิภาพ\n"
+    "🪙 /tokens - ตรวจสอบการใช้งานโทเค็นในเซสชันปัจจุบัน\n"
+    "📊 /status - ดูสรุปสถานะการสนทนาและการใช้โทเค็น\n"
+    "📈 /progress - ดูรายงานความก้าวหน้าและแนวทางถัดไป\n"
+    "📋 /context - ดูบริบทของคุณจากแบบประเมินที่กรอกไว้\n"
+    "🔔 /followup - ตรวจสอบกำหนดการติดตามของคุณ\n"
+    "🚨 /emergency - ดูข้อมูลติดต่อฉุกเฉินและสายด่วน\n"
+    "❓ /help - แสดงเมนูช่วยเหลือนี้\n\n"
+    "💡 ตัวอย่างคำถามที่สามารถถามฉันได้:\n"
+    "- \"ช่วยประเมินการใช้สารเสพติดของฉันหน่อย\"\n"
+    "- \"ผลกระทบของยาบ้าต่อร่างกายมีอะไรบ้าง\"\n"
+    "- \"มีเทคนิคจัดการความอยากยาอย่างไร\"\n"
+    "- \"ฉันควรทำอย่างไรเมื่อรู้สึกอยากกลับไปใช้สารอีก\"\n\n"
+    "📧 ติดต่อทีมงาน:\n"
+    "หากพบข้อผิดพลาด (บัค) หรือมีข้อเสนอแนะ สามารถติดต่อได้ที่:\n"
+    "🔧 ผู้พัฒนาระบบ: pahnkcn@gmail.com\n"
+    "📖 ผู้วิจัย: Std6548097@pcm.ac.th\n\n"
+    "เริ่มพูดคุยกับฉันได้เลยนะคะ ฉันพร้อมรับฟังและช่วยเหลือคุณ 💚"
+)
+
+_EMERGENCY_TEXT = (
+    "🚨 บริการช่วยเหลือฉุกเฉิน 🚨\n\n"
+    "หากคุณหรือคนใกล้ตัวกำลังประสบปัญหาต่อไปนี้:\n"
+    "- ใช้สารเสพติดเกินขนาด (Overdose)\n"
+    "- มีอาการชัก เลือดออก หมดสติ\n"
+    "- มีความคิดทำร้ายตัวเอง\n"
+    "- มีอาการถอนยารุนแรง\n\n"
+    "📞 ติดต่อขอความช่วยเหลือด่วนได้ที่:\n"
+    "🔸 สายด่วนกรมควบคุมโรค: 1422\n"
+    "🔸 ศูนย์ปรึกษาปัญหายาเสพติด: 1165\n"
+    "🔸 หน่วยกู้ชีพฉุกเฉิน: 1669\n"
+    "🔸 สายด่วนสุขภาพจิต: 1323\n\n"
+    "🌐 เว็บไซต์ช่วยเหลือ:\n"
+    "https://www.pmnidat.go.th\n\n"
+    "💚 การขอความช่วยเหลือคือก้าวแรกของการดูแลตัวเอง"
+)
+
+_REGISTER_TEXT = (
+    "📝 การลงทะเบียนใช้งานน้องใจดี\n\n"
+    "เพื่อเริ่มใช้งาน คุณจำเป็นต้องลงทะเบียนก่อน โดยทำตามขั้นตอนดังนี้:\n\n"
+    "1. กรอกแบบฟอร์มที่ลิงก์นี้: https://forms.gle/r5MGki6QFtBer2PM8\n"
+    "2. หลังกรอกเสร็จ คุณจะได้รับรหัสยืนยัน 6 หลัก\n"
+    "3. นำรหัสมาพิมพ์ที่นี่ด้วยคำสั่ง \"/verify รหัส\" เช่น \"/verify 123456\"\n\n"
+    "หากมีปัญหาในการลงทะเบียน คุณสามารถติดต่อเจ้าหน้าที่ได้ที่ support@example.com"
+)
+
+_STATIC_RESPONSES = {
+    '/help': _HELP_TEXT,
+    '/emergency': _EMERGENCY_TEXT,
+    '/register': _REGISTER_TEXT,
+}
+
 def send_session_timeout_message(user_id, reply_token=None):
     """ส่งข้อความเซสชันหมดอายุ"""
-    welcome_back = (
-        "สวัสดีค่ะ ยินดีต้อนรับกลับมา 👋\n\n"
-        "เซสชันก่อนหน้าของเราหมดอายุแล้ว เราสามารถเริ่มการสนทนาใหม่ได้ทันที\n\n"
-        "💡 ต้องการดูประวัติการสนทนาก่อนหน้า พิมพ์: /status\n"
-        "💡 ต้องการดูรายงานความก้าวหน้า พิมพ์: /progress\n"
-        "💡 ต้องการคำแนะนำเพิ่มเติม พิมพ์: /help\n\n"
-        "คุณต้องการพูดคุยเกี่ยวกับเรื่องอะไรดีคะวันนี้?"
+    send_final_response(user_id, _SESSION_TIMEOUT_TEXT, reply_token=reply_token)
+
+def _cmd_reset(user_id):
+    """ล้างประวัติการสนทนา เซสชัน และกำหนดการติดตามของผู้ใช้"""
+    db.clear_user_history(user_id)
+    redis_client.delete(f"chat_session:{user_id}")
+    redis_client.delete(f"session_tokens:{user_id}")
+    redis_client.zrem('follow_up_queue', user_id)
+    redis_client.zrem('follow_up_inflight', user_id)
+    redis_client.delete(f"last_follow_up:{user_id}")
+    redis_client.delete(f"first_interaction:{user_id}")
+    return (
+        "🔄 ล้างประวัติการสนทนาเรียบร้อยแล้วค่ะ\n\n"
+        "เราสามารถเริ่มต้นการสนทนาใหม่ได้ทันที\n"
+        "คุณต้องการพูดคุยเกี่ยวกับเรื่องอะไรดีคะ?"
+    )
+
+def _cmd_optimize(user_id):
+    """ปรับปรุงประวัติการสนทนาเมื่อโทเค็นเกินเกณฑ์"""
+    token_count_before = get_session_token_count(user_id)
+    # ต่ำกว่าเกณฑ์จะไม่มีการปรับปรุง จึงไม่ต้องโหลดและแปลงเซสชันทั้งก้อน
+    if token_count_before >= TOKEN_THRESHOLD:
+        hybrid_context_management(user_id, TOKEN_THRESHOLD)
+        token_count_after = get_session_token_count(user_id)
+    else:
+        token_count_after = token_count_before
+
+    return (
+        f"🔄 ปรับปรุงประวัติการสนทนาเรียบร้อยแล้วค่ะ\n\n"
+        f"จำนวนโทเค็น: {token_count_before} → {token_count_after} ({(token_count_before - token_count_after)} ลดลง)\n\n"
+        "ประวัติการสนทนาสำคัญยังคงถูกเก็บไว้ และบอทยังเข้าใจบริบทการสนทนาของเรา\n"
+        "เราสามารถสนทนาต่อได้ตามปกติค่ะ"
     )
-    send_final_response(user_id, welcome_back, reply_token=reply_token)
 
+def _cmd_tokens(user_id):
+    """สรุปการใช้โทเค็นในเซสชันปัจจุบัน"""
+    token_count = get_session_token_count(user_id)
+    max_tokens = TOKEN_THRESHOLD
+    percentage = (token_count / max_tokens) * 100 if max_tokens else 0
+
+    return (
+        f"📊 สถิติการใช้โทเค็น\n\n"
+        f"โทเค็นในเซสชันปัจจุบัน: {token_count:,}\n"
+        f"ขีดจำกัด: {max_tokens:,}\n"
+        f"เปอร์เซ็นต์การใช้งาน: {percentage:.1f}%\n\n"
+        f"{'⚠️ ใกล้ถึงขีดจำกัด โปรดใช้ /optimize เพื่อปรับปรุงประวัติ' if percentage > 80 else '✅ อยู่ในเกณฑ์ปกติ'}"
+    )
+
+def _cmd_followup(user_id):
+    """สถานะกำหนดการติดตามของผู้ใช้"""
+    return get_follow_up_status(user_id)
+
+def _cmd_status(user_id):
+    """สรุปสถานะการสนทนาและการใช้โทเค็น"""
+    # สถิติจากฐานข้อมูลในคิวรีเดียว และสถานะเซสชันจาก Redis ในรอบเดียว
+    stats = db.get_user_stats(user_id) or {}
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.exists(f"chat_session:{user_id}")
+    pipe.get(f"session_tokens:{user_id}")
+    session_exists, cached_tokens = pipe.execute()
+    current_session = bool(session_exists)
+    session_tokens = int(cached_tokens) if cached_tokens else 0
+    total_db_tokens = stats.get('total_tokens', 0)
+
+    return (
+        "📊 สถิติการสนทนาของคุณ\n"
+        f"▫️ จำนวนการสนทนาที่บันทึก: {stats.get('history_count', 0)} ครั้ง\n"
+        f"▫️ ประเด็นสำคัญที่พูดคุย: {stats.get('important_count', 0)} รายการ\n"
+        f"▫️ สนทนาล่าสุดเมื่อ: {stats.get('last_interaction', 'ไม่มีข้อมูล')}\n"
+        f"▫️ สถานะเซสชันปัจจุบัน: {'🟢 กำลังสนทนาอยู่' if current_session else '🔴 ยังไม่เริ่มสนทนา'}\n\n"
+        f"📝 สถิติโทเค็น\n"
+        f"▫️ โทเค็นในเซสชันปัจจุบัน: {session_tokens:,}\n"
+        f"▫️ โทเค็นในฐานข้อมูล: {total_db_tokens:,}\n"
+        "  (ผลรวมของแต่ละข้อความที่บันทึก)\n\n"
+        "💚 น้องใจดีพร้อมให้คำปรึกษาและสนับสนุนคุณตลอดเส้นทางการเลิกสารเสพติด\n"
+        "💬 มีคำถามหรือต้องการความช่วยเหลือ เพียงพิมพ์บอกฉันได้เลยค่ะ\n\n"
+        "ℹ️ เคล็ดลับ: ต้องการดูรายงานความก้าวหน้าของคุณ พิมพ์ /progress"
+    )
+
+def _cmd_progress(user_id):
+    """รายงานความก้าวหน้าของผู้ใช้"""
+    report = generate_progress_report(user_id)
+    return (
+        f"{report}\n\nℹ️ เคล็ดลับ: ต้องการดูสรุปสถานะการสนทนาปัจจุบัน พิมพ์ /status"
+        if report else
+        (
+            "📊 รายงานความก้าวหน้า\n\n"
+            "ยังไม่มีข้อมูลความก้าวหน้าเพียงพอสำหรับการวิเคราะห์\n\n"
+            "เมื่อเราพูดคุยกันมากขึ้น น้องใจดีจะสามารถติดตามและวิเคราะห์ความก้าวหน้าของคุณได้\n\n"
+            "ℹ️ เคล็ดลับ: ดูสรุปสถานะล่าสุดด้วย /status"
+        )
+    )
+
+def _cmd_context(user_id):
+    """บริบทของผู้ใช้จากแบบประเมิน"""
+    context = get_user_context(user_id)
+    if context:
+        response_text = (
+            "📋 บริบทของคุณจากแบบประเมิน:\n\n"
+            f"{context}\n\n"
+            "ใจดีใช้ข้อมูลนี้เพื่อให้คำปรึกษาที่เหมาะสมกับคุณมากที่สุดค่ะ"
+        )
+    else:
+        response_text = (
+            "ไม่พบข้อมูลบริบทจากแบบประเมิน\n"
+            "อาจเป็นเพราะคุณลงทะเบียนก่อนที่ระบบจะมีฟีเจอร์นี้"
+        )
+    return response_text
+
+# ตารางคำสั่งที่ต้องใช้ข้อมูลของผู้ใช้ แต่ละฟังก์ชันคืนข้อความตอบกลับ
+_COMMAND_HANDLERS = {
+    '/reset': _cmd_reset,
+    '/optimize': _cmd_optimize,
+    '/tokens': _cmd_tokens,
+    '/followup': _cmd_followup,
+    '/status': _cmd_status,
+    '/progress': _cmd_progress,
+    '/context': _cmd_context,
+}
+
+_UNKNOWN_COMMAND_TEXT = "คำสั่งไม่ถูกต้องค่ะ ลองพิมพ์ /help เพื่อดูคำสั่งที่สามารถใช้ได้"
 
 def handle_command_with_processing(user_id, command, reply_token=None):
     """จัดการคำสั่งและส่งผลลัพธ์กลับไปยังผู้ใช้ หากจัดการได้จะคืน True"""
@@ -2140,8 +2923,8 @@ def handle_command_with_processing(user_id, command, reply_token=None):
             )
             return True
 
-        parts = normalized.split()
-        if len(parts) != 2:
+        confirmation_code = parse_verify_code(normalized)
+        if confirmation_code is None:
             send_final_response(
                 user_id,
                 "รูปแบบไม่ถูกต้อง กรุณาพิมพ์ \"/verify\" ตามด้วยรหัส 6 หลัก เช่น \"/verify 123456\"",
@@ -2149,173 +2932,21 @@ def handle_command_with_processing(user_id, command, reply_token=None):
             )
             return True
 
-        confirmation_code = parts[1].strip()
         success, message = register_user_with_code(user_id, confirmation_code)
         send_final_response(user_id, message, reply_token=reply_token)
         return True
 
-    response_text = None
-
-    if normalized == '/reset':
-        db.clear_user_history(user_id)
-        redis_client.delete(f"chat_session:{user_id}")
-        redis_client.delete(f"session_tokens:{user_id}")
-        redis_client.zrem('follow_up_queue', user_id)
-        redis_client.delete(f"last_follow_up:{user_id}")
-        redis_client.delete(f"first_interaction:{user_id}")
-        response_text = (
-            "🔄 ล้างประวัติการสนทนาเรียบร้อยแล้วค่ะ\n\n"
-            "เราสามารถเริ่มต้นการสนทนาใหม่ได้ทันที\n"
-            "คุณต้องการพูดคุยเกี่ยวกับเรื่องอะไรดีคะ?"
-        )
-
-    elif normalized == '/optimize':
-        token_count_before = get_session_token_count(user_id)
-        hybrid_context_management(user_id, TOKEN_THRESHOLD)
-        token_count_after = get_session_token_count(user_id)
-
-        response_text = (
-            f"🔄 ปรับปรุงประวัติการสนทนาเรียบร้อยแล้วค่ะ\n\n"
-            f"จำนวนโทเค็น: {token_count_before} → {token_count_after} ({(token_count_before - token_count_after)} ลดลง)\n\n"
-            "ประวัติการสนทนาสำคัญยังคงถูกเก็บไว้ และบอทยังเข้าใจบริบทการสนทนาของเรา\n"
-            "เราสามารถสนทนาต่อได้ตามปกติค่ะ"
-        )
-
-    elif normalized == '/tokens':
-        token_count = get_session_token_count(user_id)
-        max_tokens = TOKEN_THRESHOLD
-        percentage = (token_count / max_tokens) * 100 if max_tokens else 0
-
-        response_text = (
-            f"📊 สถิติการใช้โทเค็น\n\n"
-            f"โทเค็นในเซสชันปัจจุบัน: {token_count:,}\n"
-            f"ขีดจำกัด: {max_tokens:,}\n"
-            f"เปอร์เซ็นต์การใช้งาน: {percentage:.1f}%\n\n"
-            f"{'⚠️ ใกล้ถึงขีดจำกัด โปรดใช้ /optimize เพื่อปรับปรุงประวัติ' if percentage > 80 else '✅ อยู่ในเกณฑ์ปกติ'}"
-        )
-
-    elif normalized == '/followup':
-        response_text = get_follow_up_status(user_id)
-
-    elif normalized == '/help':
-        response_text = (
-            "สวัสดีค่ะ 👋 ฉันคือน้องใจดี ผู้ช่วยดูแลและให้คำปรึกษาสำหรับผู้ที่ต้องการเลิกใช้สารเสพติด"
-            "💬 ฉันสามารถช่วยคุณได้ดังนี้:\n"
-            "- พูดคุยและให้กำลังใจในการเลิกใช้สารเสพติด\n"
-            "- ให้คำปรึกษาเกี่ยวกับวิธีรับมือความอยากและอาการถอน\n"
-            "- ให้ข้อมูลเกี่ยวกับผลกระทบของสารเสพติดและการรักษา\n"
-            "- ติดตามความก้าวหน้าและให้คำแนะนำที่เหมาะสมกับคุณ\n\n"
-            "🛠️ คำสั่งที่มีให้ใช้:\n"
-            "📥 /register - วิธีลงทะเบียนใช้งาน\n"
-            "✅ /verify <รหัส> - ยืนยันตัวตนด้วยรหัส 6 หลัก\n"
-            "🧠 /optimize - ปรับปรุงประวัติการสนทนาให้มีประสิทธิภาพ\n"
-            "🪙 /tokens - ตรวจสอบการใช้งานโทเค็นในเซสชันปัจจุบัน\n"
-            "📊 /status - ดูสรุปสถานะการสนทนาและการใช้โทเค็น\n"
-            "📈 /progress - ดูรายงานความก้าวหน้าและแนวทางถัดไป\n"
-            "📋 /context - ดูบริบทของคุณจากแบบประเมินที่กรอกไว้\n"
-            "🔔 /followup - ตรวจสอบกำหนดการติดตามของคุณ\n"
-            "🚨 /emergency - ดูข้อมูลติดต่อฉุกเฉินและสายด่วน\n"
-            "❓ /help - แสดงเมนูช่วยเหลือนี้\n\n"
-            "💡 ตัวอย่างคำถามที่สามารถถามฉันได้:\n"
-            "- \"ช่วยประเมินการใช้สารเสพติดของฉันหน่อย\"\n"
-            "- \"ผลกระทบของยาบ้าต่อร่างกายมีอะไรบ้าง\"\n"
-            "- \"มีเทคนิคจัดการความอยากยาอย่างไร\"\n"
-            "- \"ฉันควรทำอย่างไรเมื่อรู้สึกอยากกลับไปใช้สารอีก\"\n\n"
-            "📧 ติดต่อทีมงาน:\n"
-            "หากพบข้อผิดพลาด (บัค) หรือมีข้อเสนอแนะ สามารถติดต่อได้ที่:\n"
-            "🔧 ผู้พัฒนาระบบ: pahnkcn@gmail.com\n"
-            "📖 ผู้วิจัย: Std6548097@pcm.ac.th\n\n"
-            "เริ่มพูดคุยกับฉันได้เลยนะคะ ฉันพร้อมรับฟังและช่วยเหลือคุณ 💚"
-        )
-
-    elif normalized == '/status':
-        history_count = db.get_user_history_count(user_id)
-        important_count = db.get_important_message_count(user_id)
-        last_interaction = db.get_last_interaction(user_id)
-        current_session = redis_client.exists(f"chat_session:{user_id}") == 1
-        total_db_tokens = db.get_total_tokens(user_id) or 0
-        session_tokens = get_session_token_count(user_id)
-
-        response_text = (
-            "📊 สถิติการสนทนาของคุณ\n"
-            f"▫️ จำนวนการสนทนาที่บันทึก: {history_count} ครั้ง\n"
-            f"▫️ ประเด็นสำคัญที่พูดคุย: {important_count} รายการ\n"
-            f"▫️ สนทนาล่าสุดเมื่อ: {last_interaction}\n"
-            f"▫️ สถานะเซสชันปัจจุบัน: {'🟢 กำลังสนทนาอยู่' if current_session else '🔴 ยังไม่เริ่มสนทนา'}\n\n"
-            f"📝 สถิติโทเค็น\n"
-            f"▫️ โทเค็นในเซสชันปัจจุบัน: {session_tokens:,}\n"
-            f"▫️ โทเค็นในฐานข้อมูล: {total_db_tokens:,}\n"
-            "  (ผลรวมของแต่ละข้อความที่บันทึก)\n\n"
-            "💚 น้องใจดีพร้อมให้คำปรึกษาและสนับสนุนคุณตลอดเส้นทางการเลิกสารเสพติด\n"
-            "💬 มีคำถามหรือต้องการความช่วยเหลือ เพียงพิมพ์บอกฉันได้เลยค่ะ\n\n"
-            "ℹ️ เคล็ดลับ: ต้องการดูรายงานความก้าวหน้าของคุณ พิมพ์ /progress"
-        )
-
-    elif normalized == '/emergency':
-        response_text = (
-            "🚨 บริการช่วยเหลือฉุกเฉิน 🚨\n\n"
-            "หากคุณหรือคนใกล้ตัวกำลังประสบปัญหาต่อไปนี้:\n"
-            "- ใช้สารเสพติดเกินขนาด (Overdose)\n"
-            "- มีอาการชัก เลือดออก หมดสติ\n"
-            "- มีความคิดทำร้ายตัวเอง\n"
-            "- มีอาการถอนยารุนแรง\n\n"
-            "📞 ติดต่อขอความช่วยเหลือด่วนได้ที่:\n"
-            "🔸 สายด่วนกรมควบคุมโรค: 1422\n"
-            "🔸 ศูนย์ปรึกษาปัญหายาเสพติด: 1165\n"
-            "🔸 หน่วยกู้ชีพฉุกเฉิน: 1669\n"
-            "🔸 สายด่วนสุขภาพจิต: 1323\n\n"
-            "🌐 เว็บไซต์ช่วยเหลือ:\n"
-            "https://www.pmnidat.go.th\n\n"
-            "💚 การขอความช่วยเหลือคือก้าวแรกของการดูแลตัวเอง"
-        )
-
-    elif normalized == '/progress':
-        report = generate_progress_report(user_id)
-        response_text = (
-            f"{report}\n\nℹ️ เคล็ดลับ: ต้องการดูสรุปสถานะการสนทนาปัจจุบัน พิมพ์ /status"
-            if report else
-            (
-                "📊 รายงานความก้าวหน้า\n\n"
-                "ยังไม่มีข้อมูลความก้าวหน้าเพียงพอสำหรับการวิเคราะห์\n\n"
-                "เมื่อเราพูดคุยกันมากขึ้น น้องใจดีจะสามารถติดตามและวิเคราะห์ความก้าวหน้าของคุณได้\n\n"
-                "ℹ️ เคล็ดลับ: ดูสรุปสถานะล่าสุดด้วย /status"
-            )
-        )
-
-    elif normalized == '/register':
-        response_text = (
-            "📝 การลงทะเบียนใช้งานน้องใจดี\n\n"
-            "เพื่อเริ่มใช้งาน คุณจำเป็นต้องลงทะเบียนก่อน โดยทำตามขั้นตอนดังนี้:\n\n"
-            "1. กรอกแบบฟอร์มที่ลิงก์นี้: https://forms.gle/r5MGki6QFtBer2PM8\n"
-            "2. หลังกรอกเสร็จ คุณจะได้รับรหัสยืนยัน 6 หลัก\n"
-            "3. นำรหัสมาพิมพ์ที่นี่ด้วยคำสั่ง \"/verify รหัส\" เช่น \"/verify 123456\"\n\n"
-            "หากมีปัญหาในการลงทะเบียน คุณสามารถติดต่อเจ้าหน้าที่ได้ที่ support@example.com"
-        )
-
-    elif normalized == '/context':
-        context = get_user_context(user_id)
-        if context:
-            response_text = (
-                "📋 บริบทของคุณจากแบบประเมิน:\n\n"
-                f"{context}\n\n"
-                "ใจดีใช้ข้อมูลนี้เพื่อให้คำปรึกษาที่เหมาะสมกับคุณมากที่สุดค่ะ"
-            )
-        else:
-            response_text = (
-                "ไม่พบข้อมูลบริบทจากแบบประเมิน\n"
-                "อาจเป็นเพราะคุณลงทะเบียนก่อนที่ระบบจะมีฟีเจอร์นี้"
-            )
-        send_final_response(user_id, response_text, reply_token=reply_token)
+    static_response = _STATIC_RESPONSES.get(normalized)
+    if static_response is not None:
+        send_final_response(user_id, static_response, reply_token=reply_token)
         return True
 
-    else:
-        send_final_response(
-            user_id,
-            "คำสั่งไม่ถูกต้องค่ะ ลองพิมพ์ /help เพื่อดูคำสั่งที่สามารถใช้ได้",
-            reply_token=reply_token,
-        )
+    command_handler = _COMMAND_HANDLERS.get(normalized)
+    if command_handler is None:
+        send_final_response(user_id, _UNKNOWN_COMMAND_TEXT, reply_token=reply_token)
         return True
 
+    response_text = command_handler(user_id)
     if response_text:
         send_final_response(user_id, response_text, reply_token=reply_token)
         return True
@@ -2323,7 +2954,11 @@ def handle_command_with_processing(user_id, command, reply_token=None):
     return False
 
 def handle_response_timing(start_time, animation_success):
-    """จัดการเวลาในการตอบสนองเพื่อประสบการณ์ผู้ใช้ที่ดีขึ้น"""
+    """คำนวณเวลาหน่วงก่อนส่งคำตอบเพื่อประสบการณ์ผู้ใช้ที่ดีขึ้น
+
+    Returns:
+        จำนวนวินาทีที่ควรรอก่อนส่งคำตอบ (0 หากส่งได้ทันที)
+    """
     # คำนวณเวลาที่ผ่านไป
     elapsed_time = time.time() - start_time
 
@@ -2332,15 +2967,88 @@ def handle_response_timing(start_time, animation_success):
     # แต่ไม่นานเกินไปที่จะทำให้เกิดความหงุดหงิด (ขั้นต่ำ 5 วินาที สูงสุด 15 วินาที)
     if animation_success and elapsed_time < 5:
         # เพิ่มการหน่วงเวลาเล็กน้อยเพื่อให้แน่ใจว่าการเคลื่อนไหวจะถูกมองเห็นเป็นเวลาอย่างน้อย 5 วินาที
-        time.sleep(5 - elapsed_time)
+        return 5 - elapsed_time
+    return 0
+
+def schedule_delayed_call(delay, func, *args):
+    """เรียกฟังก์ชันหลังจากเวลาที่กำหนดโดยไม่บล็อกเธรดปัจจุบัน"""
+    # กำลังปิดแอป: ทำทันที เพราะ scheduler และ timer จะไม่อยู่รอจนถึงเวลา
+    if delay <= 0 or _CLEANED.is_set():
+        func(*args)
+        return
+
+    try:
+        if scheduler.running:
+            scheduler.add_job(
+                func,
+                'date',
+                run_date=datetime.now() + timedelta(seconds=delay),
+                args=list(args),
+                misfire_grace_time=30,
+            )
+            return
+    except Exception as e:
+        logging.warning(f"ไม่สามารถตั้งเวลางานผ่าน scheduler: {str(e)}")
+
+    # scheduler ยังไม่ทำงาน ใช้ timer แทนการ sleep บนเธรดที่รับงาน
+    timer = threading.Timer(delay, func, args=args)
+    timer.daemon = True
+    timer.start()
+
+def _schedule_final_delivery(delay, *args):
+    """ตั้งเวลาส่งคำตอบสุดท้าย โดยนับเป็นงานค้างจนกว่าจะส่งเสร็จ ตอนปิดแอปจึงรอส่งก่อน"""
+    global _running_messages
+    with _active_locks_lock:
+        _running_messages += 1
+    schedule_delayed_call(delay, _deliver_scheduled_response, *args)
+
+def _deliver_scheduled_response(*args):
+    """ส่งคำตอบที่ตั้งเวลาไว้ แล้วลดจำนวนงานค้าง"""
+    global _running_messages
+    try:
+        deliver_final_response(*args)
+    finally:
+        with _active_locks_lock:
+            _running_messages -= 1
+
+def _flush_scheduled_responses():
+    """เลื่อนคำตอบที่หน่วงไว้ใน scheduler ให้ส่งทันที (ใช้ตอนปิดแอป)"""
+    if not scheduler.running:
+        return
+    now = datetime.now()
+    for job in scheduler.get_jobs():
+        if job.func is _deliver_scheduled_response:
+            try:
+                job.modify(next_run_time=now)
+            except Exception as e:
+                logging.warning(f"ไม่สามารถเลื่อนเวลาส่งคำตอบ {job.id}: {str(e)}")
+
+def deliver_final_response(user_id, user_message, bot_response, reply_token, used_fallback, error_occurred):
+    """ส่งคำตอบสุดท้ายให้ผู้ใช้พร้อมการแจ้งเตือนระบบที่เกี่ยวข้อง"""
+    try:
+        success = send_final_response(user_id, bot_response, reply_token=reply_token)
+        if not success:
+            raise create_legacy_chatbot_error(
+                ErrorType.MESSAGE_SEND_ERROR,
+                "Failed to send response to user"
+            )
+
+        # ถ้าใช้ fallback หรือมี error แจ้งให้ผู้ใช้ทราบ
+        if used_fallback or error_occurred:
+            send_system_notification(user_id, used_fallback, error_occurred)
+
+    except Exception as e:
+        logging.critical(f"ไม่สามารถส่งข้อความให้ผู้ใช้ {user_id}: {str(e)}")
+        # นี่คือ critical error - ผู้ใช้จะไม่ได้รับการตอบกลับเลย
+        notify_admin_critical_error(user_id, user_message, str(e))
 
 @safe_api_call
 def generate_ai_response(messages) -> str:
     """สร้างการตอบกลับด้วย AI โดยมีการจัดการข้อผิดพลาด (xAI Grok)"""
     try:
-        filtered_messages = filter_messages_for_api(messages)
+        filtered_messages = with_system_prompt(filter_messages_for_api(messages))
         text = grok_client.send_chat(
-            messages=[SYSTEM_MESSAGES] + filtered_messages,
+            messages=filtered_messages,
             model=config.XAI_MODEL,
             **GENERATION_CONFIG,
         )
@@ -2356,12 +3064,16 @@ def generate_ai_response(messages) -> str:
 @app.route("/callback", methods=['POST'])
 @limiter.limit("10/minute")
 def callback():
+    # กำลังปิดแอป: ไม่รับ webhook ใหม่ระหว่างรองานที่ค้าง
+    if _CLEANED.is_set():
+        abort(503)
+
     # รับค่า X-Line-Signature header
     signature = request.headers['X-Line-Signature']
 
     # รับเนื้อหาคำขอเป็นข้อความ
     body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
+    app.logger.debug("Request body: %s", body)
 
     try:
         handler.handle(body, signature)
@@ -2388,11 +3100,19 @@ def add_verification_code():
         return jsonify({"success": False, "error": "Invalid verification code"}), 400
     
     try:
-        # ตรวจสอบว่ารหัสมีอยู่แล้วหรือไม่
-        check_query = 'SELECT code FROM registration_codes WHERE code = %s'
-        result = db_manager.execute_query(check_query, (code,))
-        
-        if result and result[0]:
+        # จองรหัสก่อนเรียก AI (form_data ยังเป็น NULL) เพื่อไม่ให้คำขอซ้ำเสียค่าสรุปข้อมูล
+        # code เป็น PRIMARY KEY: ถ้ามีอยู่แล้วจะไม่มีแถวถูกเปลี่ยน (rowcount = 0) จึงไม่มีช่องว่างระหว่างตรวจสอบกับบันทึก
+        insert_query = '''
+            INSERT INTO registration_codes 
+            (code, created_at, status) 
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE code = code
+        '''
+        inserted = db_manager.execute_and_commit(
+            insert_query, 
+            (code, datetime.now(), 'pending')
+        )
+        if not inserted:
             return jsonify({"success": False, "error": "Code already exists"}), 409
         
         # สรุปข้อมูลด้วย AI
@@ -2408,15 +3128,10 @@ def add_verification_code():
             "processed_at": datetime.now().isoformat()
         }
         
-        # บันทึกรหัสใหม่พร้อมข้อมูล form และสรุป
-        insert_query = '''
-            INSERT INTO registration_codes 
-            (code, created_at, status, form_data) 
-            VALUES (%s, %s, %s, %s)
-        '''
+        # บันทึกข้อมูล form และสรุปลงในรหัสที่จองไว้
         db_manager.execute_and_commit(
-            insert_query, 
-            (code, datetime.now(), 'pending', json.dumps(form_data_json))
+            'UPDATE registration_codes SET form_data = %s WHERE code = %s',
+            (json.dumps(form_data_json), code)
         )
         
         logging.info(f"บันทึกรหัสยืนยันและข้อมูล form สำเร็จ: {code}")
@@ -2430,21 +3145,7 @@ def add_verification_code():
         logging.error(f"เกิดข้อผิดพลาดในการบันทึกรหัสยืนยัน: {str(e)}")
         return jsonify({"success": False, "error": str(e)}), 500
 
-def check_redis_health():
-    """ตรวจสอบการเชื่อมต่อ Redis"""
-    try:
-        return redis_client.ping()
-    except Exception:
-        return False
-
-def check_mysql_health():
-    """ตรวจสอบการเชื่อมต่อ MySQL"""
-    try:
-        return db_manager.check_connection()
-    except Exception as e:
-        logging.error(f"MySQL health check failed: {str(e)}")
-        return False
-
+@cache_api_health_result
 def check_line_api_health():
     """ตรวจสอบการเชื่อมต่อ LINE API"""
     try:
@@ -2454,15 +3155,11 @@ def check_line_api_health():
     except Exception:
         return False
 
+@cache_api_health_result
 def check_grok_api_health():
-    """ตรวจสอบการเชื่อมต่อ xAI Grok API"""
+    """ตรวจสอบการเชื่อมต่อ xAI Grok API (เรียก endpoint รายการโมเดล ไม่เสียค่าโทเค็น)"""
     try:
-        _ = grok_client.send_chat(
-            messages=[{"role": "user", "content": "ping"}],
-            model=config.XAI_MODEL,
-            max_tokens=1,
-        )
-        return True
+        return grok_client.ping(timeout=2)
     except Exception as e:
         logging.debug(f"xAI Grok API health check failed: {str(e)}")
         return False
@@ -2470,8 +3167,9 @@ def check_grok_api_health():
 def get_uptime():
     """ดึงเวลาการทำงานของแอปพลิเคชัน"""
     try:
-        with open('/proc/uptime', 'r') as f:
-            uptime_seconds = float(f.readline().split()[0])
+        # อ่านแบบ bytes ครั้งเดียว float() รับ bytes ได้โดยไม่ต้อง decode
+        with open('/proc/uptime', 'rb') as f:
+            uptime_seconds = float(f.read(32).split()[0])
 
         days, remainder = divmod(uptime_seconds, 86400)
         hours, remainder = divmod(remainder, 3600)
@@ -2486,19 +3184,219 @@ def get_uptime():
     except Exception:
         return "unknown"
 
-def get_memory_usage():
-    """ดึงข้อมูลการใช้หน่วยความจำ"""
+# ปิดการวัดหน่วยความจำทั้งหมดได้ด้วย ENABLE_MEM_METRICS=0
+_MEM_ENABLED = os.getenv('ENABLE_MEM_METRICS', '1') == '1'
+
+# แคชค่าการใช้หน่วยความจำล่าสุด เพื่อไม่ให้อ่าน /proc ทุกครั้งที่ถูกเรียก
+_MEM_TTL = 2.0  # วินาที
+_MEM_CACHE = (0.0, None)  # (เวลา monotonic ที่อ่าน, VmRSS เป็น kB หรือ None)
+_MEM_CACHE_LOCK = threading.Lock()
+
+# file descriptor ของ /proc/self/status ที่เปิดค้างไว้ อ่านซ้ำด้วย pread จาก offset 0
+_STATUS_FD = None
+# ตำแหน่งไบต์ของบรรทัด VmRSS จากการอ่านครั้งล่าสุด (รูปแบบไฟล์คงที่บน kernel เดียวกัน)
+_VMRSS_OFFSET = None
+
+def _get_status_fd():
+    """คืน fd ของ /proc/self/status โดยเปิดครั้งแรกเมื่อถูกเรียก"""
+    global _STATUS_FD
+    if _STATUS_FD is None:
+        _STATUS_FD = os.open('/proc/self/status', os.O_RDONLY)
+    return _STATUS_FD
+
+def _close_status_fd():
+    """ปิด fd ของ /proc/self/status ถ้าเปิดอยู่"""
+    global _STATUS_FD, _VMRSS_OFFSET
+    fd, _STATUS_FD = _STATUS_FD, None
+    _VMRSS_OFFSET = None
+    if fd is not None:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+# /proc/self ถูกผูกกับ process ตอนเปิด โปรเซสลูกหลัง fork ต้องเปิด fd ของตัวเองใหม่
+# (และล้างตำแหน่ง VmRSS ที่จำไว้)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_close_status_fd)
+
+def _read_vmrss_kb():
+    """อ่านค่า VmRSS (kB) จาก /proc/self/status คืน None หากอ่านไม่ได้"""
+    global _VMRSS_OFFSET
+    try:
+        fd = _get_status_fd()
+        # อ่านเฉพาะบรรทัด VmRSS จากตำแหน่งเดิม หากยังตรงกันไม่ต้องสแกนทั้งไฟล์
+        offset = _VMRSS_OFFSET
+        if offset is not None:
+            line = os.pread(fd, 64, offset)
+            if line.startswith(b'VmRSS:'):
+                memory_kb = _parse_vmrss_kb(line, 0)
+                if memory_kb is not None:
+                    return memory_kb
+        buf = os.pread(fd, 4096, 0)
+    except (OSError, AttributeError):
+        # ไม่มี /proc หรือ os.pread (เช่น ระบบที่ไม่ใช่ Linux) ใช้การเปิดไฟล์แบบเดิม
+        _close_status_fd()
+        return _read_vmrss_kb_from_file()
+
+    idx = buf.find(b'VmRSS:')
+    _VMRSS_OFFSET = idx if idx != -1 else None
+    return _parse_vmrss_kb(buf, idx)
+
+def _read_vmrss_kb_from_file():
+    """อ่านค่า VmRSS (kB) ด้วยการเปิดไฟล์ใหม่ทุกครั้ง"""
     try:
         # ใช้ /proc/self/status แทน psutil
-        with open('/proc/self/status', 'r') as f:
-            for line in f:
-                if 'VmRSS:' in line:
-                    # แปลงจาก kB เป็น MB
-                    memory_kb = int(line.split()[1])
-                    return f"{memory_kb / 1024:.2f} MB"
-        return "unknown"
+        with open('/proc/self/status', 'rb') as f:
+            return _parse_vmrss_kb(f.read())
     except Exception:
+        return None
+
+def _parse_vmrss_kb(buf, idx=None):
+    """หาค่า VmRSS ในเนื้อหาไฟล์ status ด้วย bytes.find (หรือจากตำแหน่ง idx ที่ทราบแล้ว)"""
+    if idx is None:
+        idx = buf.find(b'VmRSS:')
+    if idx == -1:
+        return None
+    # บรรทัดมีรูปแบบ "VmRSS:\t   12345 kB" int() รับ bytes ที่มีช่องว่างรอบตัวเลขได้โดยตรง
+    # จึงตัดเฉพาะช่วงตัวเลขโดยไม่ต้อง split/decode
+    end = buf.find(b' kB', idx)
+    if end == -1:
+        return None
+    try:
+        return int(buf[idx + 6:end])
+    except ValueError:
+        return None
+
+# เธรดเบื้องหลังที่อัปเดตค่าหน่วยความจำเป็นระยะ ผู้เรียกเพียงอ่านค่าจากแคช
+# ช่วงเวลาอ่านปรับตามการเปลี่ยนแปลง: ลดลงครึ่งหนึ่งเมื่อค่าเปลี่ยนเกิน 1%
+# และเพิ่มเป็นสองเท่าเมื่อค่าคงที่ติดต่อกัน 3 รอบ
+_MEM_POLL_INTERVAL = 10  # วินาที (ค่าเริ่มต้น)
+_MEM_POLL_MIN_INTERVAL = 5
+_MEM_POLL_MAX_INTERVAL = 60
+_MEM_POLL_CHANGE_RATIO = 0.01
+_MEM_POLL_QUIET_ROUNDS = 3
+_MEM_POLL_STOP = threading.Event()
+_mem_poll_thread = None
+
+def _poll_memory_usage():
+    """อัปเดตแคชการใช้หน่วยความจำจนกว่าจะได้รับสัญญาณหยุด"""
+    global _MEM_CACHE
+    interval = _MEM_POLL_INTERVAL
+    previous_kb = None
+    quiet_rounds = 0
+    while True:
+        memory_kb = _read_vmrss_kb()
+        _MEM_CACHE = (time.monotonic(), memory_kb)
+
+        if memory_kb is not None and previous_kb:
+            if abs(memory_kb - previous_kb) / previous_kb > _MEM_POLL_CHANGE_RATIO:
+                interval = max(_MEM_POLL_MIN_INTERVAL, interval / 2)
+                quiet_rounds = 0
+            else:
+                quiet_rounds += 1
+                if quiet_rounds >= _MEM_POLL_QUIET_ROUNDS:
+                    interval = min(_MEM_POLL_MAX_INTERVAL, interval * 2)
+                    quiet_rounds = 0
+        previous_kb = memory_kb
+
+        if _MEM_POLL_STOP.wait(interval):
+            break
+
+def start_memory_poller():
+    """เริ่มเธรดอ่านค่าหน่วยความจำเบื้องหลัง (เรียกซ้ำได้อย่างปลอดภัย)"""
+    global _mem_poll_thread
+    if not _MEM_ENABLED:
+        return
+    if _mem_poll_thread is not None and _mem_poll_thread.is_alive():
+        return
+    _MEM_POLL_STOP.clear()
+    _mem_poll_thread = threading.Thread(target=_poll_memory_usage, name="memory-poller", daemon=True)
+    _mem_poll_thread.start()
+
+def stop_memory_poller():
+    """ส่งสัญญาณให้เธรดอ่านค่าหน่วยความจำหยุดทำงาน"""
+    _MEM_POLL_STOP.set()
+
+def get_memory_usage_kb() -> Optional[int]:
+    """ดึงค่า VmRSS เป็น kB (จากเธรดเบื้องหลัง หรือแคชไว้ _MEM_TTL วินาที)"""
+    global _MEM_CACHE
+    if not _MEM_ENABLED:
+        return None
+    read_at, memory_kb = _MEM_CACHE
+    if _mem_poll_thread is not None and _mem_poll_thread.is_alive():
+        return memory_kb
+
+    now = time.monotonic()
+    if now - read_at < _MEM_TTL:
+        return memory_kb
+
+    with _MEM_CACHE_LOCK:
+        # เธรดอื่นอาจอัปเดตแคชไปแล้วระหว่างรอล็อค
+        read_at, memory_kb = _MEM_CACHE
+        if now - read_at < _MEM_TTL:
+            return memory_kb
+        memory_kb = _read_vmrss_kb()
+        _MEM_CACHE = (time.monotonic(), memory_kb)
+        return memory_kb
+
+def get_memory_usage_mb() -> Optional[float]:
+    """ดึงการใช้หน่วยความจำเป็น MB (ตัวเลข) ให้ผู้เรียกจัดรูปแบบเองเมื่อจำเป็น"""
+    memory_kb = get_memory_usage_kb()
+    if memory_kb is None:
+        return None
+    return memory_kb / 1024.0
+
+def get_memory_usage():
+    """ดึงข้อมูลการใช้หน่วยความจำเป็นข้อความ (คงไว้เพื่อความเข้ากันได้)"""
+    if not _MEM_ENABLED:
+        return "disabled"
+    memory_mb = get_memory_usage_mb()
+    if memory_mb is None:
         return "unknown"
+    return f"{memory_mb:.2f} MB"
+
+# thread pool สำหรับประมวลผลข้อความ (เรียก LLM) แยกจากเธรดของ WSGI server
+_WORK_POOL = ThreadPoolExecutor(max_workers=MESSAGE_WORKERS, thread_name_prefix="message-worker")
+# thread pool สำหรับดึงบริบทผู้ใช้ไปพร้อมกับการโหลดเซสชันและประวัติการสนทนา
+_CONTEXT_POOL = ThreadPoolExecutor(max_workers=MESSAGE_WORKERS, thread_name_prefix="context-prefetch")
+# thread pool สำหรับเรียก LINE loading animation ระหว่างเตรียมบริบทการสนทนา
+_LOADING_POOL = ThreadPoolExecutor(max_workers=LOADING_WORKERS, thread_name_prefix="loading-animation")
+
+def _handle_verify_command(event, user_id, user_message):
+    """ยืนยันรหัสลงทะเบียนจากคำสั่ง /verify"""
+    # แยกรหัสยืนยันออกจากข้อความก่อน (ทำในเครื่อง ไม่ต้องใช้ Redis)
+    confirmation_code = parse_verify_code(user_message)
+    if confirmation_code is None:
+        line_bot_api.reply_message(event.reply_token, _MSG_VERIFY_FORMAT)
+        return
+
+    # ตรวจสอบการลงทะเบียนและจำกัดความถี่การลองรหัสใน Redis รอบเดียว
+    registered, allowed = check_registration_and_verify_lock(user_id)
+    if registered:
+        line_bot_api.reply_message(event.reply_token, _MSG_ALREADY_REGISTERED)
+        return
+    if not allowed:
+        line_bot_api.reply_message(event.reply_token, _MSG_VERIFY_WAIT)
+        return
+
+    _, message = register_user_with_code(user_id, confirmation_code)
+    line_bot_api.reply_message(
+        event.reply_token,
+        TextSendMessage(text=message)
+    )
+
+def _handle_register_command(event, user_id, user_message):
+    """ส่งลิงก์ลงทะเบียนใหม่ให้ผู้ใช้"""
+    send_registration_message(user_id)
+
+# คำสั่งที่จัดการทันทีใน webhook โดยไม่ผ่าน thread pool
+_WEBHOOK_COMMANDS = {
+    '/verify': _handle_verify_command,
+    '/register': _handle_register_command,
+}
+# ความยาวส่วนหัวข้อความที่ใช้ตรวจหาคำสั่ง (คำสั่งที่ยาวที่สุดบวกช่องว่าง 1 ตัว)
+_WEBHOOK_COMMAND_HEAD = max(len(c) for c in _WEBHOOK_COMMANDS) + 1
 
 # ตัวจัดการเหตุการณ์
 @handler.add(MessageEvent, message=TextMessage)
@@ -2506,97 +3404,152 @@ def handle_message(event):
     user_id = event.source.user_id
     user_message = event.message.text
 
-    # ตรวจสอบว่าเป็นการยืนยันรหัสด้วย /verify หรือไม่
-    if user_message.lower().startswith("/verify"):
-        # ตรวจสอบว่าผู้ใช้ลงทะเบียนแล้วหรือไม่
-        if is_user_registered(user_id):
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="✅ คุณได้ลงทะเบียนและยืนยันตัวตนเรียบร้อยแล้ว\n"
-                                    "ไม่จำเป็นต้องยืนยันอีกครั้ง คุณสามารถใช้บริการของน้องใจดีได้ตามปกติ")
-            )
-            return
-
-        # ดำเนินการต่อสำหรับผู้ที่ยังไม่ได้ลงทะเบียน
-        try:
-            # แยกรหัสยืนยันออกจากข้อความ
-            parts = user_message.split()
-            if len(parts) != 2:
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text="รูปแบบไม่ถูกต้อง กรุณาพิมพ์ \"/verify\" ตามด้วยรหัส 6 หลัก เช่น \"/verify 123456\"")
-                )
-                return
+    # ปฏิเสธข้อความที่ยาวผิดปกติทันที ก่อนใช้ Redis, ฐานข้อมูล หรือ LLM
+    if len(user_message) > MAX_USER_MESSAGE_LENGTH:
+        line_bot_api.reply_message(event.reply_token, _MSG_TOO_LONG)
+        return
 
-            confirmation_code = parts[1].strip()
-            _, message = register_user_with_code(user_id, confirmation_code)
+    # ตรวจหาคำสั่งจากส่วนหัวของข้อความเท่านั้น ไม่ต้องแปลงตัวพิมพ์ทั้งข้อความ
+    if user_message[:1] == '/':
+        head = user_message[:_WEBHOOK_COMMAND_HEAD].lower()
+        handler_func = _WEBHOOK_COMMANDS.get(head.split(None, 1)[0])
+        if handler_func is not None:
+            return handler_func(event, user_id, user_message)
 
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=message)
-            )
-            return
-        except (IndexError, ValueError):
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="รูปแบบไม่ถูกต้อง กรุณาพิมพ์ \"/verify\" ตามด้วยรหัส 6 หลัก เช่น \"/verify 123456\"")
-            )
-            return
-
-    # คำสั่งขอลิงก์ลงทะเบียนใหม่
-    if user_message.lower() == "/register":
-        send_registration_message(user_id)
+    # ส่งการตรวจสอบการลงทะเบียนและการประมวลผลไปยัง thread pool
+    # เพื่อให้ webhook ตอบกลับ LINE ได้ทันทีโดยไม่รอ Redis/MySQL
+    try:
+        future = _WORK_POOL.submit(
+            process_incoming_message, user_id, user_message, event.reply_token,
+            getattr(event, 'webhook_event_id', None),
+        )
+    except RuntimeError as e:
+        # pool ถูกปิดแล้ว (ระหว่างปิดแอป)
+        logging.error(f"ไม่สามารถส่งงานประมวลผลข้อความของผู้ใช้ {user_id}: {str(e)}")
         return
 
-    # ตรวจสอบการลงทะเบียนก่อนประมวลผลข้อความปกติ
-    if not is_user_registered(user_id):
-        # ตรวจสอบว่าเคยส่งข้อความลงทะเบียนแล้วหรือไม่
-        registration_sent = redis_client.exists(f"registration_sent:{user_id}")
+    # จำงานที่รอคิวไว้ ตอนปิดแอปจะรอให้ทำงาน และแจ้งผู้ใช้หากต้องยกเลิกเมื่อหมดเวลา
+    with _active_locks_lock:
+        _queued_messages[future] = user_id
+    future.add_done_callback(_forget_queued_message)
+
+def process_incoming_message(user_id, user_message, reply_token, event_id=None):
+    """ตรวจสอบการลงทะเบียนและล็อคผู้ใช้ แล้วประมวลผลข้อความ (ทำงานใน thread pool)"""
+    global _running_messages
+    # นับงานที่เริ่มแล้ว ตอนปิดแอปจะรอจนงานเหล่านี้จบ (รวมช่วงก่อนได้ล็อค)
+    with _active_locks_lock:
+        _running_messages += 1
+    try:
+        _process_incoming_message(user_id, user_message, reply_token, event_id)
+    finally:
+        with _active_locks_lock:
+            _running_messages -= 1
 
-        if not registration_sent:
-            send_registration_message(user_id)
-            # เก็บสถานะว่าส่งข้อความลงทะเบียนแล้ว (หมดอายุใน 1 วัน)
-            redis_client.setex(f"registration_sent:{user_id}", 86400, "1")
-        else:
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="คุณยังไม่ได้ลงทะเบียน กรุณาลงทะเบียนก่อนใช้งาน พิมพ์ /register เพื่อดูวิธีลงทะเบียน")
-            )
-        return
+def _process_incoming_message(user_id, user_message, reply_token, event_id):
+    try:
+        # ตรวจสอบการลงทะเบียน ล็อคผู้ใช้ และกันเหตุการณ์ซ้ำ (SET NX) ใน Redis รอบเดียว
+        registered, lock_token, duplicate = check_registration_and_lock(user_id, event_id)
+        if duplicate:
+            # LINE ส่ง webhook เดิมซ้ำ (เช่น ตอบกลับไม่ทันเวลา) ไม่ต้องเรียก LLM อีกรอบ
+            logging.info(f"ข้าม webhook event ซ้ำ {event_id} ของผู้ใช้ {user_id}")
+            return
+        if not registered:
+            # จองสถานะ "ส่งข้อความลงทะเบียนแล้ว" (หมดอายุใน 1 วัน) ด้วย SET NX EX คำสั่งเดียว
+            # หากโปรเซสนี้รู้อยู่แล้วว่าส่งไปแล้ว ข้ามการเรียก Redis
+            registration_key = f"registration_sent:{user_id}"
+            if not _registration_sent_cache.get(user_id) and redis_client.set(registration_key, "1", nx=True, ex=86400):
+                try:
+                    send_registration_message(user_id)
+                except Exception:
+                    # ส่งไม่สำเร็จ: คืนสถานะเพื่อให้ข้อความถัดไปส่งใหม่ได้
+                    redis_client.delete(registration_key)
+                    raise
+                _registration_sent_cache.set(user_id, True)
+            else:
+                _registration_sent_cache.set(user_id, True)
+                line_bot_api.reply_message(reply_token, _MSG_NOT_REGISTERED_HINT)
+            return
 
-    # ถ้าลงทะเบียนแล้ว ดำเนินการปกติ
-    if is_user_locked(user_id):
-        handle_locked_user(user_id)
+        # ถ้าลงทะเบียนแล้วแต่ได้ล็อคไม่สำเร็จ แสดงว่ามีข้อความก่อนหน้ากำลังประมวลผลอยู่
+        if lock_token is None:
+            handle_locked_user(user_id)
+            return
+    except Exception as e:
+        logging.error(f"เกิดข้อผิดพลาดในการเตรียมประมวลผลข้อความของผู้ใช้ {user_id}: {str(e)}", exc_info=True)
         return
 
-    # ล็อคผู้ใช้และประมวลผลข้อความ
-    lock_user(user_id)
+    process_locked_message(user_id, user_message, reply_token, lock_token)
+
+# ล็อคที่งานประมวลผลข้อความในโปรเซสนี้ถืออยู่ {user_id: token} และจำนวนงานที่กำลังทำงาน
+# (รวมคำตอบที่ตั้งเวลาส่งไว้แต่ยังไม่ได้ส่ง)
+# ใช้ตอนปิดแอปเพื่อรองานที่ค้างและปลดล็อคที่เหลือ ผู้ใช้จึงไม่ถูกล็อคค้างจนหมดอายุหลังรีสตาร์ท
+_active_locks = {}
+_running_messages = 0
+_active_locks_lock = threading.Lock()
+# งานใน _WORK_POOL ที่ยังไม่จบ {future: user_id} (webhook ตอบ 200 ไปแล้ว LINE จึงไม่ส่งซ้ำ)
+_queued_messages = {}
+
+def _forget_queued_message(future):
+    with _active_locks_lock:
+        _queued_messages.pop(future, None)
+
+def process_locked_message(user_id, user_message, reply_token, lock_token):
+    """ประมวลผลข้อความของผู้ใช้ที่ถูกล็อคไว้แล้ว และปลดล็อคเมื่อเสร็จ"""
+    with _active_locks_lock:
+        _active_locks[user_id] = lock_token
     try:
-        process_user_message(user_id, user_message, event.reply_token)
+        process_user_message(user_id, user_message, reply_token)
+    except Exception as e:
+        logging.error(f"เกิดข้อผิดพลาดในการประมวลผลข้อความของผู้ใช้ {user_id}: {str(e)}", exc_info=True)
     finally:
-        unlock_user(user_id)
+        with _active_locks_lock:
+            _active_locks.pop(user_id, None)
+        unlock_user(user_id, lock_token)
+
+def _drain_active_locks(timeout):
+    """รองานประมวลผลข้อความที่ค้างไม่เกิน timeout วินาที แล้วยกเลิกงานที่ยังรอคิวและปลดล็อคของงานที่ยังไม่เสร็จ"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with _active_locks_lock:
+            if not _queued_messages and not _running_messages and not _active_locks:
+                return
+        time.sleep(0.1)
 
-@handler.add(FollowEvent)
-def handle_follow(event):
-    user_id = event.source.user_id
+    # หมดเวลา: ยกเลิกงานที่ยังรอคิว แล้วแจ้งผู้ใช้ให้ส่งข้อความใหม่ แทนการทิ้งไปเงียบ ๆ
+    with _active_locks_lock:
+        queued = list(_queued_messages.items())
+    cancelled = [user_id for future, user_id in queued if future.cancel()]
+    for user_id in dict.fromkeys(cancelled):
+        try:
+            line_bot_api.push_message(user_id, _MSG_RESEND_AFTER_RESTART)
+        except Exception as e:
+            logging.error(f"ไม่สามารถแจ้งผู้ใช้ {user_id} ให้ส่งข้อความใหม่: {str(e)}")
+    if cancelled:
+        logging.warning(f"ยกเลิกข้อความที่ยังรอคิว {len(cancelled)} รายการก่อนปิดแอป")
 
-    # ส่งข้อความต้อนรับและขอให้ลงทะเบียน
-    welcome_message = (
-        "ขอบคุณที่เพิ่มน้องใจดีเป็นเพื่อน! 👋\n\n"
-        "น้องใจดีพร้อมเป็นเพื่อนคุยและช่วยเหลือคุณในเรื่องการเลิกสารเสพติด\n\n"
-        "👉 ก่อนเริ่มต้นใช้งาน กรุณาลงทะเบียนตามขั้นตอนง่ายๆ"
-    )
+    with _active_locks_lock:
+        remaining = list(_active_locks.items())
+        _active_locks.clear()
+    for user_id, token in remaining:
+        unlock_user(user_id, token)
+    logging.warning(f"ปลดล็อคงานประมวลผลข้อความที่ยังไม่เสร็จ {len(remaining)} รายการก่อนปิดแอป")
 
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text=welcome_message)
-    )
-
-    # ส่งข้อความลงทะเบียนแบบ push message เพื่อให้แน่ใจว่าผู้ใช้ได้รับ
-    send_registration_message(user_id)
+@handler.add(FollowEvent)
+def handle_follow(event):
+    # ส่งข้อความต้อนรับและข้อความลงทะเบียนใน reply เดียว (LINE รับได้สูงสุด 5 ข้อความต่อครั้ง)
+    # ไม่ต้องเรียก push message แยกอีกรอบ
+    line_bot_api.reply_message(event.reply_token, [_MSG_WELCOME, _MSG_REGISTRATION])
 
 # เริ่มต้นตัวกำหนดการ
-scheduler = BackgroundScheduler()
+# งานติดตามผลรันใน executor เธรดเดียวแยกต่างหาก เพื่อไม่ให้รอบที่ใช้เวลานานแย่งเธรด
+# กับงานส่งคำตอบที่หน่วงเวลาไว้ และรวมรอบที่พลาดเป็นรอบเดียว (coalesce)
+scheduler = BackgroundScheduler(
+    executors={
+        'default': SchedulerThreadPoolExecutor(10),
+        'follow_ups': SchedulerThreadPoolExecutor(1),
+    },
+    job_defaults={'coalesce': True, 'max_instances': 1},
+)
 
 def shutdown_scheduler(wait=True, reason="unknown"):
     """�Դ��ǡ�˹���âͧ APScheduler ���ҧ��ʹ���"""
@@ -2613,27 +3566,78 @@ def shutdown_scheduler(wait=True, reason="unknown"):
 
 # เพิ่มงานตัวกำหนดการ
 def init_scheduler():
-    scheduler.add_job(check_and_send_follow_ups, 'interval', minutes=30)
+    # เรียกซ้ำได้ (เช่น reload) โดยไม่เริ่มตัวกำหนดการหรือเธรดอ่านหน่วยความจำซ้อน
+    if scheduler.running:
+        logging.debug("ตัวกำหนดการทำงานอยู่แล้ว ข้ามการเริ่มต้นซ้ำ")
+        return
+    scheduler.add_job(
+        check_and_send_follow_ups,
+        'interval',
+        minutes=30,
+        id='check_and_send_follow_ups',
+        executor='follow_ups',
+        replace_existing=True,
+    )
     scheduler.start()
     logging.info("ตัวกำหนดการเริ่มต้นแล้ว ตรวจสอบการติดตามทุก 30 นาที")
 
-    # การจัดการการปิดอย่างถูกต้อง
-    atexit.register(lambda: scheduler.shutdown())
+    # เริ่มเธรดอ่านค่าหน่วยความจำเบื้องหลัง
+    start_memory_poller()
+
+# ขั้นตอนปิดทรัพยากรเพียงจุดเดียว ใช้ร่วมกันทั้ง signal handler และ atexit
+_CLEANED = threading.Event()
+_CLEANUP_LOCK = threading.Lock()
+
+def _cleanup():
+    """ปิดทรัพยากรของแอปพลิเคชัน (เรียกซ้ำได้ แต่ทำงานจริงเพียงครั้งเดียว)"""
+    with _CLEANUP_LOCK:
+        if _CLEANED.is_set():
+            return
+        _CLEANED.set()
 
-# ตัวจัดการการปิดอย่างสง่างาม
-def handle_shutdown(sig=None, frame=None):
     logging.info("กำลังปิดแอปพลิเคชัน...")
 
-    # ปิดตัวกำหนดการ
+    # หยุดเธรดอ่านค่าหน่วยความจำ
+    stop_memory_poller()
+
+    # หยุดรับงานประมวลผลข้อความใหม่ (/callback ตอบ 503 ตั้งแต่ _CLEANED ถูกตั้ง LINE จึงส่งซ้ำได้)
+    # งานที่รอคิวอยู่ยังทำต่อระหว่างรอ เพราะ webhook ของงานเหล่านั้นตอบ 200 ไปแล้ว
+    try:
+        _WORK_POOL.shutdown(wait=False)
+        _HEALTH_POOL.shutdown(wait=False)
+    except Exception as e:
+        logging.error(f"เกิดข้อผิดพลาดในการปิด thread pool: {str(e)}")
+
+    # ส่งคำตอบที่หน่วงไว้ทันที แล้วรองานที่ค้างในเวลาจำกัด (ให้ทันระยะผ่อนผันของ container)
+    # จากนั้นปลดล็อคที่เหลือ
+    try:
+        _flush_scheduled_responses()
+        _drain_active_locks(SHUTDOWN_DRAIN_TIMEOUT)
+    except Exception as e:
+        logging.error(f"เกิดข้อผิดพลาดในการรองานประมวลผลข้อความ: {str(e)}")
+
+    # ปิดตัวกำหนดการหลังรองานเสร็จ คำตอบที่ตั้งเวลาไว้จึงถูกส่งก่อน
+    shutdown_scheduler(wait=False, reason="cleanup")
+
+    # pool ที่งานประมวลผลข้อความใช้ ปิดหลังรองานเสร็จ
+    try:
+        _LOADING_POOL.shutdown(wait=False)
+        _CONTEXT_POOL.shutdown(wait=False)
+        logging.info("ปิด thread pool ประมวลผลข้อความเรียบร้อย")
+    except Exception as e:
+        logging.error(f"เกิดข้อผิดพลาดในการปิด thread pool: {str(e)}")
+
+    _close_status_fd()
+
+    # หยุด event loop กลางที่ใช้เรียก Grok แบบ async
     try:
-        scheduler.shutdown()
-        logging.info("ปิดตัวกำหนดการเรียบร้อย")
+        grok_client.shutdown_event_loop()
     except Exception as e:
-        logging.error(f"เกิดข้อผิดพลาดในการปิดตัวกำหนดการ: {str(e)}")
+        logging.error(f"เกิดข้อผิดพลาดในการปิด event loop: {str(e)}")
 
-    # ปิดการเชื่อมต่อ Redis
+    # ปิดการเชื่อมต่อ Redis ทั้งหมดใน pool
     try:
-        redis_client.close()
+        redis_pool.disconnect()
         logging.info("ปิดการเชื่อมต่อ Redis เรียบร้อย")
     except Exception as e:
         logging.error(f"เกิดข้อผิดพลาดในการปิดการเชื่อมต่อ Redis: {str(e)}")
@@ -2645,13 +3649,66 @@ def handle_shutdown(sig=None, frame=None):
         logging.error(f"เกิดข้อผิดพลาดในการปิดการเชื่อมต่อ xAI Grok API: {str(e)}")
 
     logging.info("ปิดแอปพลิเคชันเรียบร้อย")
-    exit(0)
 
-signal.signal(signal.SIGTERM, handle_shutdown)
-signal.signal(signal.SIGINT, handle_shutdown)
+# ตัวจัดการการปิดอย่างสง่างาม
+def handle_shutdown(sig=None, frame=None):
+    _cleanup()
+    # ปิดทรัพยากรครบแล้ว ออกทันทีโดยไม่วนเข้าขั้นตอน finalization ของ Python ซ้ำ
+    os._exit(0)
+
+def install_shutdown_signal_handlers():
+    """ติดตั้งการรับ SIGTERM/SIGINT ผ่าน wakeup fd และเธรดเฝ้าสัญญาณ (เฉพาะเมื่อรันด้วย Waitress)
+
+    ไม่เรียกตอน import: gunicorn ติดตั้ง signal handler และ wakeup fd ของ worker เองก่อน import แอป
+    หากแทนที่จะข้าม graceful_timeout ของ gunicorn ในกรณีนั้นใช้ atexit เรียก _cleanup แทน
+
+    C-level signal handler เขียนหมายเลขสัญญาณลง pipe ทันที เธรดเฝ้าสัญญาณจึงเริ่มปิดแอปได้
+    โดยไม่ต้องรอ main thread ว่างพอจะรัน Python signal handler
+    """
+    shutdown_signals = (signal.SIGTERM, signal.SIGINT)
+    try:
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(write_fd, False)
+        signal.set_wakeup_fd(write_fd)
+    except (ValueError, OSError, AttributeError) as e:
+        # ไม่ได้อยู่ใน main thread หรือระบบไม่รองรับ ใช้ signal handler แบบเดิม
+        logging.debug(f"ใช้ signal handler แบบเดิม: {str(e)}")
+        for sig in shutdown_signals:
+            signal.signal(sig, handle_shutdown)
+        return
+
+    def _ignore_signal(sig, frame):
+        # งานจริงทำในเธรดเฝ้าสัญญาณ handler นี้มีไว้แทนพฤติกรรมเริ่มต้นที่จะหยุดโปรเซสทันที
+        pass
+
+    for sig in shutdown_signals:
+        signal.signal(sig, _ignore_signal)
+
+    def _watch_signals():
+        while True:
+            try:
+                data = os.read(read_fd, 1)
+            except OSError:
+                return
+            if data and data[0] in shutdown_signals:
+                handle_shutdown(data[0])
+
+    threading.Thread(target=_watch_signals, name="shutdown-signal-watcher", daemon=True).start()
+
+atexit.register(_cleanup)
 
 if __name__ == "__main__":
+    # Waitress ไม่จัดการสัญญาณปิดเอง จึงติดตั้ง handler ของแอป
+    install_shutdown_signal_handlers()
     # เริ่มต้นตัวกำหนดการก่อนเริ่มเซิร์ฟเวอร์
     init_scheduler()
-    # เริ่มเซิร์ฟเวอร์
-    serve(app, host='0.0.0.0', port=5000)
+    # เริ่มเซิร์ฟเวอร์ (import waitress เฉพาะตอนรันโดยตรง)
+    from waitress import serve
+    serve(
+        app,
+        host='0.0.0.0',
+        port=int(os.getenv('PORT', 5000)),
+        threads=int(os.getenv('THREADS', 16)),
+        connection_limit=int(os.getenv('CONN_LIMIT', 1000)),
+        asyncore_use_poll=True,
+    )
@@ -303,6 +303,13 @@ class ChatHistoryDB:
             return True
 
         try:
+            # นับโทเค็นของรายการที่ไม่ได้ระบุไว้ในการเรียกครั้งเดียว
+            missing = [conv for conv in conversations if not conv.get('token_count')]
+            counted = self.counter.count_tokens(
+                [conv['user_message'] + conv['bot_response'] for conv in missing]
+            ) if missing else []
+            missing_counts = {id(conv): count for conv, count in zip(missing, counted)}
+
             # Prepare batch values with optimized processing
             values = []
             for conv in conversations:
@@ -313,12 +320,8 @@ class ChatHistoryDB:
                         conv['user_message'], conv['bot_response']
                     )
 
-                # ถ้าไม่มีการระบุจำนวนโทเค็น ให้คำนวณ
-                token_count = conv.get('token_count', 0)
-                if not token_count:
-                    token_count = self.counter.count_tokens(
-                        conv['user_message'] + conv['bot_response']
-                    )
+                # ถ้าไม่มีการระบุจำนวนโทเค็น ใช้ค่าที่นับไว้แล้วด้านบน
+                token_count = conv.get('token_count') or missing_counts[id(conv)]
 
                 values.append((
                     conv['user_id'],
@@ -439,6 +442,37 @@ class ChatHistoryDB:
         result = self.db.execute_query(query, (user_id,))
         return result[0][0] or 0 if result and result[0] else 0
 
+    @safe_db_operation
+    def get_user_stats(self, user_id: str) -> Dict[str, Any]:
+        """
+        ดึงสถิติการสนทนาของผู้ใช้ทั้งหมดในคิวรีเดียว
+
+        Args:
+            user_id: LINE User ID
+
+        Returns:
+            Dict: history_count, important_count, last_interaction (string หรือ "ไม่มีข้อมูล") และ total_tokens
+        """
+        query = '''
+            SELECT
+                COUNT(*),
+                COALESCE(SUM(CASE WHEN important_flag THEN 1 ELSE 0 END), 0),
+                MAX(timestamp),
+                COALESCE(SUM(token_count), 0)
+            FROM conversations
+            WHERE user_id = %s
+        '''
+        result = self.db.execute_query(query, (user_id,))
+        row = result[0] if result else (0, 0, None, 0)
+
+        last_interaction = row[2]
+        return {
+            'history_count': int(row[0] or 0),
+            'important_count': int(row[1] or 0),
+            'last_interaction': last_interaction.strftime('%Y-%m-%d %H:%M:%S') if last_interaction else "ไม่มีข้อมูล",
+            'total_tokens': int(row[3] or 0),
+        }
+
     @safe_db_operation
     def clear_user_history(self, user_id: str) -> bool:
         """
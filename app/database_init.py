@@ -126,7 +126,8 @@ class DatabaseInitializer:
                 status ENUM('pending', 'verified', 'expired') DEFAULT 'pending',
                 form_data JSON,
                 INDEX idx_user_id (user_id),
-                INDEX idx_status (status)
+                INDEX idx_status (status),
+                INDEX idx_user_status (user_id, status)
             ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
         """
         self.db.execute_and_commit(query)
@@ -80,6 +80,15 @@ class DatabaseOptimizer:
                     ON registration_codes(status, created_at)
                 '''
             },
+            {
+                'table': 'registration_codes',
+                'index_name': 'idx_user_status',
+                'columns': '(user_id, status)',
+                'query': '''
+                    CREATE INDEX idx_user_status 
+                    ON registration_codes(user_id, status)
+                '''
+            },
             # Follow ups table additional indexes
             {
                 'table': 'follow_ups',
@@ -1,6 +1,10 @@
 import os
+import time
+import asyncio
 import logging
-from typing import Iterable, AsyncIterable, List, Dict, Any, Optional
+import threading
+from concurrent.futures import Future
+from typing import Iterable, AsyncIterable, Awaitable, List, Dict, Any, Optional, Tuple
 
 from openai import OpenAI, AsyncOpenAI
 from openai import (
@@ -15,19 +19,170 @@ from openai import (
 _DEFAULT_BASE_URL = "https://api.x.ai/v1"
 _DEFAULT_MODEL = os.getenv("XAI_MODEL", "grok-4")
 
+# Client-side throttling so bursts are smoothed before they reach xAI's limit
+_RATE_LIMIT_RETRIES = 3
+_RATE_LIMIT_BACKOFF = 1.0
+# Callers hold a 30s per-user message lock, so a single wait and the whole
+# retry sequence must both finish well inside it.
+_RATE_LIMIT_MAX_DELAY = 5.0
+_RATE_LIMIT_BUDGET = 15.0
+
+
+class TokenBucket:
+    """Thread-safe token bucket shared by sync and async callers.
+
+    ``reserve`` takes the tokens immediately (the balance may go negative)
+    and returns how long the caller must wait, so waiters queue fairly.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n: float = 1) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def refund(self, n: float = 1) -> None:
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + n)
+
+    def take(self, n: float = 1) -> None:
+        delay = self.reserve(n)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def atake(self, n: float = 1) -> None:
+        delay = self.reserve(n)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+_requests_per_minute = float(os.getenv("XAI_REQUESTS_PER_MINUTE", "300"))
+_bucket: Optional[TokenBucket] = (
+    TokenBucket(
+        rate=_requests_per_minute / 60.0,
+        capacity=float(os.getenv("XAI_REQUEST_BURST", "20")),
+    )
+    if _requests_per_minute > 0
+    else None
+)
+
+
+def _rate_limit_delay(error: RateLimitError, attempt: int) -> float:
+    """Honour Retry-After when xAI sends it, else back off exponentially (capped)."""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        delay = max(float(retry_after), 0.0)
+    except (TypeError, ValueError):
+        delay = _RATE_LIMIT_BACKOFF * (2 ** attempt)
+    return min(delay, _RATE_LIMIT_MAX_DELAY)
+
 
 def _get_sync_client(api_key: Optional[str] = None, base_url: Optional[str] = None) -> OpenAI:
+    # Retries are handled by our loop so every attempt goes through the bucket
     return OpenAI(
         api_key=api_key or os.getenv("XAI_API_KEY"),
         base_url=base_url or os.getenv("XAI_BASE_URL", _DEFAULT_BASE_URL),
+        max_retries=0,
     )
 
 
+# Shared background event loop. Async clients created on it keep their
+# HTTP connection pool for the life of the process instead of per asyncio.run().
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[threading.Thread] = None
+_loop_lock = threading.Lock()
+_loop_clients: Dict[Tuple[str, str], AsyncOpenAI] = {}
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Return the shared background event loop, starting it on first use."""
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(
+                target=_loop.run_forever, name="grok-event-loop", daemon=True
+            )
+            _loop_thread.start()
+        return _loop
+
+
+def submit(coro: Awaitable[Any]) -> Future:
+    """Schedule a coroutine on the shared loop and return a concurrent Future."""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+
+def run_coroutine(coro: Awaitable[Any], timeout: Optional[float] = None) -> Any:
+    """Run a coroutine on the shared loop and block until it finishes."""
+    return submit(coro).result(timeout)
+
+
+def shutdown_event_loop() -> None:
+    """Stop the shared loop if it was started."""
+    global _loop, _loop_thread
+    with _loop_lock:
+        loop, thread = _loop, _loop_thread
+        _loop, _loop_thread = None, None
+        _loop_clients.clear()
+    if loop is not None and loop.is_running():
+        loop.call_soon_threadsafe(loop.stop)
+        if thread is not None:
+            thread.join(timeout=5)
+
+
+def _reset_after_fork() -> None:
+    # The loop thread does not survive fork; the child starts its own on demand
+    global _loop, _loop_thread, _loop_lock
+    _loop, _loop_thread = None, None
+    _loop_lock = threading.Lock()
+    _loop_clients.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 def _get_async_client(api_key: Optional[str] = None, base_url: Optional[str] = None) -> AsyncOpenAI:
-    return AsyncOpenAI(
-        api_key=api_key or os.getenv("XAI_API_KEY"),
-        base_url=base_url or os.getenv("XAI_BASE_URL", _DEFAULT_BASE_URL),
-    )
+    key = api_key or os.getenv("XAI_API_KEY")
+    url = base_url or os.getenv("XAI_BASE_URL", _DEFAULT_BASE_URL)
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    # Only clients on the shared loop are reused; other loops may be short-lived
+    if running_loop is None or running_loop is not _loop:
+        return AsyncOpenAI(api_key=key, base_url=url, max_retries=0)
+    client = _loop_clients.get((key, url))
+    if client is None:
+        client = AsyncOpenAI(api_key=key, base_url=url, max_retries=0)
+        _loop_clients[(key, url)] = client
+    return client
+
+
+def ping(
+    *,
+    timeout: float = 2.0,
+    api_key: Optional[str] = None,
+    base_url: Optional[str] = None,
+) -> bool:
+    """Check that the API is reachable using the models endpoint.
+
+    Lists models instead of running a completion, so health probes cost no
+    tokens. Raises the client's error on failure.
+    """
+    client = _get_sync_client(api_key, base_url).with_options(timeout=timeout, max_retries=0)
+    client.models.list()
+    return True
 
 
 def send_chat(
@@ -66,12 +221,28 @@ def send_chat(
     if extra:
         params.update(extra)
 
-    try:
-        resp = client.chat.completions.create(**params)
-        return resp.choices[0].message.content
-    except (APITimeoutError, APIConnectionError, RateLimitError, APIStatusError) as e:
-        logging.error(f"xAI Grok chat error: {e}")
-        raise
+    attempt = 0
+    deadline = time.monotonic() + _RATE_LIMIT_BUDGET
+    while True:
+        if _bucket is not None:
+            _bucket.take()
+        try:
+            resp = client.chat.completions.create(**params)
+            return resp.choices[0].message.content
+        except RateLimitError as e:
+            delay = _rate_limit_delay(e, attempt)
+            if attempt >= _RATE_LIMIT_RETRIES or time.monotonic() + delay > deadline:
+                logging.error(f"xAI Grok chat error: {e}")
+                raise
+            # The rejected call was not served, so it should not cost a token
+            if _bucket is not None:
+                _bucket.refund()
+            logging.warning(f"xAI Grok rate limited, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+        except (APITimeoutError, APIConnectionError, APIStatusError) as e:
+            logging.error(f"xAI Grok chat error: {e}")
+            raise
 
 
 def stream_chat(
@@ -111,6 +282,8 @@ def stream_chat(
     if extra:
         params.update(extra)
 
+    if _bucket is not None:
+        _bucket.take()
     try:
         for chunk in client.chat.completions.create(**params):
             if not chunk.choices:
@@ -159,13 +332,28 @@ async def astream_chat(
     if extra:
         params.update(extra)
 
-    try:
-        resp = await client.chat.completions.create(**params)
-        # Do not close client explicitly; connection pool is reused by SDK.
-        return resp.choices[0].message.content
-    except (APITimeoutError, APIConnectionError, RateLimitError, APIStatusError) as e:
-        logging.error(f"xAI Grok async chat error: {e}")
-        raise
+    attempt = 0
+    deadline = time.monotonic() + _RATE_LIMIT_BUDGET
+    while True:
+        if _bucket is not None:
+            await _bucket.atake()
+        try:
+            resp = await client.chat.completions.create(**params)
+            # Do not close client explicitly; on the shared loop it is reused.
+            return resp.choices[0].message.content
+        except RateLimitError as e:
+            delay = _rate_limit_delay(e, attempt)
+            if attempt >= _RATE_LIMIT_RETRIES or time.monotonic() + delay > deadline:
+                logging.error(f"xAI Grok async chat error: {e}")
+                raise
+            if _bucket is not None:
+                _bucket.refund()
+            logging.warning(f"xAI Grok rate limited, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+        except (APITimeoutError, APIConnectionError, APIStatusError) as e:
+            logging.error(f"xAI Grok async chat error: {e}")
+            raise
 
 
 async def astream_chat_iter(
@@ -202,6 +390,8 @@ async def astream_chat_iter(
     if extra:
         params.update(extra)
 
+    if _bucket is not None:
+        await _bucket.atake()
     try:
         stream = await client.chat.completions.create(**params)
         async for chunk in stream:
@@ -1,9 +1,11 @@
 """Risk assessment utilities for the Jai Dee chatbot."""
-import json
 import logging
+from collections import Counter
 from datetime import datetime
 from typing import Dict, Tuple, List
 
+from .utils import KeywordMatcher, json_dumps, json_loads
+
 redis_client = None
 
 # คำสำคัญที่ใช้ประเมินความเสี่ยงจากข้อความของผู้ใช้
@@ -81,11 +83,31 @@ RISK_KEYWORDS = {
 # จำนวนคำความเสี่ยงระดับปานกลางที่จะยกระดับเป็นความเสี่ยงสูง
 MEDIUM_RISK_THRESHOLD = 2
 
+# Newest progress entries kept per user in progress:<user_id> (LPUSH + LTRIM).
+PROGRESS_HISTORY_LIMIT = 100
+
 GENERAL_RISK_LEVEL = 'general'
 LEGACY_LOW_RISK_LEVEL = 'low'
 LOW_RISK_LEVELS = {GENERAL_RISK_LEVEL, LEGACY_LOW_RISK_LEVEL}
 
 
+def _lowercase_keywords(keywords: List[str]) -> Tuple[str, ...]:
+    """คืนคำสำคัญที่เป็นตัวพิมพ์เล็กแล้วตามลำดับเดิม (คงคำที่ซ้ำไว้ เพราะนับรวมในเกณฑ์ความเสี่ยง)
+
+    ข้อความจะถูกแปลงเป็นตัวพิมพ์เล็กก่อนตรวจ คำที่มีตัวพิมพ์ใหญ่ (เช่น "OD", "MDMA", "LSD",
+    "E", "ยาX") จึงไม่เคยตรงกับข้อความใดเลย การตัดออกจึงไม่เปลี่ยนผลการประเมิน
+    """
+    return tuple(kw for kw in keywords if kw == kw.lower())
+
+
+# เตรียมคำสำคัญไว้ครั้งเดียวตอน import แทนการวนรายการดิบทุกข้อความ
+_HIGH_RISK_KEYWORDS = _lowercase_keywords(RISK_KEYWORDS["high_risk"])
+_MEDIUM_RISK_KEYWORDS = _lowercase_keywords(RISK_KEYWORDS["medium_risk"])
+
+# ตัวค้นหารวมของทุกคำ (คำความเสี่ยงสูงมาก่อน) สแกนข้อความเพียงรอบเดียว
+_RISK_MATCHER = KeywordMatcher(_HIGH_RISK_KEYWORDS + _MEDIUM_RISK_KEYWORDS)
+
+
 def normalize_risk_level(level: str) -> str:
     """Normalize risk level values, mapping legacy low risk to general."""
     normalized = (level or '').lower()
@@ -109,27 +131,25 @@ def assess_risk(message: str) -> Tuple[str, List[str]]:
     ระดับความเสี่ยงจะถูกยกระดับเป็น "high" หากพบคำความเสี่ยงระดับสูง
     หรือพบคำความเสี่ยงระดับปานกลางหลายคำในข้อความเดียวกัน
     """
-    message = message.lower()
-    matched_keywords: List[str] = []
+    found = set(_RISK_MATCHER.find_all(message.lower()))
+    if not found:
+        return GENERAL_RISK_LEVEL, []
 
+    # ไล่ตามรายการเดิม (รวมคำที่ซ้ำ) ผลลัพธ์และจำนวนคำจึงตรงกับการตรวจทีละคำ
     # ตรวจหาคำความเสี่ยงสูง
-    for keyword in RISK_KEYWORDS["high_risk"]:
-        if keyword in message:
-            matched_keywords.append(keyword)
-
+    matched_keywords = [kw for kw in _HIGH_RISK_KEYWORDS if kw in found]
     if matched_keywords:
         return "high", matched_keywords
 
     # ตรวจหาคำความเสี่ยงปานกลาง
-    medium_matches = [kw for kw in RISK_KEYWORDS["medium_risk"] if kw in message]
-    matched_keywords.extend(medium_matches)
+    medium_matches = [kw for kw in _MEDIUM_RISK_KEYWORDS if kw in found]
 
     if len(medium_matches) >= MEDIUM_RISK_THRESHOLD:
-        return "high", matched_keywords
+        return "high", medium_matches
     elif medium_matches:
-        return "medium", matched_keywords
+        return "medium", medium_matches
 
-    return GENERAL_RISK_LEVEL, matched_keywords
+    return GENERAL_RISK_LEVEL, medium_matches
 
 
 def save_progress_data(user_id: str, risk_level: str, keywords: List[str]) -> None:
@@ -141,8 +161,8 @@ def save_progress_data(user_id: str, risk_level: str, keywords: List[str]) -> No
             'risk_level': normalized_level,
             'keywords': keywords
         }
-        redis_client.lpush(f"progress:{user_id}", json.dumps(progress_data))
-        redis_client.ltrim(f"progress:{user_id}", 0, 99)
+        redis_client.lpush(f"progress:{user_id}", json_dumps(progress_data))
+        redis_client.ltrim(f"progress:{user_id}", 0, PROGRESS_HISTORY_LIMIT - 1)
     except Exception as e:
         logging.error(f"เกิดข้อผิดพลาดในการบันทึกความก้าวหน้า: {str(e)}")
 
@@ -154,21 +174,16 @@ def generate_progress_report(user_id: str) -> str:
         if not progress_data:
             return "ยังไม่มีข้อมูลความก้าวหน้า"
 
-        data = [json.loads(item) for item in progress_data]
-        for entry in data:
-            entry['risk_level'] = normalize_risk_level(entry.get('risk_level'))
-        risk_trends = {
-            'high': sum(1 for d in data if d['risk_level'] == 'high'),
-            'medium': sum(1 for d in data if d['risk_level'] == 'medium'),
-            'general': sum(1 for d in data if d['risk_level'] == GENERAL_RISK_LEVEL)
-        }
+        data = [json_loads(item) for item in progress_data]
+        # นับทุกระดับในรอบเดียว แทนการวนข้อมูลทั้งชุดแยกตามระดับ
+        risk_trends = Counter(normalize_risk_level(d.get('risk_level')) for d in data)
         report = (
             "📊 รายงานความก้าวหน้า\n\n"
             f"📅 ช่วงเวลา: {data[-1]['timestamp'][:10]} ถึง {data[0]['timestamp'][:10]}\n"
             f"📈 การประเมินความเสี่ยง:\n"
             f"▫️ ความเสี่ยงสูง: {risk_trends['high']} ครั้ง\n"
             f"▫️ ความเสี่ยงปานกลาง: {risk_trends['medium']} ครั้ง\n"
-            f"▫️ ข้อความทั่วไป: {risk_trends['general']} ข้อความ\n"
+            f"▫️ ข้อความทั่วไป: {risk_trends[GENERAL_RISK_LEVEL]} ข้อความ\n"
         )
         return report
     except Exception as e:
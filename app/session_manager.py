@@ -1,59 +1,88 @@
 """Session management utilities for the Jai Dee chatbot."""
-import json
 import logging
 from datetime import datetime
 from typing import List, Dict, Tuple
 
+from linebot.models import TextSendMessage
+
+from .config import SYSTEM_MESSAGES
+from .utils import KeywordMatcher, json_dumps, json_loads
+
 redis_client = None
 line_bot_api = None
 token_counter = None
 SESSION_TIMEOUT = 604800
 
+# KEYS: last_activity, timeout_warning; ARGV: now, warning threshold, session ttl
+# คืนค่า 1 เมื่อผู้เรียกต้องส่งข้อความแจ้งเตือน (ตั้งธงไว้แล้วภายในสคริปต์)
+TOUCH_ACTIVITY_LUA = """
+local last = redis.call('GET', KEYS[1])
+local warn = redis.call('GET', KEYS[2])
+local send = 0
+if last and (tonumber(ARGV[1]) - tonumber(last)) > tonumber(ARGV[2]) and not warn then
+    redis.call('SETEX', KEYS[2], 86400, '1')
+    send = 1
+end
+redis.call('SETEX', KEYS[1], tonumber(ARGV[3]), ARGV[1])
+return send
+"""
+_touch_activity_script = None
+
 def init_session_manager(redis_instance, line_api, token_counter_instance, session_timeout: int = 604800):
     """Initialize session manager dependencies."""
-    global redis_client, line_bot_api, token_counter, SESSION_TIMEOUT
+    global redis_client, line_bot_api, token_counter, SESSION_TIMEOUT, _touch_activity_script
     redis_client = redis_instance
     line_bot_api = line_api
     token_counter = token_counter_instance
     SESSION_TIMEOUT = session_timeout
+    _touch_activity_script = redis_instance.register_script(TOUCH_ACTIVITY_LUA)
 
 
-def get_chat_session(user_id: str) -> List[Dict[str, str]]:
-    """Retrieve chat session history from Redis."""
+def get_chat_session(user_id: str, include_system: bool = False) -> List[Dict[str, str]]:
+    """Retrieve chat session history from Redis.
+
+    When ``include_system`` is true the list always starts with ``SYSTEM_MESSAGES``
+    so it can be sent to the API without copying into a new list.
+    """
+    messages: List[Dict[str, str]] = [SYSTEM_MESSAGES] if include_system else []
     try:
         history = redis_client.get(f"chat_session:{user_id}")
         if history:
-            loaded_history = json.loads(history)
-            return [
+            loaded_history = json_loads(history)
+            messages.extend(
                 {"role": msg_data["role"], "content": msg_data["content"]}
                 for msg_data in loaded_history
-            ]
-        return []
+            )
+        return messages
     except Exception as e:  # redis.RedisError or others
         logging.error(f"Redis error in get_chat_session: {str(e)}")
-        return []
+        return [SYSTEM_MESSAGES] if include_system else []
 
 
 def save_chat_session(user_id: str, messages: List[Dict[str, str]]) -> None:
     """Save chat session history to Redis."""
     try:
         max_messages = 100
+        # ข้าม system prompt หลักที่ตรึงไว้ที่ตำแหน่งแรก ไม่ต้องเก็บลง Redis
+        start = 1 if messages and messages[0] is SYSTEM_MESSAGES else 0
         serialized_history = [
             {"role": msg["role"], "content": msg["content"]}
-            for msg in messages[-max_messages:]
+            for msg in messages[max(start, len(messages) - max_messages):]
         ]
         ttl_seconds = max(int(SESSION_TIMEOUT or 0), 60)
-        redis_client.setex(
+        token_count = token_counter.count_message_tokens(serialized_history)
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.setex(
             f"chat_session:{user_id}",
             ttl_seconds,
-            json.dumps(serialized_history),
+            json_dumps(serialized_history),
         )
-        token_count = token_counter.count_message_tokens(serialized_history)
-        redis_client.setex(
+        pipe.setex(
             f"session_tokens:{user_id}",
             ttl_seconds,
             str(token_count),
         )
+        pipe.execute()
         logging.debug(
             f"บันทึกเซสชัน: {len(serialized_history)} ข้อความ, {token_count} โทเค็น สำหรับผู้ใช้ {user_id}"
         )
@@ -66,8 +95,6 @@ def check_session_timeout(user_id: str) -> bool:
     try:
         last_activity = redis_client.get(f"last_activity:{user_id}")
         if last_activity:
-            if isinstance(last_activity, bytes):
-                last_activity = last_activity.decode("utf-8")
             last_activity_time = float(last_activity)
             if (datetime.now().timestamp() - last_activity_time) > SESSION_TIMEOUT:
                 redis_client.delete(f"chat_session:{user_id}")
@@ -81,37 +108,25 @@ def check_session_timeout(user_id: str) -> bool:
 
 
 def update_last_activity(user_id: str) -> None:
-    """Update last activity timestamp and send timeout warnings."""
+    """Update last activity timestamp and send timeout warnings.
+
+    The check-and-set runs atomically in Redis so concurrent webhooks for the
+    same user cannot both send the warning.
+    """
     try:
         current_time = datetime.now().timestamp()
-        last_activity = redis_client.get(f"last_activity:{user_id}")
-        warning_sent = redis_client.get(f"timeout_warning:{user_id}")
-
-        if isinstance(last_activity, bytes):
-            last_activity = last_activity.decode("utf-8")
-        if isinstance(warning_sent, bytes):
-            warning_sent = warning_sent.decode("utf-8")
-
-        if last_activity:
-            time_passed = current_time - float(last_activity)
-            if time_passed > (SESSION_TIMEOUT - 86400) and not warning_sent:
-                warning_message = (
-                    "⚠️ เซสชันของคุณจะหมดอายุในอีก 1 วัน\n"
-                    "หากต้องการคุยต่อ กรุณาพิมพ์ข้อความใดๆ เพื่อต่ออายุเซสชัน"
-                )
-                line_bot_api.push_message(user_id, TextSendMessage(text=warning_message))
-                redis_client.setex(
-                    f"timeout_warning:{user_id}",
-                    86400,
-                    "1",
-                )
-                logging.info(f"ส่งการแจ้งเตือนหมดเวลาเซสชันไปยังผู้ใช้: {user_id}")
-
-        redis_client.setex(
-            f"last_activity:{user_id}",
-            SESSION_TIMEOUT,
-            str(current_time),
+        send_warning = _touch_activity_script(
+            keys=[f"last_activity:{user_id}", f"timeout_warning:{user_id}"],
+            args=[repr(current_time), SESSION_TIMEOUT - 86400, SESSION_TIMEOUT],
         )
+
+        if int(send_warning or 0) == 1:
+            warning_message = (
+                "⚠️ เซสชันของคุณจะหมดอายุในอีก 1 วัน\n"
+                "หากต้องการคุยต่อ กรุณาพิมพ์ข้อความใดๆ เพื่อต่ออายุเซสชัน"
+            )
+            line_bot_api.push_message(user_id, TextSendMessage(text=warning_message))
+            logging.info(f"ส่งการแจ้งเตือนหมดเวลาเซสชันไปยังผู้ใช้: {user_id}")
     except Exception as e:
         logging.error(
             f"เกิดข้อผิดพลาดในการอัพเดทเวลาใช้งานล่าสุดสำหรับผู้ใช้ {user_id}: {str(e)}"
@@ -119,55 +134,49 @@ def update_last_activity(user_id: str) -> None:
 
 
 def get_session_token_count(user_id: str) -> int:
-    """Calculate token usage for the current session."""
+    """Return token usage for the current session.
+
+    ``save_chat_session`` writes the count together with the session and the
+    same TTL, so a missing count means there is no session to count.
+    """
     try:
         cached_count = redis_client.get(f"session_tokens:{user_id}")
-        if cached_count:
-            return int(cached_count)
-        session_data = redis_client.get(f"chat_session:{user_id}")
-        if not session_data:
-            return 0
-        messages = json.loads(session_data)
-        token_count = token_counter.count_message_tokens(messages)
-        ttl_seconds = max(int(SESSION_TIMEOUT or 0), 60)
-        redis_client.setex(
-            f"session_tokens:{user_id}",
-            ttl_seconds,
-            str(token_count),
-        )
-        return token_count
+        return int(cached_count) if cached_count else 0
     except Exception as e:
         logging.error(f"เกิดข้อผิดพลาดในการคำนวณโทเค็นของเซสชัน: {str(e)}")
         return 0
 
 
+# Stored lowercase so the text only needs lowering once per call.
+IMPORTANT_KEYWORDS = frozenset({
+    'ฆ่าตัวตาย', 'ทำร้ายตัวเอง', 'อยากตาย',
+    'overdose', 'เกินขนาด', 'ก้าวร้าว',
+    'ซึมเศร้า', 'วิตกกังวล', 'ความทรงจำ',
+    'ไม่มีความสุข', 'ทรมาน', 'เครียด',
+    'เลิก', 'หยุด', 'อดทน', 'ยา', 'เสพ',
+    'บำบัด', 'กลับไปเสพ', 'อาการ', 'ถอนยา'
+})
+_IMPORTANT_MATCHER = KeywordMatcher(sorted(IMPORTANT_KEYWORDS))
+
+
 def is_important_message(user_message: str, bot_response: str) -> bool:
     """Determine if a message pair is important."""
-    important_keywords = [
-        'ฆ่าตัวตาย', 'ทำร้ายตัวเอง', 'อยากตาย',
-        'overdose', 'เกินขนาด', 'ก้าวร้าว',
-        'ซึมเศร้า', 'วิตกกังวล', 'ความทรงจำ',
-        'ไม่มีความสุข', 'ทรมาน', 'เครียด',
-        'เลิก', 'หยุด', 'อดทน', 'ยา', 'เสพ',
-        'บำบัด', 'กลับไปเสพ', 'อาการ', 'ถอนยา'
-    ]
-    combined_text = (user_message + " " + bot_response).lower()
-    for keyword in important_keywords:
-        if keyword.lower() in combined_text:
-            return True
     if len(user_message) > 300 or len(bot_response) > 500:
         return True
-    return False
+    combined_text = (user_message + " " + bot_response).lower()
+    return _IMPORTANT_MATCHER.contains_any(combined_text)
 
 
 def hybrid_context_management(user_id: str, token_threshold: int) -> List[Dict[str, str]]:
-    """Manage conversation history to fit within the context window."""
+    """Manage conversation history to fit within the context window.
+
+    The cached token count is checked first; the session is only parsed once.
+    """
+    current_history: List[Dict[str, str]] = []
     try:
-        current_history = get_chat_session(user_id)
-        if not current_history:
-            return []
         current_tokens = get_session_token_count(user_id)
-        if current_tokens < token_threshold:
+        current_history = get_chat_session(user_id)
+        if not current_history or current_tokens < token_threshold:
             return current_history
         logging.info(
             f"เซสชันใกล้เต็ม context window ({current_tokens} tokens) สำหรับผู้ใช้ {user_id}, กำลังจัดการประวัติ..."
@@ -1,6 +1,7 @@
 import re
 import json
 import functools
+import hashlib
 from typing import Union, List, Dict, Any, Optional, Tuple
 import logging
 from collections import OrderedDict
@@ -69,6 +70,23 @@ class TokenCounter:
             self.use_tiktoken = False
             logging.info("Tiktoken not found, using approximate token counting")
 
+    @staticmethod
+    def _cache_key(text: str) -> bytes:
+        """
+        Fixed-size cache key for a text
+
+        A 16-byte BLAKE2b digest keeps the cache small however long the
+        messages are, and sessions re-parsed from JSON hash fresh str
+        objects every turn anyway, so keying on the text itself saves nothing
+
+        Args:
+            text: Text to build the key for
+
+        Returns:
+            Digest of the UTF-8 encoded text
+        """
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
     def count_tokens(self, text: Union[str, List[str]]) -> Union[int, List[int]]:
         """
         Count tokens in text or list of texts
@@ -80,9 +98,56 @@ class TokenCounter:
             Token count(s) for the input text(s)
         """
         if isinstance(text, list):
-            return [self._count_single_text(t) for t in text]
+            return self._count_batch(text)
         return self._count_single_text(text)
 
+    def _count_batch(self, texts: List[str]) -> List[int]:
+        """
+        Count tokens for several texts, encoding all cache misses in one call
+
+        With tiktoken the misses go through ``encode_batch`` so the whole
+        list crosses into the native tokenizer once instead of per text.
+
+        Args:
+            texts: List of text strings to count tokens for
+
+        Returns:
+            Token counts in the same order as the input
+        """
+        counts: List[Optional[int]] = []
+        misses: Dict[str, bytes] = {}
+        for text in texts:
+            if not text:
+                counts.append(0)
+                continue
+            text_key = self._cache_key(text)
+            cached_count = self.cache.get(text_key)
+            counts.append(cached_count)
+            if cached_count is None:
+                misses[text] = text_key
+
+        if not misses:
+            return counts
+
+        # Duplicates in one batch only need encoding once
+        unique_misses = list(misses)
+        if self.use_tiktoken:
+            encoded = self.tokenizer.encode_batch(unique_misses)
+            miss_counts = {
+                text: self._adjust_for_thai(text, len(tokens))
+                for text, tokens in zip(unique_misses, encoded)
+            }
+        else:
+            miss_counts = {text: self._count_with_heuristics(text) for text in unique_misses}
+
+        for text, token_count in miss_counts.items():
+            self.cache.put(misses[text], token_count)
+
+        return [
+            miss_counts[text] if count is None else count
+            for text, count in zip(texts, counts)
+        ]
+
     def _count_single_text(self, text: str) -> int:
         """
         Count tokens in a single text string with efficient caching
@@ -96,9 +161,9 @@ class TokenCounter:
         if not text:
             return 0
 
-        # Use a more robust hash for cache key
-        # Using first 100 chars + length as a reasonable compromise
-        text_key = hash((text[:100], len(text)))
+        # Key on a digest of the whole text: bounded memory per entry, and
+        # unlike a prefix+length key two different messages never collide
+        text_key = self._cache_key(text)
 
         # Check cache first
         cached_count = self.cache.get(text_key)
@@ -126,8 +191,19 @@ class TokenCounter:
             Adjusted token count
         """
         # Get base token count from tiktoken
-        token_count = len(self.tokenizer.encode(text))
+        return self._adjust_for_thai(text, len(self.tokenizer.encode(text)))
 
+    def _adjust_for_thai(self, text: str, token_count: int) -> int:
+        """
+        Scale a tiktoken count up by the share of Thai characters in the text
+
+        Args:
+            text: Text the count was taken from
+            token_count: Raw tiktoken count
+
+        Returns:
+            Adjusted token count
+        """
         # Apply consistent adjustment for Thai text
         has_thai = bool(self.thai_pattern.search(text))
         if has_thai:
@@ -205,20 +281,34 @@ class TokenCounter:
 
         # Process each message
         for message in messages:
-            # Count content tokens
-            content = message.get("content", "")
-            content_tokens = self.count_tokens(content)
-            base_tokens += content_tokens
+            base_tokens += self.count_message_tokens_single(message)
 
-            # Add role formatting overhead
-            role = message.get("role", "")
-            base_tokens += 4  # Standard role overhead
+        return base_tokens
 
-            # Extra tokens for system messages
-            if role == "system":
-                base_tokens += 2
+    def count_message_tokens_single(self, message: Dict[str, str]) -> int:
+        """
+        Count tokens for one message including its role overhead
 
-        return base_tokens
+        Content counts come from the LRU cache, so re-counting a session
+        only tokenizes messages that have not been seen before.
+
+        Args:
+            message: Message dictionary with 'role' and 'content'
+
+        Returns:
+            Token count before safety margin
+        """
+        # Count content tokens
+        tokens = self.count_tokens(message.get("content", ""))
+
+        # Add role formatting overhead
+        tokens += 4  # Standard role overhead
+
+        # Extra tokens for system messages
+        if message.get("role", "") == "system":
+            tokens += 2
+
+        return tokens
 
     def estimate_completion_tokens(self, prompt_tokens: int, max_output_tokens: int = 500) -> Tuple[int, int]:
         """
@@ -3,16 +3,120 @@
 รวมฟังก์ชันช่วยเหลือและเดโครเรเตอร์ต่างๆ
 """
 import functools
+import json
 import re
 import logging
 import traceback
 import time
+import threading
 import requests
-from typing import Callable, Any, TypeVar, cast, Dict
+from collections import OrderedDict
+from typing import Callable, Any, TypeVar, cast, Dict, Hashable, Iterable, List, Optional, Union
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # ตัวแปรประเภทสำหรับฟังก์ชัน
 F = TypeVar('F', bound=Callable[..., Any])
 
+class TTLCache:
+    """
+    แคชในหน่วยความจำแบบจำกัดขนาดและมีอายุ (LRU + TTL) ใช้งานข้ามเธรดได้
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 1.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        """คืนค่าที่ยังไม่หมดอายุ หรือ default"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if time.monotonic() >= expires_at:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """บันทึกค่าพร้อมเวลาหมดอายุ และลบรายการเก่าที่สุดเมื่อเกินขนาด"""
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        """ลบค่าออกจากแคช"""
+        with self._lock:
+            self._data.pop(key, None)
+
+class KeywordMatcher:
+    """
+    ค้นหาคำสำคัญหลายคำในข้อความด้วยการสแกนครั้งเดียว
+
+    ใช้ Aho-Corasick automaton จาก pyahocorasick เมื่อติดตั้งไว้ หากไม่มีจะใช้
+    regex รวมคัดกรองก่อนแล้วจึงตรวจทีละคำ ผลลัพธ์เรียงตามลำดับคำที่ส่งเข้ามา
+    """
+    def __init__(self, keywords: Iterable[str]):
+        self.keywords = tuple(dict.fromkeys(kw for kw in keywords if kw))
+        if ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for index, keyword in enumerate(self.keywords):
+                self._automaton.add_word(keyword, index)
+            self._automaton.make_automaton()
+            self._pattern = None
+        else:
+            self._automaton = None
+            self._pattern = re.compile(
+                "|".join(re.escape(kw) for kw in sorted(self.keywords, key=len, reverse=True))
+            )
+
+    def find_all(self, text: str) -> List[str]:
+        """คืนคำสำคัญทั้งหมดที่พบในข้อความ (ไม่ซ้ำ)"""
+        if not text or not self.keywords:
+            return []
+        if self._automaton is not None:
+            indexes = sorted({index for _, index in self._automaton.iter(text)})
+            return [self.keywords[index] for index in indexes]
+        if not self._pattern.search(text):
+            return []
+        return [kw for kw in self.keywords if kw in text]
+
+    def contains_any(self, text: str) -> bool:
+        """ตรวจว่าข้อความมีคำสำคัญอย่างน้อยหนึ่งคำหรือไม่"""
+        if not text or not self.keywords:
+            return False
+        if self._automaton is not None:
+            return next(self._automaton.iter(text), None) is not None
+        return self._pattern.search(text) is not None
+
+def json_dumps(obj: Any) -> Union[str, bytes]:
+    """
+    แปลงข้อมูลเป็น JSON ด้วย orjson เมื่อติดตั้งไว้ (คืนค่า bytes แบบ UTF-8)
+    หากไม่มีจะใช้ json มาตรฐาน ค่าทั้งสองแบบส่งเข้า Redis ได้โดยตรง
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj)
+
+def json_loads(data: Union[str, bytes]) -> Any:
+    """อ่าน JSON จาก str หรือ bytes ด้วย orjson เมื่อติดตั้งไว้"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 def safe_db_operation(func: F) -> F:
     """
     เดโครเรเตอร์สำหรับการดำเนินการฐานข้อมูลแบบปลอดภัย
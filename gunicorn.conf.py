@@ -0,0 +1,42 @@
+"""
+ค่าตั้งต้น Gunicorn สำหรับรันแชทบอท 'ใจดี' หลายโปรเซส
+
+ใช้งาน: gunicorn -c gunicorn.conf.py wsgi:application
+"""
+import os
+import subprocess
+import sys
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+
+# แต่ละ worker มี MySQL pool, Redis pool และ rate limit ของ xAI เป็นของตัวเอง
+# จึงใช้ค่าเริ่มต้นน้อย ๆ แล้วปรับผ่าน WEB_CONCURRENCY
+workers = int(os.getenv('WEB_CONCURRENCY', min(4, os.cpu_count() or 1)))
+worker_class = 'gthread'
+threads = int(os.getenv('THREADS', 16))
+
+# worker ใช้ค่านี้แบ่ง DB_POOL_SIZE ให้จำนวนการเชื่อมต่อ MySQL รวมคงที่
+os.environ['WEB_CONCURRENCY'] = str(workers)
+
+# ไม่ใช้ preload: app.app_main สร้าง thread pool, event loop ของ Grok และเธรดเบื้องหลังตอน import
+# ซึ่งไม่ตามไปหลัง fork แต่ละ worker จึงต้อง import แอปเอง
+# (ตัวกำหนดการเริ่มใน worker ทุกตัว การดึงคิวติดตามผลเป็น atomic จึงไม่ส่งซ้ำ)
+preload_app = False
+
+# LINE รอ webhook ไม่นาน งานหนักถูกส่งต่อให้ thread pool อยู่แล้ว
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 10
+keepalive = 5
+
+
+def on_starting(server):
+    """สร้างตารางและปรับปรุงฐานข้อมูลครั้งเดียวใน master ก่อน fork worker"""
+    if os.getenv('DB_INIT_ON_START', '1') != '0':
+        # import แอปในโปรเซสแยก master จึงไม่ถือ pool หรือเธรดของแอปไปถึง worker
+        subprocess.run(
+            [sys.executable, '-c', 'import app.app_main'],
+            env={**os.environ, 'WEB_CONCURRENCY': '1', 'DB_INIT_ON_START': '1'},
+            check=True,
+        )
+    # worker ข้ามขั้นตอนนี้ตอน import
+    os.environ['DB_INIT_ON_START'] = '0'
@@ -4,6 +4,13 @@
 ด้วยเซิร์ฟเวอร์ WSGI เช่น Gunicorn หรือ uWSGI
 """
 import os
+
+# เมื่อรันด้วย gunicorn -k gevent ต้อง patch socket/threading ก่อน import โมดูลอื่น
+# เพื่อให้ Redis, MySQL และ HTTP client ทำงานร่วมกับ greenlet ได้
+if os.getenv('SERVER', 'waitress') == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
 import sys
 import logging
 from logging.handlers import RotatingFileHandler
@@ -40,15 +47,28 @@ except Exception as e:
     logging.critical(f"เกิดข้อผิดพลาดร้ายแรงในการเริ่มต้นแอปพลิเคชัน: {str(e)}")
     raise
 
-# สำหรับ Gunicorn
+# สำหรับ Gunicorn: SERVER=gevent gunicorn -k gevent -w 2 --worker-connections 1000 wsgi:application
 application = app
 
 # สำหรับการรันโดยตรง (เช่น ทดสอบ)
 if __name__ == "__main__":
     from waitress import serve
+    from app.app_main import install_shutdown_signal_handlers
+
+    # Waitress ไม่จัดการสัญญาณปิดเอง จึงติดตั้ง handler ของแอป (gunicorn จัดการเองจึงไม่ติดตั้งตอน import)
+    install_shutdown_signal_handlers()
     
-    # กำหนดพอร์ตจากตัวแปรสภาพแวดล้อมหรือใช้ค่าเริ่มต้น
+    # กำหนดพอร์ตและจำนวนเธรดจากตัวแปรสภาพแวดล้อมหรือใช้ค่าเริ่มต้น
     port = int(os.getenv('PORT', 5000))
+    threads = int(os.getenv('THREADS', 16))
+    connection_limit = int(os.getenv('CONN_LIMIT', 1000))
     
-    logging.info(f"เริ่มต้นเซิร์ฟเวอร์ Waitress บนพอร์ต {port}")
-    serve(app, host='0.0.0.0', port=port)
+    logging.info(f"เริ่มต้นเซิร์ฟเวอร์ Waitress บนพอร์ต {port} ({threads} เธรด)")
+    serve(
+        app,
+        host='0.0.0.0',
+        port=port,
+        threads=threads,
+        connection_limit=connection_limit,
+        asyncore_use_poll=True,
+    )